@@ -1,9 +1,11 @@
 
+import os
+
 from celery import shared_task
 
 from django.conf import settings
 from django.core.mail import send_mail
-from manager.models import Opus
+from manager.models import Corpus, Opus, Annotation, render_cache
 
 @shared_task
 def add(x, y):
@@ -24,3 +26,24 @@ def send_email(subject, message, recipients, html_message=None):
 def parse_dmos(opus_ref):
 	opus = Opus.objects.get(ref=opus_ref)
 	opus.parse_dmos()
+
+@shared_task
+def render_opus(opus_ref):
+	opus = Opus.objects.get(ref=opus_ref)
+	render_path = opus.get_render_path()
+	if render_path is not None:
+		render_cache.render(render_path)
+
+@shared_task
+def backfill_web_annotations(opus_ref):
+	opus = Opus.objects.get(ref=opus_ref)
+	Annotation.backfill_web_annotations(Annotation.objects.filter(opus=opus))
+
+@shared_task
+def export_corpus(corpus_ref, mode="json", flat=False, recipient=None):
+	corpus = Corpus.objects.get(ref=corpus_ref)
+	path = corpus.export_to_file(mode, flat)
+	if recipient is not None:
+		url = settings.EXPORT_URL + os.path.basename(path)
+		send_email(f"Export of corpus {corpus.title}", 
+				f"The export of corpus {corpus.title} can be downloaded at {url}", [recipient])
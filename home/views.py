@@ -3,7 +3,6 @@ import logging, json
 import os
 from pprint import pprint  # debug only
 import zipfile
-import verovio
 from natsort import natsorted
 
 #from Cython.Compiler.Buffer import context
@@ -13,7 +12,7 @@ from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.urls import reverse
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse, JsonResponse
 from django.http import HttpResponseRedirect
 from django.shortcuts import redirect
 from django.shortcuts import render
@@ -27,10 +26,14 @@ from manager.models import (Corpus,
 						Opus, Upload, Bookmark, 
 						Config, Licence, Annotation, 
 						AnalyticModel, AnalyticConcept, Image)
+from manager.utils import StreamBuffer
 
 from music import *
 
 from neumasearch.IndexWrapper import IndexWrapper
+from neumasearch.SearchBackend import get_search_backend
+from neumasearch.SearchResults import SearchResults
+from neumasearch.SearchCache import SearchCache
 from neumasearch.MusicSummary import  MusicSummary
 from neumasearch.SearchContext import SearchContext
 from neumasearch.Sequence import Sequence
@@ -38,10 +41,12 @@ from neumautils.views import NeumaView
 import xml.etree.ElementTree as ET
 
 from .forms import *
+from .tasks import export_corpus
 
 # Music model modules
 import lib.music.source as source_mod
 import lib.music.constants as constants_mod
+from lib.music.toolkits import toolkit_pool
 import lib.iiif.IIIF2 as iiif2_mod
 import lib.iiif.IIIF3 as iiif3_mod
 import lib.iiif.helpers as iiif3_helpers
@@ -174,8 +179,25 @@ def export_corpus_as_zip (request, corpus_ref):
 	else:
 		mode = "json"
 
-	zip_bytes = corpus.export_as_zip(request,mode)
-	resp = HttpResponse(zip_bytes.getvalue(), content_type = "application/x-zip-compressed")
+	# Children as directories, instead of zip files
+	flat = request.GET.get("layout") == "flat"
+
+	if request.GET.get("background") == "true":
+		# Large corpora: the zip is produced by a task, then downloaded
+		export_corpus.delay(corpus.ref, mode, flat, getattr(request.user, "email", "") or None)
+		return JsonResponse({"status": "ok",
+				"message": f"Export of corpus {corpus.ref} in progress",
+				"url": settings.EXPORT_URL + corpus.get_export_name(mode, flat)})
+
+	# The zip is sent while it is produced
+	buffer = StreamBuffer()
+	def zip_chunks():
+		for _block in corpus.stream_zip(buffer, mode, flat):
+			data = buffer.take()
+			if len(data) > 0:
+				yield data
+
+	resp = StreamingHttpResponse(zip_chunks(), content_type = "application/x-zip-compressed")
 	resp["Content-Disposition"] = "attachment; filename=%s.zip" % Corpus.local_ref(corpus_ref) 
 
 	return resp
@@ -426,19 +448,10 @@ class OpusView(NeumaView):
 
 		if self.search_context.keywords != "":
 			#There is a keyword to search
-			matching_ids = []
-			keyword_in_search = self.search_context.keywords
-			score = opus.get_score()
-			for voice in score.get_all_voices():
-				#get lyrics of the current voice
-				curr_lyrics = voice.get_lyrics()
-				if curr_lyrics != None:
-					#There is a match within the current lyrics
-					if keyword_in_search in curr_lyrics:
-						occurrences, curr_matching_ids = voice.search_in_lyrics(keyword_in_search)
-						if occurrences > 0:
-							for m_id in curr_matching_ids:
-								matching_ids.append(m_id)
+			def find_lyrics_ids():
+				return SearchResults.find_lyrics_ids(opus, self.search_context.keywords)
+			# The search context now refers to the opus: the key is specific to it
+			matching_ids = SearchCache.get_or_set(self.search_context, "lyrics_ids", find_lyrics_ids)
 			context["msummary"] = ""
 			context["pattern"] = ""
 			# Could be improved if necessary: context["occurrences"] in the 
@@ -453,19 +466,19 @@ class OpusView(NeumaView):
 			pattern_sequence = Sequence()
 			pattern_sequence.set_from_pattern(self.search_context.pattern)
 
-			msummary = MusicSummary()
 			if opus.summary:
-				with open(opus.summary.path, "r") as summary_file:
-					msummary_content = summary_file.read()
-				msummary.decode(msummary_content)
+				msummary = MusicSummary.load(opus.summary.path)
 			else:
+				msummary = MusicSummary()
 				logger.warning ("No summary for Opus " + opus.ref)
 
 			search_type = self.search_context.search_type
 			mirror_setting = False 
 
-			occurrences = msummary.find_positions(pattern_sequence, search_type, mirror_setting)
-			matching_ids = msummary.find_matching_ids(pattern_sequence, search_type, mirror_setting)
+			def find_matches():
+				return (msummary.find_positions(pattern_sequence, search_type, mirror_setting),
+					msummary.find_matching_ids(pattern_sequence, search_type, mirror_setting))
+			occurrences, matching_ids = SearchCache.get_or_set(self.search_context, "opus_matches", find_matches)
 			
 			context["msummary"] = msummary
 			context["pattern"] = self.search_context.pattern
@@ -639,10 +652,10 @@ def add_opus (request, corpus_ref):
 			opus.corpus = context["corpus"]
 			opus.save()
 			if bool(opus.musicxml)  and not bool(opus.mei):
-				tk = verovio.toolkit()
-				tk.loadFile(opus.musicxml.path)
-				mei_content = tk.getMEI()
+				with open(opus.musicxml.path, "rb") as mxml_file:
+					mei_content = toolkit_pool.to_mei(mxml_file.read())
 				opus.mei.save("mei.xml", ContentFile(mei_content))
+			opus.index_mei()
 			return redirect ('home:edit_opus', opus_ref=opus.ref)
 		else:
 			print ("Problème")
@@ -670,10 +683,10 @@ def edit_opus (request, opus_ref):
 			opus.save()
 			
 			if bool(opus.musicxml)  and not bool(opus.mei):
-				tk = verovio.toolkit()
-				tk.loadFile(opus.musicxml.path)
-				mei_content = tk.getMEI()
+				with open(opus.musicxml.path, "rb") as mxml_file:
+					mei_content = toolkit_pool.to_mei(mxml_file.read())
 				opus.mei.save("mei.xml", ContentFile(mei_content))
+			opus.index_mei()
 			context["message"] = "Opus updated ! "
 		else:
 			# Reaffichage avec l'erreur
@@ -750,9 +763,8 @@ class SearchView(NeumaView):
 		context["corpus"] = Corpus.objects.get(ref=search_context.ref)
 		context["corpus_cover"] = context["corpus"].get_cover()
 
-		# Run the search
-		index = IndexWrapper()
-		all_opera = index.search(search_context)
+		# Run the search, or resume it from the cache
+		all_opera = SearchResults.run(get_search_backend(), search_context)
 
 		paginator = Paginator(all_opera, settings.ITEMS_PER_PAGE)
 		page = self.request.GET.get('page')
@@ -766,7 +778,7 @@ class SearchView(NeumaView):
 			opera = paginator.page(paginator.num_pages)
 
 		context["searchType"] = search_context.search_type
-		context["nbHits"] = len(all_opera)
+		context["nbHits"] = paginator.count
 		context["opera"] = opera
 		return context
 
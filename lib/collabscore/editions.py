@@ -222,6 +222,28 @@ class Edition:
 	def insert_after(self, parent, element, new_element):
 		parent.insert(parent.index(element)+1, new_element)
 
+	@staticmethod
+	def apply_editions_to_doc(post_editions, mxml_doc):
+		# Post editions applied to a MusicXML document in memory
+		
+		# Find the value of "divisions": used to determine XML duration
+		for division_node in mxml_doc.findall(f".//divisions"):
+			divisions = int(division_node.text)
+		
+		# First we reinsert objects 
+		for ed in post_editions:
+			if ed.name == Edition.APPEND_OBJECTS:
+				ed.append_objects (mxml_doc, divisions)
+
+		# Then we apply the other editions
+		for ed in post_editions:
+			if ed.name == Edition.MOVE_OBJECT_TO_STAFF:
+				# Assign an object to a staff. Done in the MusicXML file
+				ed.move_object_to_staff (mxml_doc)
+			elif ed.name == Edition.CLEAN_BEAM:
+				# Remove temporary beams
+				ed.clean_beam (mxml_doc)
+
 	@staticmethod
 	def apply_editions_to_file(post_editions, xml_file, format="musicxml"):
 		# All post editions apply to the MusicXML file
@@ -229,24 +251,7 @@ class Edition:
 		if format == "musicxml":
 			print (f"Open file {xml_file}")
 			mxml_doc = etree.parse(xml_file)
-			# Find the value of "divisions": used to determine XML duration
-			for division_node in mxml_doc.findall(f".//divisions"):
-				divisions = int(division_node.text)
-			
-			# First we reinsert objects 
-			for ed in post_editions:
-				if ed.name == Edition.APPEND_OBJECTS:
-					ed.append_objects (mxml_doc, divisions)
-
-			# Then we apply the other editions
-			for ed in post_editions:
-				if ed.name == Edition.MOVE_OBJECT_TO_STAFF:
-					# Assign an object to a staff. Done in the MusicXML file
-					ed.move_object_to_staff (mxml_doc)
-				elif ed.name == Edition.CLEAN_BEAM:
-					# Remove temporary beams
-					ed.clean_beam (mxml_doc)
-	
+			Edition.apply_editions_to_doc (post_editions, mxml_doc)
 			# Write it back
 			mxml_doc.write (xml_file)
 		elif format == "mei":
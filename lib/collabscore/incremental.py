@@ -0,0 +1,353 @@
+# import the logging library
+import logging
+
+import copy
+import io
+import json
+import multiprocessing
+import sys
+import threading
+from collections import OrderedDict
+
+import lib.collabscore.parser as parser_mod
+import lib.music.constants as constants_mod
+
+from .editions import Edition
+from .reader import DmosReader
+
+# for XML editions
+from lxml import etree
+
+logger = logging.getLogger(__name__)
+
+'''
+  Incremental production of the MusicXML file of a DMOS source. The
+  output of the last editions is kept, and a new list of editions only
+  regenerates the measures it modifies
+'''
+
+# Score decoded by the parent process, used by the workers of a pool
+worker_score = None
+
+def init_worker(omr_score):
+	global worker_score
+	worker_score = omr_score
+
+def produce_systems(task):
+	'''
+	  Produce, in a worker process, the measures of a range of systems. Returns
+	  the MusicXML document, its divisions and the post editions of the parser
+	'''
+	config, measures, editions_json = task
+	omr_score = worker_score
+	omr_score.config = parser_mod.ParserConfig(config)
+	mxml_doc = IncrementalScore.write_score(omr_score)
+	divisions = mxml_doc.findtext(".//divisions")
+
+	# The measures of the systems given as a context are removed
+	for part in mxml_doc.getroot().iterfind("part"):
+		for measure in list(part.iterfind("measure")):
+			if int(measure.get("number")) not in measures:
+				# With the comment that announces the measure
+				comment = measure.getprevious()
+				if comment is not None and comment.tag is etree.Comment:
+					part.remove(comment)
+				part.remove(measure)
+
+	parser_editions = IncrementalScore.get_parser_editions(omr_score, editions_json)
+	for edition in parser_editions:
+		if edition.name == Edition.APPEND_OBJECTS:
+			edition.params = {"events": [RenderedEvent(event, int(divisions))
+								for event in edition.params["events"]]}
+	return etree.tostring(mxml_doc), divisions, parser_editions
+
+class RenderedEvent:
+	"""
+	  An event removed from a voice, already encoded in MusicXML. Events
+	  refer to the whole score, and cannot be sent by a worker process
+	"""
+	def __init__(self, event, divisions):
+		self.id = event.id
+		self.elements = [etree.tostring(el) for el in event.to_musicxml(divisions)]
+
+	def to_musicxml(self, divisions):
+		return [etree.fromstring(el) for el in self.elements]
+
+class IncrementalScore:
+	"""
+	  State of the score produced from a version of a DMOS source: the MusicXML
+	  document before post-editions, the editions it results from, and the
+	  location of the note heads.
+	"""
+
+	# Number of sources whose state is kept in memory
+	MAX_SOURCES = 8
+	sources = OrderedDict()
+
+	# Editions that only change the measure of their target (a note head)
+	LOCAL_EDITION_CODES = [Edition.REPLACE_MUSIC_ELEMENT, Edition.REMOVE_OBJECT,
+						Edition.COMMENT_ELEMENT]
+
+	# A process produces at least this number of systems
+	MIN_SYSTEMS_PER_JOB = 4
+
+	def __init__(self, open_dmos, config={}, jobs=1):
+		# The DMOS input is read again for each production: editions
+		# modify the decoded objects. open_dmos opens the DMOS file
+		self.open_dmos = open_dmos
+		self.config = config
+		# Nb of processes for a full production
+		self.jobs = jobs
+
+		# MusicXML document, before post-editions, and editions it comes from
+		self.mxml_doc = None
+		self.editions_json = []
+		# Post editions produced by the parser (eg, moves to another staff)
+		self.parser_editions = []
+		# Measure of each note head
+		self.locations = {}
+		# Systems of the score, with the numbers of their measures
+		self.systems = []
+		# Editions of a same source are applied one at a time
+		self.lock = threading.Lock()
+
+	@staticmethod
+	def get_score(key, open_dmos, config={}, jobs=1):
+		'''
+		  The state kept for a key (source, version, page range). open_dmos
+		  opens the DMOS file
+		'''
+		if key in IncrementalScore.sources:
+			IncrementalScore.sources.move_to_end(key)
+		else:
+			IncrementalScore.sources[key] = IncrementalScore(open_dmos, config, jobs)
+			if len(IncrementalScore.sources) > IncrementalScore.MAX_SOURCES:
+				IncrementalScore.sources.popitem(last=False)
+		return IncrementalScore.sources[key]
+
+	def write_as_musicxml(self, editions, out_file):
+		with self.lock:
+			self.write_editions(editions, out_file)
+
+	def write_editions(self, editions, out_file):
+		# The parser modifies the editions: we work on copies
+		editions_json = json.loads(json.dumps([edition.to_json() for edition in editions]))
+
+		if self.mxml_doc is None:
+			self.produce(editions_json)
+		else:
+			changed = self.changed_editions(editions_json)
+			dirty_measures = self.dirty_measures(changed)
+			if dirty_measures is None:
+				print ("Editions change the structure of the score. Full production")
+				self.produce(editions_json)
+			elif len(dirty_measures) > 0:
+				print (f"Regenerating measures {sorted(dirty_measures)}")
+				if not self.regenerate(editions_json, dirty_measures):
+					logger.warning ("Unable to regenerate the measures. Full production")
+					self.produce(editions_json)
+			self.editions_json = editions_json
+
+		# Post editions are applied to a copy of the document
+		mxml_doc = copy.deepcopy(self.mxml_doc)
+		post_editions = [edition for edition in IncrementalScore.decode_editions(editions_json)
+							if edition.name in Edition.POST_EDITION_CODES]
+		post_editions += self.parser_editions
+		post_editions.append(Edition (Edition.CLEAN_BEAM, "score"))
+		Edition.apply_editions_to_doc (post_editions, mxml_doc)
+		mxml_doc.write(out_file)
+
+	@staticmethod
+	def decode_editions(editions_json):
+		return [Edition.from_json(json.loads(json.dumps(json_ed))) for json_ed in editions_json]
+
+	def create_omr_score(self, editions_json, config):
+		with self.open_dmos() as dmos_file:
+			return parser_mod.OmrScore ("", DmosReader(dmos_file), config,
+							IncrementalScore.decode_editions(editions_json))
+
+	def produce(self, editions_json):
+		'''
+		  Produce the whole score
+		'''
+		omr_score = self.create_omr_score(editions_json, self.config)
+		self.systems = []
+		for page in omr_score.pages:
+			for system in page.systems:
+				self.systems.append({"page": page.no_page, "system": system.no_system_in_page,
+						"measures": [measure.no_measure_in_score for measure in system.measures]})
+
+		if not self.produce_in_parallel(omr_score, editions_json):
+			self.mxml_doc = IncrementalScore.write_score(omr_score)
+			self.parser_editions = IncrementalScore.get_parser_editions(omr_score, editions_json)
+		self.editions_json = editions_json
+		self.locations.update(omr_score.get_object_locations())
+
+	def produce_in_parallel(self, omr_score, editions_json):
+		'''
+		  Produce the score with a pool of processes, each one in charge of
+		  consecutive systems. The decoding of the input gives the signatures,
+		  clefs and lyrics that carry over systems. The previous and next systems
+		  are produced as a context, and the measures are merged in order.
+		'''
+		parser_config = parser_mod.ParserConfig(self.config)
+		if parser_config.measure_min > 0 or parser_config.measure_max < sys.maxsize:
+			# Ranges of measures are not split
+			return False
+		systems = [system for system in self.systems
+					if parser_config.in_range(system["page"], system["system"])]
+		nb_jobs = min(self.jobs, len(systems) // IncrementalScore.MIN_SYSTEMS_PER_JOB)
+		if nb_jobs < 2 or multiprocessing.current_process().daemon:
+			# Daemon processes (e.g., Celery workers) cannot have a pool
+			return False
+
+		tasks = []
+		for i_job in range(nb_jobs):
+			i_first = i_job * len(systems) // nb_jobs
+			i_last = (i_job + 1) * len(systems) // nb_jobs - 1
+			first = systems[max(i_first - 1, 0)]
+			last = systems[min(i_last + 1, len(systems) - 1)]
+			config = dict(self.config)
+			config.update({"page_min": first["page"], "system_min": first["system"], "measure_min": 0,
+				"page_max": last["page"], "system_max": last["system"], "measure_max": sys.maxsize})
+			measures = set()
+			for system in systems[i_first:i_last + 1]:
+				measures.update(system["measures"])
+			tasks.append((config, measures, editions_json))
+
+		print (f"Producing {len(systems)} systems with {nb_jobs} processes")
+		# A new process for each task: the production modifies the score
+		with multiprocessing.Pool(nb_jobs, initializer=init_worker, 
+							initargs=(omr_score,), maxtasksperchild=1) as pool:
+			results = pool.map(produce_systems, tasks)
+
+		# The measures produced by the other processes are added to the first document
+		mxml_text, divisions, parser_editions = results[0]
+		mxml_doc = etree.parse(io.BytesIO(mxml_text))
+		parts = {part.get("id"): part for part in mxml_doc.getroot().iterfind("part")}
+		for mxml_text, job_divisions, job_editions in results[1:]:
+			if job_divisions != divisions:
+				logger.warning ("Processes produced different divisions: sequential production")
+				return False
+			for part in etree.fromstring(mxml_text).iterfind("part"):
+				if part.get("id") not in parts:
+					logger.warning (f"Part {part.get('id')} unknown to the first process: sequential production")
+					return False
+				parts[part.get("id")].extend(list(part))
+			parser_editions += job_editions
+
+		self.mxml_doc = mxml_doc
+		self.parser_editions = parser_editions
+		return True
+
+	def changed_editions(self, editions_json):
+		# Editions added, modified or removed since the last production
+		previous = [json.dumps(json_ed, sort_keys=True) for json_ed in self.editions_json]
+		current = [json.dumps(json_ed, sort_keys=True) for json_ed in editions_json]
+		return ([json_ed for json_ed, code in zip(editions_json, current) if code not in previous] +
+			[json_ed for json_ed, code in zip(self.editions_json, previous) if code not in current])
+
+	def dirty_measures(self, changed):
+		'''
+		  The numbers of the measures to regenerate, or None if the
+		  whole score must be produced again
+		'''
+		dirty_measures = set()
+		for json_ed in changed:
+			if json_ed["name"] in Edition.POST_EDITION_CODES:
+				# Applied to the MusicXML document
+				continue
+			if json_ed["name"] not in IncrementalScore.LOCAL_EDITION_CODES:
+				# Parts, staves and signatures concern the following measures as well
+				return None
+			for id in json_ed["target"].split (constants_mod.ID_SEPARATOR):
+				if id not in self.locations:
+					# Clefs, or unknown objects
+					return None
+				dirty_measures.add(self.locations[id])
+		return dirty_measures
+
+	def regenerate(self, editions_json, dirty_measures):
+		'''
+		  Produce again the systems that contain dirty measures, and replace
+		  the measures in the document. The previous and next systems are
+		  produced as well, as a context for signatures, ties and beams.
+		'''
+		# The measures of the document, by part and number
+		measures = {}
+		for part in self.mxml_doc.getroot().iterfind("part"):
+			for measure in part.iterfind("measure"):
+				measures[(part.get("id"), measure.get("number"))] = measure
+		# Measures out of the page range are not in the document
+		dirty_measures = set(no_measure for no_measure in dirty_measures
+					if str(no_measure) in set(number for id_part, number in measures.keys()))
+		if len(dirty_measures) == 0:
+			return True
+
+		i_systems = [i for i, system in enumerate(self.systems)
+						if not dirty_measures.isdisjoint(system["measures"])]
+		# Systems close to each other are produced together
+		clusters = [[i_systems[0], i_systems[0]]]
+		for i_system in i_systems[1:]:
+			if i_system - clusters[-1][1] <= 2:
+				clusters[-1][1] = i_system
+			else:
+				clusters.append([i_system, i_system])
+
+		for i_first, i_last in clusters:
+			first = self.systems[max(i_first - 1, 0)]
+			last = self.systems[min(i_last + 1, len(self.systems) - 1)]
+			cluster_measures = set()
+			for system in self.systems[i_first:i_last + 1]:
+				cluster_measures.update(dirty_measures.intersection(system["measures"]))
+			if not self.regenerate_systems(editions_json, cluster_measures, first, last, measures):
+				return False
+		return True
+
+	def regenerate_systems(self, editions_json, dirty_measures, first, last, measures):
+		# Produce the systems from first to last, and replace the dirty measures
+		config = dict(self.config)
+		config.update({"page_min": first["page"], "system_min": first["system"], "measure_min": 0,
+			"page_max": last["page"], "system_max": last["system"], "measure_max": sys.maxsize})
+		omr_score = self.create_omr_score(editions_json, config)
+		partial_doc = IncrementalScore.write_score(omr_score)
+
+		if (partial_doc.findtext(".//divisions") != self.mxml_doc.findtext(".//divisions")):
+			return False
+
+		# Post editions produced for the measures which are replaced
+		dirty_ids = set()
+		for (id_part, no_measure), measure in measures.items():
+			if int(no_measure) in dirty_measures:
+				dirty_ids.update(el.get("id") for el in measure.iter() if el.get("id") is not None)
+		new_ids = set()
+
+		for part in partial_doc.getroot().iterfind("part"):
+			for measure in part.iterfind("measure"):
+				key = (part.get("id"), measure.get("number"))
+				if int(measure.get("number")) in dirty_measures:
+					if key not in measures:
+						return False
+					previous = measures[key]
+					previous.getparent().replace(previous, measure)
+					measures[key] = measure
+					new_ids.update(el.get("id") for el in measure.iter() if el.get("id") is not None)
+
+		self.parser_editions = ([edition for edition in self.parser_editions if edition.target not in dirty_ids] +
+					[edition for edition in IncrementalScore.get_parser_editions(omr_score, editions_json)
+							if edition.target in new_ids])
+		self.locations.update(omr_score.get_object_locations())
+		return True
+
+	@staticmethod
+	def get_parser_editions(omr_score, editions_json):
+		# The parser adds its own post-editions after those received
+		nb_post_editions = len([json_ed for json_ed in editions_json
+							if json_ed["name"] in Edition.POST_EDITION_CODES])
+		return [edition for edition in omr_score.post_editions[nb_post_editions:]
+						if edition.name != Edition.CLEAN_BEAM]
+
+	@staticmethod
+	def write_score(omr_score):
+		# The MusicXML document produced from the score, without post editions
+		return omr_score.get_score().get_musicxml_doc()
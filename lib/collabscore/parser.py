@@ -1,6 +1,8 @@
 
 # import the logging library
 import logging
+import multiprocessing
+import os
 import sys
 import json
 import jsonref
@@ -52,6 +54,25 @@ c_handler.setFormatter(c_format)
 PSEUDO_SIGN_ID="pseudo_sign"
 PSEUDO_SIGN_COUNTER=0
 
+# Parser that validates the pages decoded by the workers of a pool
+worker_parser = None
+
+def init_page_worker(parser):
+	global worker_parser
+	worker_parser = parser
+
+def decode_page(task):
+	'''
+	  Validate and decode a page of the DMOS input, in a worker process.
+	  Returns the page and its validation errors
+	'''
+	i_page, json_page = task
+	errors = []
+	if worker_parser is not None:
+		errors = worker_parser.validate_page(json_page, i_page)
+	json_page["no_page"] = i_page + 1 # Bug in DMOS
+	return Page(json_page), errors
+
 
 def set_logging_level(level):
 	logger.setLevel(level)
@@ -136,6 +157,9 @@ class CollabScoreParser:
 
 	"""
 
+	# Parsers already built, with the signature of their schema files
+	parsers = {}
+
 	def __init__(self, schema_file_path, base_uri=""):
 		"""
 		   Load the schema of OMR json files, for type checking
@@ -177,30 +201,127 @@ class CollabScoreParser:
 				str_errors += " Error : " + e.message + " (path " + path + ")"
 			raise Exception ("Schema  validation error: " + str_errors)
 
-
-	def validate_data (self, json_content):
-		# Might raise an exception
+		# The schema is checked once: data are then validated with
+		# a compiled validator (same class as jsonschema.validate)
+		validator_class = jsonschema.validators.validator_for(self.schema)
 		try:
-			jsonschema.validate (instance=json_content, 
-							schema=self.schema, 
-							resolver=self.resolver)
-		except jsonschema.ValidationError as ex:
-			self.error_messages = self.collect_errors(json_content, "Data validation errror")
-			return False
+			validator_class.check_schema(self.schema)
+			self.schema_error = None
 		except jsonschema.SchemaError as ex:
+			logger.warning (f'Invalid schema {schema_file_path}: {ex.message}')
+			self.schema_error = ex
+		self.data_validator = validator_class(self.schema, resolver=self.resolver)
+
+		# Validators of a single page, for a page by page validation
+		self.page_validator = None
+		self.page_data_validator = None
+		if ("properties" in self.schema and "pages" in self.schema["properties"]
+				and "items" in self.schema["properties"]["pages"]):
+			page_schema = self.schema["properties"]["pages"]["items"]
+			self.page_validator = jsonschema.Draft7Validator (page_schema, resolver=self.resolver)
+			self.page_data_validator = validator_class(page_schema, resolver=self.resolver)
+
+	@staticmethod
+	def get_parser(schema_file_path, base_uri=""):
+		"""
+		  A parser built once per process, and again only when
+		  the schema files change 
+		"""
+		key = (schema_file_path, base_uri)
+		signature = CollabScoreParser.schema_signature(schema_file_path)
+		if key in CollabScoreParser.parsers:
+			parser_signature, parser = CollabScoreParser.parsers[key]
+			if parser_signature == signature:
+				return parser
+			logger.info (f'Schema files of {schema_file_path} have changed. Reloading')
+		parser = CollabScoreParser(schema_file_path, base_uri)
+		CollabScoreParser.parsers[key] = (signature, parser)
+		return parser
+
+	@staticmethod
+	def schema_signature(schema_file_path):
+		# Modification times of the files in the schema directory
+		schema_dir = os.path.dirname(schema_file_path.replace("file://", "", 1))
+		if not os.path.isdir(schema_dir):
+			return None
+		signature = []
+		for entry in os.scandir(schema_dir):
+			if entry.is_file() and entry.name.endswith(".json"):
+				signature.append((entry.name, entry.stat().st_mtime))
+		return sorted(signature)
+
+	def validate_data (self, json_content):
+		if self.schema_error is not None:
+			# jsonschema.validate fails on an invalid schema
 			self.error_messages = self.collect_errors(json_content, "Schema validation errror")
 			return False
+		if not self.data_validator.is_valid(json_content):
+			self.error_messages = self.collect_errors(json_content, "Data validation errror")
+			return False
 		# No pb
 		return True
+
+	def validate_pages (self, json_content, max_errors=1):
+		"""
+		  Validate a DMOS document page by page: the validation stops
+		  once max_errors pages (None: no limit) have been found invalid 
+		"""
+		if (self.page_validator is None or not isinstance(json_content, dict)
+				or not isinstance(json_content.get("pages"), list)):
+			return self.validate_data(json_content)
+
+		if self.schema_error is not None:
+			context = "Schema validation errror"
+		else:
+			context = "Data validation errror"
+		self.error_messages = []
+		nb_errors = 0
+
+		# The document, with its first page only
+		pages = json_content["pages"]
+		document = dict(json_content)
+		document["pages"] = pages[:1]
+		if self.schema_error is not None or not self.data_validator.is_valid(document):
+			errors = self.collect_errors(document, context)
+			if len(errors) > 0:
+				self.error_messages += errors
+				nb_errors += 1
+
+		for i_page in range(1, len(pages)):
+			if max_errors is not None and nb_errors >= max_errors:
+				logger.warning (f'Validation stopped at page {i_page + 1} after {nb_errors} invalid pages')
+				break
+			errors = self.validate_page(pages[i_page], i_page)
+			if len(errors) > 0:
+				self.error_messages += errors
+				nb_errors += 1
+
+		return len(self.error_messages) == 0
+
+	def validate_page (self, json_page, i_page):
+		"""
+		  Validate one page of a DMOS document. Returns the list of errors
+		"""
+		if self.page_validator is None:
+			return []
+		if self.schema_error is None and self.page_data_validator.is_valid(json_page):
+			return []
+		if self.schema_error is not None:
+			context = "Schema validation errror"
+		else:
+			context = "Data validation errror"
+		return self.collect_errors(json_page, context, self.page_validator, f"/pages/{i_page}/")
 	
-	def collect_errors (self, json_content, context):
+	def collect_errors (self, json_content, context, validator=None, path_prefix="/"):
 		''' 
 		Put errors found in an exception in a list
 		'''
+		if validator is None:
+			validator = self.validator
 		errors_list=[]
-		errors = sorted(self.validator.iter_errors(json_content), key=lambda e: e.path)
+		errors = sorted(validator.iter_errors(json_content), key=lambda e: e.path)
 		for e in errors:
-			path = "/"
+			path = path_prefix
 			for p in e.absolute_path:
 				path += str(p) + '/' 
 			errors_list.append(f"{context}: {e.message} at path {path}")
@@ -214,10 +335,12 @@ class OmrScore:
 	"""
 	  A structured representation of the score supplied by the OMR tool
 	"""
-	def __init__(self, uri, json_data, config={}, editions=[]):
+	def __init__(self, uri, json_data, config={}, editions=[], jobs=1):
 		"""
-			Input: a validated JSON object. The method builds
-			a representation based on the Python classes
+			Input: a validated JSON object, or a DmosReader that
+			gives the pages one at a time. The method builds
+			a representation based on the Python classes. Pages
+			of a DmosReader are decoded by 'jobs' processes
 		"""
 		"""config = { "log_level": "INFO", "page_min":1, "system_min":1,
 				"measure_min":1, "page_max": 1, "system_max":2,"measure_max": 999
@@ -232,7 +355,6 @@ class OmrScore:
 		self.id = 1 #json_data["id"]
 		self.score_image_url = "http://" # json_data["score_image_url"]
 		#self.date = json_data["date"]
-		self.json_data = json_data
 		
 		# We record some information on notational peculiarities
 		self.clef_changes = False
@@ -264,23 +386,31 @@ class OmrScore:
 			if edition.name in Edition.POST_EDITION_CODES:
 				self.post_editions.append (edition)
 		
-		# Decode the DMOS input as Python objects
-		print ("\t*** Decode the OMR input\n")
+		# Decode the DMOS input as Python objects, one page at a time. The
+		# JSON of a page is not kept: the manifest of the score is produced
+		# and editions that correct the DMOS raw output are applied on the way
+		print ("\t*** Decode the OMR input and compute the score manifest\n")
+		replacements, removals = self.get_replacements(editions)
+		self.manifest = Manifest(self.id, self.uri)
 		self.pages = []
-		no_page = 1
-		for json_page in self.json_data["pages"]:
-			json_page["no_page"] = no_page # Bug in DMOS
-			page = Page(json_page)							
+		no_measure = 1
+		for page in self.decode_pages(json_data, jobs):
 			self.pages.append(page)
-			no_page += 1
-			
-		# Produce the manifest of the score
-		print ("\t*** Compute the score manifest\n")
-		self.manifest = self.create_manifest()
+			# Number the measures in the score
+			for system in page.systems:
+				for measure in system.measures:
+					measure.no_measure_in_score = no_measure
+					no_measure += 1
+			self.add_to_manifest(self.manifest, page)
+			self.apply_replacements(page, replacements, removals)
+		# Now we create the groups to detect parts that extend over several staves
+		self.manifest.create_groups()
 
-		# Apply editions to correct the DMOS raw output and the manifest
+		# Apply editions to correct the manifest
 		print ("\t*** Apply pre-editions\n")
-		self.apply_pre_editions(editions)
+		for edition in editions:
+			if edition.name in Edition.PRE_EDITION_CODES:
+				edition.apply_to(self)
 				
 		# Now the JSON is decoded and we assume that the structure
 		# of the score, encoded in the manifest, is correct.
@@ -406,75 +536,100 @@ class OmrScore:
 
 		print ("\n\t*** Initialization done. Ready to produce the score\n")
 
-	def create_manifest(self):
+	def decode_pages(self, json_data, jobs=1):
 		"""
-		  The Manifest is a description of the source structure
-		  in pages / systems / measures and staves
+		  The pages of the input, decoded in order. The pages of a
+		  DmosReader are validated and decoded by a pool of processes:
+		  the reader only splits the input in pages. Signatures, clefs
+		  and lyrics carried over pages are determined afterwards, in order.
 		"""
-		manifest = Manifest(self.id, self.uri)
-		for page in self.pages:
-			# Create the manifest from the source
-			src_page = source_mod.MnfPage(page.page_url, page.no_page, 0, 0,
+		if isinstance(json_data, dict):
+			json_pages = json_data["pages"]
+		elif (jobs < 2 or json_data.parser is None
+				or multiprocessing.current_process().daemon):
+			# Nothing to share: validation is the costly part of the decoding.
+			# Daemon processes (e.g., Celery workers) cannot have a pool
+			json_pages = json_data.read_pages()
+		else:
+			print (f"\t*** Decode the pages with {jobs} processes\n")
+			with multiprocessing.Pool(jobs, initializer=init_page_worker,
+								initargs=(json_data.parser,)) as pool:
+				results = pool.imap(decode_page, enumerate(json_data.read_pages(validate=False)))
+				for i_page, (page, errors) in enumerate(results):
+					json_data.add_errors(errors, i_page)
+					yield page
+			return
+
+		for i_page, json_page in enumerate(json_pages):
+			json_page["no_page"] = i_page + 1 # Bug in DMOS
+			yield Page(json_page)
+
+	def add_to_manifest(self, manifest, page):
+		# Create the manifest from the source
+		src_page = source_mod.MnfPage(page.page_url, page.no_page, 0, 0,
 										manifest)
-			for system in page.systems:
-				# URL not known at this point. Could be
-				src_system = source_mod.MnfSystem(system.no_system_in_page, 
-												None, 
-												src_page,
-												system.region.to_json())
-				src_page.add_system(src_system)
+		for system in page.systems:
+			# URL not known at this point. Could be
+			src_system = source_mod.MnfSystem(system.no_system_in_page, 
+											None, 
+											src_page,
+											system.region.to_json())
+			src_page.add_system(src_system)
+			
+			count_staff_per_part = {}
+			for header in system.headers:
+				src_staff = source_mod.MnfStaff(header.no_staff, src_system)
+				src_system.add_staff(src_staff)
+				if manifest.part_exists (header.id_part):
+					# This part has already been met
+					src_part = manifest.get_part (header.id_part)
+				else:
+					# It is a new part 
+					src_part = source_mod.MnfPart(header.id_part, header.id_part, header.id_part) 
+					manifest.add_part(src_part)
 				
-				count_staff_per_part = {}
-				for header in system.headers:
-					src_staff = source_mod.MnfStaff(header.no_staff, src_system)
-					src_system.add_staff(src_staff)
-					if manifest.part_exists (header.id_part):
-						# This part has already been met
-						src_part = manifest.get_part (header.id_part)
-					else:
-						# It is a new part 
-						src_part = source_mod.MnfPart(header.id_part, header.id_part, header.id_part) 
-						manifest.add_part(src_part)
+				# Did we get the name of the part ?
+				if header.part_name is not None and header.part_name != "":
+					src_part.name = header.part_name
 					
-					# Did we get the name of the part ?
-					if header.part_name is not None and header.part_name != "":
-						src_part.name = header.part_name
-						
-					# Count the number of staves for the part
-					if header.id_part in count_staff_per_part.keys():
-						count_staff_per_part[header.id_part] += 1
-					else:
-						count_staff_per_part[header.id_part] = 1
-						
-					src_staff.add_part(header.id_part)
+				# Count the number of staves for the part
+				if header.id_part in count_staff_per_part.keys():
+					count_staff_per_part[header.id_part] += 1
+				else:
+					count_staff_per_part[header.id_part] = 1
 					
-				for measure in system.measures:
-					src_measure = source_mod.MnfMeasure(measure.no_measure_in_score, 
-													  measure.no_measure_in_system,
-													  None, # IIIF url not known. Could be
-													  "", # So far we do not know the MEI id
-													  src_system,
-														measure.region.to_json())
-					src_system.add_measure(src_measure)
-			manifest.add_page(src_page)
-		
-		# Now we create the groups to detect parts that extend over several staves
-		manifest.create_groups()
-		
-		# Clean pages URL and find the first page of music
-		# A QUOI CA SERT??
-		#manifest.clean_pages_url()
-		
-		#
-		# A QUOI CA SERT ???
-		#manifest.get_first_music_page()
-		return manifest
+				src_staff.add_part(header.id_part)
+				
+			for measure in system.measures:
+				src_measure = source_mod.MnfMeasure(measure.no_measure_in_score, 
+												  measure.no_measure_in_system,
+												  None, # IIIF url not known. Could be
+												  "", # So far we do not know the MEI id
+												  src_system,
+													measure.region.to_json())
+				src_system.add_measure(src_measure)
+		manifest.add_page(src_page)
 		
 	def apply_pre_editions(self, editions):
 		"""
 		  Most of the editions are applied to the DMOS input, before
 		  producing the score
 		"""
+		replacements, removals = self.get_replacements(editions)
+		for edition in editions:
+			if edition.name in Edition.PRE_EDITION_CODES:
+				# Pre editions  concern pages  and staff layout are applied the manifest
+				edition.apply_to(self)
+
+		# Finally we scan the structure decoded from DMOS, and apply editions
+		for page in self.pages:
+			self.apply_replacements(page, replacements, removals)
+
+	def get_replacements(self, editions):
+		"""
+		  Editions that apply to the objects decoded from DMOS, indexed
+		  by the id of the objects
+		"""
 		# Create a double dictionary indexed on the edition target + element id, referring
 		# to the editions that must be applied at run time
 		replacements = {Edition.REPLACE_CLEF: {}, 
@@ -501,80 +656,78 @@ class OmrScore:
 						edition.target = id
 						logger.warning (f"Add edition {edition} for object {id}")
 						replacements[edition.name][id] = edition.params
-			elif edition.name in Edition.PRE_EDITION_CODES:
-				# Pre editions  concern pages  and staff layout are applied the manifest
-				edition.apply_to(self)
-		
-		# Finally we scan the structure decoded from DMOS, and apply editions
-		for page in self.pages:
-			#print (f"Apply editions to page {page}")
-			for system in page.systems:
-				#print (f"\tApply editions to system {system}")
-				for measure in system.measures: 
-					#print (f"\t\tApply editions to measure {measure}")
-					for header in measure.headers:
-						if header.clef is not None:
-							if header.clef.id in replacements[Edition.REPLACE_CLEF].keys():
-								replacement = replacements[Edition.REPLACE_CLEF][header.clef.id]
-								header.clef.overwrite (replacement)
-								logger.info (f"Clef {header.clef.id} has been replaced")
-							if header.clef.id in removals:
-								logger.info (f"Clef {header.clef.id} has been removed")
-								header.clef = None
-
-						if header.time_signature is not None:
-							if header.time_signature.id in replacements[Edition.REPLACE_TIMESIGN].keys():
-								replacement = replacements[Edition.REPLACE_TIMESIGN][header.time_signature.id]
-								header.time_signature.overwrite (replacement)
-							if header.time_signature.id in removals:
-								logger.info (f"Time signature {header.time_signature.id} has been removed")			
-								header.time_signature = None
-								
-						if header.key_signature is not None:
-							if header.key_signature.id in replacements[Edition.REPLACE_KEYSIGN].keys():
-								replacement = replacements[Edition.REPLACE_KEYSIGN][header.key_signature.id]
-								header.key_signature.overwrite (replacement)
-							if  header.key_signature.id in removals:
-								logger.info (f"Key signature {header.key_signature.id} has been removed")
-								header.key_signature = None
-
-					for voice  in measure.voices: 
-						for item in voice.items: 
-							if item.note_attr is not None or item.rest_attr is not None:
-								if item.note_attr is not None:
-									heads = item.note_attr.heads
-								else:
-									heads = item.rest_attr.heads
-								for head in heads:
-									if head.id in replacements[Edition.REPLACE_MUSIC_ELEMENT].keys():
-										head.overwrite (replacements[Edition.REPLACE_MUSIC_ELEMENT][head.id])
-										item.duration.overwrite (replacements[Edition.REPLACE_MUSIC_ELEMENT][head.id])
-										if "switch" in replacements[Edition.REPLACE_MUSIC_ELEMENT][head.id]:
-											if item.note_attr is not None:
-												#print (f"Note {head.id} becomes a rest")
-												# A note becomes a rest
-												item.rest_attr = item.note_attr
-												item.note_attr = None
-											else:
-												#print (f"Rest {head.id} becomes a note")
-												# A rest becomes a note. We give an impossible height, that
-												# will be adjusted based on the Clef (not known yet)
-												head.height = 999
-												item.note_attr = item.rest_attr
-												item.rest_attr = None
-												
-									if head.id in removals:
-										logger.info (f"Note head {head.id}  is removed")
-										heads.remove(head)
-							if item.clef_attr is not None:
-								#This is a clef change 
-								if item.clef_attr.id in replacements[Edition.REPLACE_CLEF].keys():
-									logger.info (f"Voice clef {item.clef_attr.id} has been replaced")
-									replace = replacements[Edition.REPLACE_CLEF][item.clef_attr.id]
-									item.clef_attr.overwrite (replace)
-								if item.clef_attr.id in removals:
-									logger.info (f"Voice clef {item.clef_attr.id} has been removed")
-									voice.items.remove(item)
+		return replacements, removals
+
+	def apply_replacements(self, page, replacements, removals):
+		# Apply editions to the objects of a page
+		#print (f"Apply editions to page {page}")
+		for system in page.systems:
+			#print (f"\tApply editions to system {system}")
+			for measure in system.measures: 
+				#print (f"\t\tApply editions to measure {measure}")
+				for header in measure.headers:
+					if header.clef is not None:
+						if header.clef.id in replacements[Edition.REPLACE_CLEF].keys():
+							replacement = replacements[Edition.REPLACE_CLEF][header.clef.id]
+							header.clef.overwrite (replacement)
+							logger.info (f"Clef {header.clef.id} has been replaced")
+						if header.clef.id in removals:
+							logger.info (f"Clef {header.clef.id} has been removed")
+							header.clef = None
+
+					if header.time_signature is not None:
+						if header.time_signature.id in replacements[Edition.REPLACE_TIMESIGN].keys():
+							replacement = replacements[Edition.REPLACE_TIMESIGN][header.time_signature.id]
+							header.time_signature.overwrite (replacement)
+						if header.time_signature.id in removals:
+							logger.info (f"Time signature {header.time_signature.id} has been removed")			
+							header.time_signature = None
+							
+					if header.key_signature is not None:
+						if header.key_signature.id in replacements[Edition.REPLACE_KEYSIGN].keys():
+							replacement = replacements[Edition.REPLACE_KEYSIGN][header.key_signature.id]
+							header.key_signature.overwrite (replacement)
+						if  header.key_signature.id in removals:
+							logger.info (f"Key signature {header.key_signature.id} has been removed")
+							header.key_signature = None
+
+				for voice  in measure.voices: 
+					for item in voice.items: 
+						if item.note_attr is not None or item.rest_attr is not None:
+							if item.note_attr is not None:
+								heads = item.note_attr.heads
+							else:
+								heads = item.rest_attr.heads
+							for head in heads:
+								if head.id in replacements[Edition.REPLACE_MUSIC_ELEMENT].keys():
+									head.overwrite (replacements[Edition.REPLACE_MUSIC_ELEMENT][head.id])
+									item.duration.overwrite (replacements[Edition.REPLACE_MUSIC_ELEMENT][head.id])
+									if "switch" in replacements[Edition.REPLACE_MUSIC_ELEMENT][head.id]:
+										if item.note_attr is not None:
+											#print (f"Note {head.id} becomes a rest")
+											# A note becomes a rest
+											item.rest_attr = item.note_attr
+											item.note_attr = None
+										else:
+											#print (f"Rest {head.id} becomes a note")
+											# A rest becomes a note. We give an impossible height, that
+											# will be adjusted based on the Clef (not known yet)
+											head.height = 999
+											item.note_attr = item.rest_attr
+											item.rest_attr = None
+											
+								if head.id in removals:
+									logger.info (f"Note head {head.id}  is removed")
+									heads.remove(head)
+						if item.clef_attr is not None:
+							#This is a clef change 
+							if item.clef_attr.id in replacements[Edition.REPLACE_CLEF].keys():
+								logger.info (f"Voice clef {item.clef_attr.id} has been replaced")
+								replace = replacements[Edition.REPLACE_CLEF][item.clef_attr.id]
+								item.clef_attr.overwrite (replace)
+							if item.clef_attr.id in removals:
+								logger.info (f"Voice clef {item.clef_attr.id} has been removed")
+								voice.items.remove(item)
 	
 	def produce_annotations (self, score):
 		"""
@@ -706,11 +859,17 @@ class OmrScore:
 		logger.info (f"")
 		logger.info (f"== End of score structure creation. Scanning pages ===")
 
-		# Main scan: we fill the parts with measures
+		# Main scan: we fill the parts with measures. Measures
+		# out of the range are counted as well: measure numbers
+		# are those of the whole score
 		current_measure_no = 0
+		nb_produced_measures = 0
 		
 		for page in self.pages:
 			if not self.config.in_range (page.no_page):
+				for system in page.systems:
+					self.skip_measures(score, system, current_measure_no, nb_produced_measures)
+					current_measure_no += len(system.measures)
 				continue
 			
 			logger.info (f"")
@@ -720,7 +879,7 @@ class OmrScore:
 			mnf_page = self.manifest.get_page(page.no_page)
 			
 			#print (f"Processing page {page.no_page}")
-			if current_measure_no > 0:
+			if nb_produced_measures > 0:
 				# We are not on the first page
 				page_begins = True
 			else:
@@ -728,6 +887,8 @@ class OmrScore:
 			for system in page.systems:
 				system_begins = True
 				if not self.config.in_range (page.no_page, system.no_system_in_page):
+					self.skip_measures(score, system, current_measure_no, nb_produced_measures)
+					current_measure_no += len(system.measures)
 					continue
 
 				logger.info (f"")
@@ -744,10 +905,13 @@ class OmrScore:
 					current_measure_no += 1
 					if not self.config.in_range (page.no_page, system.no_system_in_page, measure.no_measure_in_system):
 						logger.info (f'Skipping measure {current_measure_no}')
+						if nb_produced_measures == 0:
+							self.skip_time_signature(score, current_measure_no)
 						continue
+					nb_produced_measures += 1
 				
 					logger.info (f"")
-					logger.info (f'***** Process measure {current_measure_no}, to be inserted at position {score.duration().quarterLength}')
+					logger.info (f'***** Process measure {current_measure_no}, to be inserted at position {score.get_duration()}')
 
 					# Accidentals are reset at the beginning of measures
 					score.reset_accidentals()
@@ -770,6 +934,10 @@ class OmrScore:
 							# for which we do no  find a signature on the staff. Cf marins de Kermor
 							#print (f"Changing time signature for part {part.id} at measure {current_measure_no}")
 							part.set_current_time_signature (self.ts_per_measure[current_measure_no])
+						elif nb_produced_measures == 1 and current_measure_no > 1:
+							# The range begins inside the score: the first measure
+							# gets the current time signature
+							part.set_current_time_signature (part.get_current_time_signature())
 						part.reset_voice_counter()
 
 						# Adding page and system breaks
@@ -979,6 +1147,36 @@ class OmrScore:
 		self.score = score 			
 		return self.score
 
+	def skip_measures(self, score, system, current_measure_no, nb_produced_measures):
+		# Measures of a system out of the range
+		if nb_produced_measures == 0:
+			for no_measure in range(current_measure_no + 1, current_measure_no + len(system.measures) + 1):
+				self.skip_time_signature(score, no_measure)
+
+	def skip_time_signature(self, score, no_measure):
+		# A time signature change in a measure before the range: it is
+		# the current one when the range begins (it is not repeated on systems)
+		if no_measure in self.ts_per_measure.keys():
+			for part in score.get_parts():
+				part.set_current_time_signature (self.ts_per_measure[no_measure])
+
+	def get_object_locations(self):
+		'''
+			Number of the measure (in the score) of each note head found in the input
+		'''
+		locations = {}
+		for page in self.pages:
+			for system in page.systems:
+				for measure in system.measures:
+					for voice in measure.voices:
+						for item in voice.items:
+							for attr in [item.note_attr, item.rest_attr]:
+								if attr is not None:
+									for head in attr.heads:
+										if head.id is not None:
+											locations[head.id] = measure.no_measure_in_score
+		return locations
+
 	def decode_event(self, mnf_system, voice, voice_item):
 		'''
 			Produce an event (from our score model) and its region by decoding the OMR input
@@ -1175,9 +1373,11 @@ class OmrScore:
 		print ("\nCreate the score from JSON input")
 		score = self.get_score()		
 		print (f"\nWriting as MusicXML in {out_file}")
-		score.write_as_musicxml (out_file)
-		print ("\nApplying post-editions to the MusicXML file\n")
-		Edition.apply_editions_to_file (self.post_editions, out_file)
+		# Post editions are applied to the document before writing it
+		mxml_doc = score.get_musicxml_doc()
+		print ("\nApplying post-editions to the MusicXML document\n")
+		Edition.apply_editions_to_doc (self.post_editions, mxml_doc)
+		mxml_doc.write (out_file)
 		print ("\nPost-editions on MusicXML done\n")
 
 	def write_as_mei(self, mxml_file, out_file):
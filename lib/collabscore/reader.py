@@ -0,0 +1,137 @@
+import io
+import json
+
+# import the logging library
+import logging
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+'''
+  Streaming decoding of DMOS files. A DMOS document is a JSON object
+  whose 'pages' array may be very large: pages are decoded one at a time,
+  and only the text of the current page is kept in memory.
+'''
+
+WHITESPACES = " \t\n\r"
+
+class DmosReader:
+	"""
+	  Read the pages of a DMOS file one at a time. Other properties of
+	  the document are put in 'metadata'.
+
+	  If a parser (CollabScoreParser) is given, each page is validated
+	  before being returned, until max_errors pages are found invalid.
+	  Pages validated elsewhere (e.g., by a pool of processes) report
+	  their errors with add_errors().
+	"""
+
+	# Size of the blocks read from the file
+	CHUNK_SIZE = 1 << 20
+
+	def __init__(self, dmos_file, parser=None, max_errors=1):
+		if isinstance(dmos_file.read(0), bytes):
+			dmos_file = io.TextIOWrapper(dmos_file, encoding="utf-8")
+		self.file = dmos_file
+		self.decoder = json.JSONDecoder()
+		self.buffer = ""
+		self.pos = 0
+		self.eof = False
+
+		self.metadata = {}
+		self.parser = parser
+		self.max_errors = max_errors
+		self.nb_invalid_pages = 0
+		self.error_messages = []
+
+	def read_pages(self, validate=True):
+		'''
+		  Generator of the pages of the document (JSON objects)
+		'''
+		self.expect("{")
+		if self.next_char() == "}":
+			self.pos += 1
+			return
+		while True:
+			key = self.decode_value()
+			self.expect(":")
+			if key == "pages":
+				i_page = 0
+				self.expect("[")
+				if self.next_char() == "]":
+					self.pos += 1
+				else:
+					while True:
+						json_page = self.decode_value()
+						if validate:
+							self.validate(json_page, i_page)
+						yield json_page
+						i_page += 1
+						if self.expect(",]") == "]":
+							break
+			else:
+				self.metadata[key] = self.decode_value()
+			if self.expect(",}") == "}":
+				break
+
+	def validation_stopped(self):
+		return self.max_errors is not None and self.nb_invalid_pages >= self.max_errors
+
+	def validate(self, json_page, i_page):
+		if self.parser is None or self.validation_stopped():
+			return
+		self.add_errors(self.parser.validate_page(json_page, i_page), i_page)
+
+	def add_errors(self, errors, i_page):
+		'''
+		  Record the validation errors of a page. Pages are given in order
+		'''
+		if len(errors) == 0 or self.validation_stopped():
+			return
+		self.error_messages += errors
+		self.nb_invalid_pages += 1
+		if self.nb_invalid_pages == self.max_errors:
+			logger.warning (f'Validation stopped at page {i_page + 1} after {self.nb_invalid_pages} invalid pages')
+
+	def read(self, size=None):
+		# Append a block to the buffer, and forget what has been decoded
+		chunk = self.file.read(size if size is not None else self.CHUNK_SIZE)
+		if chunk == "":
+			self.eof = True
+		self.buffer = self.buffer[self.pos:] + chunk
+		self.pos = 0
+
+	def next_char(self):
+		# The next character which is not a whitespace
+		while True:
+			while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACES:
+				self.pos += 1
+			if self.pos < len(self.buffer):
+				return self.buffer[self.pos]
+			if self.eof:
+				raise ValueError ("Unexpected end of the DMOS document")
+			self.read()
+
+	def expect(self, chars):
+		char = self.next_char()
+		if char not in chars:
+			raise ValueError (f"Invalid DMOS document: found '{char}' instead of '{chars}'")
+		self.pos += 1
+		return char
+
+	def decode_value(self):
+		self.next_char()
+		# The size of the blocks grows, so that a large value is not decoded too often
+		size = self.CHUNK_SIZE
+		while True:
+			try:
+				value, end = self.decoder.raw_decode(self.buffer, self.pos)
+				# A number at the end of the buffer might be incomplete
+				if end < len(self.buffer) or self.eof:
+					self.pos = end
+					return value
+			except json.JSONDecodeError:
+				if self.eof:
+					raise
+			self.read(size)
+			size *= 2
@@ -1,4 +1,5 @@
 
+import bisect
 import time
 import sys, os
 import socket
@@ -183,20 +184,28 @@ def create_combined_manifest (item, sync_source, audio_source,
 		else:
 			pages_measures[annot_image.body.source]["last_measure"] = no_measure
 
+	# Ranges sorted by first measure: the page of a measure, with or
+	# without an image annotation, is found by bisection
+	page_ranges = sorted((measure_range["first_measure"],
+					measure_range.get("last_measure", measure_range["first_measure"]), page_id)
+					for page_id, measure_range in pages_measures.items())
+	first_measures = [first_measure for first_measure, last_measure, page_id in page_ranges]
+
 	# Now we scan the audio annotations and aggregate the time ranges
 	for measure_ref, audio_annot in sorted_audio.items():
 		no_measure = int(measure_ref.replace ("m",""))
 		# extract time range
 		t_range = audio_annot.body.selector_value.replace("t=","").split(",")
 		# 	Find the page of the measure
-		for page_id, measure_range  in pages_measures.items():
-			if (no_measure >= measure_range["first_measure"] 
-			     and no_measure <= measure_range["last_measure"]):
-				#print (f"Measure {no_measure} is in page {page_id}")
-				if measure_range["start_at"] is None:
-					measure_range["start_at"] = t_range[0]
-				else:
-					measure_range["stop_at"] = t_range[1]
+		i_page = bisect.bisect_right(first_measures, no_measure) - 1
+		if i_page >= 0 and no_measure <= page_ranges[i_page][1]:
+			page_id = page_ranges[i_page][2]
+			measure_range = pages_measures[page_id]
+			#print (f"Measure {no_measure} is in page {page_id}")
+			if measure_range["start_at"] is None:
+				measure_range["start_at"] = t_range[0]
+			else:
+				measure_range["stop_at"] = t_range[1]
 				
 	#for page_id, measure_range  in pages_measures.items():
 	#	print (f"Page {page_id}. Range {measure_range}")
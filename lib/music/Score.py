@@ -7,7 +7,7 @@ from music21 import converter, stream
 
 import converter21
 converter21.register() 
-import verovio
+from .toolkits import toolkit_pool
 
 # This constant determines which converter is userd: VEROVIO or CONVERTER21
 CONVERTER_MEI="VEROVIO"
@@ -18,10 +18,14 @@ from .Voice import Voice
 from . import notation
 from . import events
 from .constants import ID_SEPARATOR
+from .mxmlwriter import MusicXMLWriter
 
 
 from fractions import Fraction
 
+import io
+from lxml import etree
+
 logging.basicConfig(level=logging.WARNING)
 logger = logging.getLogger(__name__)
 
@@ -104,6 +108,10 @@ class Score:
 	def duration(self):
 		# Music21 conventions
 		return self.m21_score.duration
+
+	def get_duration(self):
+		# Duration of the longest part, from the counters of the parts
+		return max([part.get_duration() for part in self.get_parts()], default=0)
 	
 	def get_parts(self):
 		'''
@@ -171,8 +179,19 @@ class Score:
 			part.reset_accidentals()
 
 	def write_as_musicxml(self, filename):
-			''' Produce the MusicXML encoding thanks to Music21'''
-			self.m21_score.write ("musicxml", filename)
+			''' Produce the MusicXML encoding'''
+			self.get_musicxml_doc().write(filename, xml_declaration=True, encoding="UTF-8")
+
+	def get_musicxml_doc(self):
+		'''
+		   The MusicXML encoding, as an lxml document, written from the
+		   parts of the score. A score loaded from a file has no parts:
+		   it is exported by Music21.
+		'''
+		if len(self.parts) == 0:
+			mxml_text = m21.musicxml.m21ToXml.GeneralObjectExporter(self.m21_score).parse()
+			return etree.parse(io.BytesIO(mxml_text))
+		return MusicXMLWriter(self).get_doc()
 	
 	def write_as_pickle(self, filename):
 		''' Produce a dump of the Music21 code'''
@@ -183,11 +202,11 @@ class Score:
 			''' Produce the MEI encoding from MusicXML thanks to Verovio'''
 			# Verovio converter. Works fine, and takes into account
 			# post editions on the MusicXML file
-			tk = verovio.toolkit()
-			tk.loadFile(mxml_file)
+			with open(mxml_file, "r") as f:
+				mxml_content = f.read()
 			print (f"Convert {mxml_file} to MEI and write in {mei_name}")
 			with open(mei_name, "w") as mei_file:
-				mei_file.write(tk.getMEI())
+				mei_file.write(toolkit_pool.to_mei(mxml_content))
 		else:
 			''' Produce the MEI encoding from MusicXML thanks to Converter21'''
 			self.m21_score.write ("mei", mei_name)
@@ -195,22 +214,15 @@ class Score:
 
 	def write_as_midi(self, filename):
 			''' Produce the MIDI encoding thanks to Verovio'''
-			tk = verovio.toolkit()
-			tmp_file = "/tmp/tmp.xml"
-			#print (f"Write in {tmp_file}")
-			self.m21_score.write ("musicxml", tmp_file)
-			#print (f"Load  {tmp_file}")
-			tk.loadFile(tmp_file)
-			tk.renderToMIDIFile(filename)
+			mxml_content = etree.tostring(self.get_musicxml_doc())
+			with open(filename, "wb") as midi_file:
+				midi_file.write(toolkit_pool.to_midi(mxml_content))
 
 	def write_as_svg(self, filename, page=1):
 			''' Produce the SVG encoding thanks to Verovio'''
-			tk = verovio.toolkit()
-			tmp_file = "/tmp/tmp.xml"
-			self.m21_score.write ("musicxml", tmp_file)
-			#print (f"Load  {tmp_file}")
-			tk.loadFile(tmp_file)
-			tk.renderToSVGFile(filename, page)
+			mxml_content = etree.tostring(self.get_musicxml_doc())
+			with open(filename, "w") as svg_file:
+				svg_file.write(toolkit_pool.to_svg(mxml_content, page))
 
 	def load_from_xml(self, xml_path, format):
 		"""
@@ -425,6 +437,11 @@ class Part:
 		self.m21_part.partName  = name
 		self.m21_part.partAbbreviation = abbreviation
 		self.part_type = part_type
+		self.name = name
+		self.abbreviation = abbreviation
+		# Set with the instrument
+		self.instrument_name = None
+		self.instrument_abbreviation = None
 
 		"""
 		   During parsing, we maintain the current interpretation 
@@ -505,6 +522,8 @@ class Part:
 		instr.partId = self.id
 		instr.instrumentName = instr_name
 		instr.instrumentAbbreviation = instr_abbrev
+		self.instrument_name = instr_name
+		self.instrument_abbreviation = instr_abbrev
 		
 		if self.part_type==Part.GROUP_PART:
 			self.staff_group[0].m21_part.insert(0, instr)
@@ -541,8 +560,13 @@ class Part:
 		if self.part_type == Part.GROUP_PART:
 			#WARNING: hope that both sub-part are at the same position
 			return self.staff_group[0].get_duration()
-		else:
+		elif self.current_measure is None:
+			# Not built measure by measure (e.g., loaded from a file)
 			return self.m21_part.duration.quarterLength
+		else:
+			# Measures are appended: the part ends with the current one. Same 
+			# value as the music21 duration, without scanning the part
+			return self.current_measure.absolute_position + self.current_measure.get_duration()
 	
 	def set_current_key_signature (self, key,no_staff=1):
 		if self.part_type == Part.GROUP_PART:
@@ -870,7 +894,7 @@ class Part:
 						logger.warning (f"Measure 1 in part {self.id} has no initial clef. Adding treble")
 						# Add a treble clef for safety
 						default_clef = notation.Clef(notation.Clef.TREBLE_CLEF)
-						measure.m21_measure.insert(0,  default_clef.m21_clef)
+						measure.set_initial_clef(default_clef, measure.absolute_position)
 					if not measure.has_own_initial_ks:
 						logger.warning (f"Measure 1 in part {self.id} has no initial key signature. ")
 					if not measure.has_own_initial_ts:
@@ -981,13 +1005,19 @@ class Measure:
 		# A measure may have an initial clef. The first measure MUST have an initial clef
 		# This is tested in check_measure_consistency()
 		self.initial_clef = None 
+		# All the clefs of the measure, with their relative position
+		self.clefs = []
 		
+		# Layout
+		self.new_system = False
+		self.new_page = False
 	
 	def set_initial_clef (self, clef, abs_position=0):
 		# We add the clef to music 21 measure. 
 		relative_position = abs_position - self.absolute_position 
 		logger.info (f"Adding Clef {clef.m21_clef} at relative position {relative_position} to the current measure of part {self.part.id}")
 		self.m21_measure.insert(relative_position,  clef.m21_clef)
+		self.clefs.append((relative_position, clef))
 		if relative_position == 0:
 			self.initial_clef = clef
 		
@@ -1024,10 +1054,12 @@ class Measure:
 	def add_system_break(self):
 		system_break = m21.layout.SystemLayout(isNew=True)
 		self.m21_measure.insert (system_break)
+		self.new_system = True
 
 	def add_page_break(self):
 		system_break = m21.layout.PageLayout(isNew=True)
 		self.m21_measure.insert (system_break)
+		self.new_page = True
 		#self.insert_initial_signatures()
 
 	def insert_initial_signatures(self):
@@ -1091,8 +1123,8 @@ class Measure:
 		self.add_voice (pseudo_voice)
 
 	def get_duration(self):
-		# Returns the measure duration based on it metric
-		return self.m21_measure.duration.quarterLength
+		# Returns the measure duration: that of its longest voice (voices start at 0)
+		return max([voice.get_duration() for voice in self.voices], default=0)
 			
 	def get_expected_duration(self):
 		# Returns the measure duration based on it metric
@@ -36,6 +36,9 @@ class Voice:
 		
 		# List of events
 		self.events = []
+		# Sum of the durations of the events, maintained when
+		# events are appended or removed
+		self.duration = 0
 		
 		# For decoding durations, the time signature is sometimes required
 		#self.current_time_signature = None
@@ -77,9 +80,22 @@ class Voice:
 			self.automatic_beaming = True
 
 		self.events.append(event)
+		self.duration += event.duration.get_value()
 		
 		self.m21_stream.append(event.m21_event)
 
+	def remove_event (self, event):
+		self.events.remove(event)
+		self.duration -= event.duration.get_value()
+		# Events are in sequence: the following ones are shifted
+		self.m21_stream.remove(event.m21_event, shiftOffsets=True)
+
+	def clear (self):
+		# Remove all the events
+		self.m21_stream.clear()
+		self.events = []
+		self.duration = 0
+
 	def has_only_rests (self):
 		#  Check if a voice only contains rests
 		only_rests = True
@@ -90,11 +106,8 @@ class Voice:
 
 	def remove_hidden_events(self):
 		# We rebuild the voice without hidden events
-		
-		self.m21_stream.clear()
-		
 		old_events = self.events
-		self.events = []
+		self.clear()
 
 		# OK, scan the old events
 		for event in old_events:
@@ -114,9 +127,8 @@ class Voice:
 			#self.remove_hidden_events()
 			
 			# Reinitialize the stream
-			self.m21_stream.clear()
 			old_events = self.events
-			self.events = []
+			self.clear()
 			last_event_inserted = None
 			list_removed_events = ""
 			for event in old_events:
@@ -244,11 +256,8 @@ class Voice:
 		return freq
 
 	def get_duration(self):
-		# Return the sumof durations of the voice
-		duration = 0
-		for event in self.events:
-			duration += event.duration.get_value()
-		return duration
+		# Return the sum of durations of the voice (kept up to date by append_event())
+		return self.duration
 
 	def get_ambitus(self):
 		i = self.m21_stream.analyze('ambitus')
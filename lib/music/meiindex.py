@@ -0,0 +1,260 @@
+# import the logging library
+import logging
+
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+'''
+  An index of the elements of a MEI document, stored in a sidecar file
+  next to the document.
+
+  The index maps each xml:id to the byte offset and length of the element,
+  its path from the root, and the measure and staff it belongs to. An
+  element is found, and its XML fragment read, without parsing the whole
+  document. The index is rebuilt when the document changes.
+'''
+
+# Bump if the layout of the index changes
+INDEX_FORMAT_VERSION = 1
+
+INDEX_SUFFIX = ".idx.json"
+
+# Comments, CDATA, processing instructions, doctype, end tags and start tags
+TOKEN_RE = re.compile(rb'<!--.*?-->|<!\[CDATA\[.*?\]\]>|<\?.*?\?>'
+					rb'|<!DOCTYPE[^\[>]*(?:\[.*?\])?\s*>'
+					rb'|</([^\s>]+)\s*>'
+					rb'|<([^\s/>!?]+)((?:[^>"\']|"[^"]*"|\'[^\']*\')*?)(/?)>', re.S)
+ATTR_RE = re.compile(rb'([^\s=]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+
+# Position of the fields in an entry of the index
+OFFSET, LENGTH, PATH, MEASURE, STAFF, SCOPE = range(6)
+
+
+class MeiIndex:
+	"""
+		The xml:id index of a MEI file
+	"""
+
+	def __init__(self, mei_path, index):
+		self.mei_path = mei_path
+		self.size = index["size"]
+		self.mtime_ns = index["mtime_ns"]
+		# Namespace declarations in scope, added to fragments
+		self.scopes = index["scopes"]
+		self.paths = index["paths"]
+		self.elements = index["elements"]
+
+	@staticmethod
+	def index_path(mei_path):
+		return mei_path + INDEX_SUFFIX
+
+	def is_valid(self):
+		# The index is obsolete once the document is replaced
+		try:
+			stat = os.stat(self.mei_path)
+		except FileNotFoundError:
+			return False
+		return stat.st_size == self.size and stat.st_mtime_ns == self.mtime_ns
+
+	@staticmethod
+	def load(mei_path):
+		"""
+		  Load the index of a MEI file, rebuilt if missing or obsolete
+		"""
+		try:
+			with open(MeiIndex.index_path(mei_path)) as f:
+				index = json.load(f)
+			if index.get("version") == INDEX_FORMAT_VERSION:
+				mei_index = MeiIndex(mei_path, index)
+				if mei_index.is_valid():
+					return mei_index
+		except (OSError, ValueError) as ex:
+			logger.info (f"No usable index for {mei_path}: {ex}")
+		return MeiIndex.build(mei_path)
+
+	@staticmethod
+	def build(mei_path):
+		"""
+		  Scan a MEI file, and write its index
+		"""
+		stat = os.stat(mei_path)
+		with open(mei_path, "rb") as f:
+			content = f.read()
+		index = MeiIndex.scan(content)
+		index["version"] = INDEX_FORMAT_VERSION
+		index["size"] = stat.st_size
+		index["mtime_ns"] = stat.st_mtime_ns
+
+		# Write then rename: concurrent readers never see a partial index
+		index_path = MeiIndex.index_path(mei_path)
+		tmp_path = f"{index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+		try:
+			with open(tmp_path, "w") as f:
+				json.dump(index, f, separators=(",", ":"))
+			os.replace(tmp_path, index_path)
+		except OSError as ex:
+			logger.warning (f"Unable to write the index of {mei_path}: {ex}")
+			if os.path.exists(tmp_path):
+				os.remove(tmp_path)
+		return MeiIndex(mei_path, index)
+
+	@staticmethod
+	def scan(content):
+		"""
+		  Index the elements of a document (bytes). Only the tags are
+		  decoded: the text is skipped
+		"""
+		paths = []
+		path_ids = {}
+		scopes = [{}]
+		elements = {}
+
+		# Open elements: (path, xml:id, offset, measure, staff, scope)
+		stack = []
+		for match in TOKEN_RE.finditer(content):
+			end_name, name, attrs, self_closing = match.groups()
+			if end_name is not None:
+				if len(stack) == 0:
+					raise ValueError (f"Unexpected end tag at offset {match.start()}")
+				path, xml_id, offset, measure, staff, scope = stack.pop()
+				if xml_id is not None:
+					elements[xml_id] = [offset, match.end() - offset, path_ids[path], measure, staff, scope]
+				continue
+			if name is None:
+				# Comment, CDATA, processing instruction
+				continue
+
+			local_name = name.split(b":")[-1].decode("utf-8")
+			if len(stack) > 0:
+				path, measure, staff, scope = stack[-1][0] + "/" + local_name, stack[-1][3], stack[-1][4], stack[-1][5]
+			else:
+				path, measure, staff, scope = "/" + local_name, None, None, 0
+			if path not in path_ids:
+				path_ids[path] = len(paths)
+				paths.append(path)
+
+			xml_id = None
+			if b"xml:id" in attrs or b"xmlns" in attrs or local_name in ("measure", "staff"):
+				attributes = {}
+				for attr in ATTR_RE.finditer(attrs):
+					value = attr.group(2) if attr.group(2) is not None else attr.group(3)
+					attributes[attr.group(1).decode("utf-8")] = value.decode("utf-8")
+				xml_id = attributes.get("xml:id")
+				if local_name == "measure":
+					measure = attributes.get("n", measure)
+				if local_name == "staff":
+					staff = attributes.get("n", staff)
+				elif "staff" in attributes:
+					# Control events refer to their staff
+					staff = attributes["staff"]
+				declarations = {key: value for key, value in attributes.items()
+							if key == "xmlns" or key.startswith("xmlns:")}
+				if len(declarations) > 0:
+					scopes.append({**scopes[scope], **declarations})
+					scope = len(scopes) - 1
+
+			if self_closing:
+				if xml_id is not None:
+					elements[xml_id] = [match.start(), match.end() - match.start(),
+									path_ids[path], measure, staff, scope]
+			else:
+				stack.append((path, xml_id, match.start(), measure, staff, scope))
+
+		if len(stack) > 0:
+			raise ValueError (f"Element {stack[-1][0]} is not closed")
+		return {"scopes": scopes, "paths": paths, "elements": elements}
+
+	def describe(self, xml_id, entry):
+		path = self.paths[entry[PATH]]
+		return {"id": xml_id,
+				"element": path.split("/")[-1],
+				"path": path,
+				"measure": entry[MEASURE],
+				"staff": entry[STAFF],
+				"offset": entry[OFFSET],
+				"length": entry[LENGTH]}
+
+	def lookup(self, xml_id):
+		"""
+		  Description of an element, or None if the id is unknown
+		"""
+		entry = self.elements.get(xml_id)
+		if entry is None:
+			return None
+		return self.describe(xml_id, entry)
+
+	def lookup_batch(self, xml_ids):
+		return {xml_id: self.lookup(xml_id) for xml_id in xml_ids}
+
+	def get_fragment(self, xml_id):
+		fragments = self.get_fragments([xml_id])
+		return fragments[xml_id]
+
+	def get_fragments(self, xml_ids):
+		"""
+		  XML fragments (bytes) of a list of elements, None for unknown ids.
+		  The fragments are read in the order of the document
+		"""
+		fragments = {xml_id: None for xml_id in xml_ids}
+		known = sorted((self.elements[xml_id][OFFSET], xml_id)
+					for xml_id in fragments if xml_id in self.elements)
+		if len(known) == 0:
+			return fragments
+		with open(self.mei_path, "rb") as f:
+			for offset, xml_id in known:
+				entry = self.elements[xml_id]
+				f.seek(offset)
+				fragments[xml_id] = self.add_namespaces(f.read(entry[LENGTH]), self.scopes[entry[SCOPE]])
+		return fragments
+
+	@staticmethod
+	def add_namespaces(fragment, namespaces):
+		# A fragment must declare the namespaces in scope in the document
+		tag_end = re.search(rb"[\s/>]", fragment).start()
+		start_tag = fragment[:fragment.find(b">")]
+		declarations = b""
+		for key, value in namespaces.items():
+			if key.encode("utf-8") + b"=" not in start_tag:
+				declarations += f' {key}="{value}"'.encode("utf-8")
+		return fragment[:tag_end] + declarations + fragment[tag_end:]
+
+
+class MeiIndexStore:
+	"""
+		The indexes recently used in the process
+	"""
+
+	def __init__(self, lru_size=32):
+		self.lru_size = lru_size
+		# Path -> MeiIndex, most recently used last
+		self.lru = OrderedDict()
+		self.lock = threading.Lock()
+
+	def get_index(self, mei_path):
+		with self.lock:
+			mei_index = self.lru.get(mei_path)
+			if mei_index is not None:
+				self.lru.move_to_end(mei_path)
+		if mei_index is None or not mei_index.is_valid():
+			mei_index = MeiIndex.load(mei_path)
+			with self.lock:
+				self.lru[mei_path] = mei_index
+				while len(self.lru) > self.lru_size:
+					self.lru.popitem(last=False)
+		return mei_index
+
+	def invalidate(self, mei_path):
+		with self.lock:
+			self.lru.pop(mei_path, None)
+		index_path = MeiIndex.index_path(mei_path)
+		if os.path.exists(index_path):
+			os.remove(index_path)
+
+
+# The indexes of the process
+mei_indexes = MeiIndexStore()
@@ -0,0 +1,962 @@
+# import the logging library
+import logging
+
+import math
+from datetime import date
+
+import music21 as m21
+import webcolors
+from lxml import etree
+
+logger = logging.getLogger(__name__)
+
+'''
+  A MusicXML writer driven by the score model: the document is built
+  directly as an lxml tree from the parts, measures, voices and events
+  of a Score, without copying the score and running the music21 exporter.
+
+  The encoding is the one produced by music21 for the same score (layout of
+  the measures, voices and staves, hidden rests that complete the voices,
+  tuplet brackets, ids), so that the post-editions and the incremental
+  rendering work the same on both.
+'''
+
+# Number of divisions per quarter note
+DIVISIONS = 10080
+
+MUSICXML_VERSION = "4.0"
+MUSICXML_DOCTYPE = ('<!DOCTYPE score-partwise PUBLIC "-//Recordare//DTD MusicXML 4.0 Partwise//EN" '
+					'"http://www.musicxml.org/dtds/partwise.dtd">')
+
+# Software mentioned in the encoding of the document
+SOFTWARE = "Collabscore MusicXML writer"
+
+# Note types without an equivalent in MusicXML
+MUSICXML_TYPES = {"longa": "long"}
+# Accidentals whose names differ in MusicXML
+MUSICXML_ACCIDENTALS = {"half-sharp": "quarter-sharp",
+						"one-and-a-half-sharp": "three-quarters-sharp",
+						"half-flat": "quarter-flat",
+						"one-and-a-half-flat": "three-quarters-flat",
+						"double-flat": "flat-flat"}
+BEAM_TYPES = {"start": "begin", "continue": "continue", "stop": "end"}
+BEAM_HOOKS = {"left": "backward hook", "right": "forward hook"}
+
+# Clefs are placed before the notes met at the same offset
+CLEF_ITEM = 0
+EVENT_ITEM = 1
+
+
+class MusicXMLWriter:
+	"""
+		Produce the MusicXML document of a score
+	"""
+
+	def __init__(self, score, divisions=DIVISIONS):
+		self.score = score
+		self.divisions = divisions
+		# MIDI channels assigned so far
+		self.midi_channels = []
+		# Time signature in effect on each staff, None before the first one
+		self.current_ts = {}
+		# Staves whose voices have tuplet brackets
+		self.voice_brackets = {}
+
+	def get_doc(self):
+		'''
+			The MusicXML document, as an lxml ElementTree
+		'''
+		root = etree.fromstring(f'{MUSICXML_DOCTYPE}<score-partwise version="{MUSICXML_VERSION}"/>')
+		self.add_header(root)
+		self.add_part_list(root)
+		for i_part, part in enumerate(self.score.parts):
+			root.append(divider(f"Part {i_part + 1}"))
+			root.append(self.get_part(part))
+		return root.getroottree()
+
+	def get_duration(self, quarter_length):
+		return int(round(self.divisions * quarter_length))
+
+	##########
+	## Header
+	##########
+
+	def add_header(self, root):
+		metadata = self.score.get_metadata()
+		title = self.score.get_title() or ""
+		work = etree.SubElement(root, "work")
+		etree.SubElement(work, "work-title").text = title
+		etree.SubElement(root, "movement-title").text = title
+
+		identification = etree.SubElement(root, "identification")
+		etree.SubElement(identification, "creator", type="composer").text = self.score.get_composer() or ""
+		if metadata is not None:
+			for copyright in metadata["copyright"]:
+				etree.SubElement(identification, "rights").text = str(copyright)
+		encoding = etree.SubElement(identification, "encoding")
+		etree.SubElement(encoding, "encoding-date").text = date.today().isoformat()
+		etree.SubElement(encoding, "software").text = SOFTWARE
+		if metadata is not None:
+			for software in metadata["software"]:
+				if not str(software).startswith("music21"):
+					etree.SubElement(encoding, "software").text = str(software)
+
+		defaults = etree.SubElement(root, "defaults")
+		scaling = etree.SubElement(defaults, "scaling")
+		etree.SubElement(scaling, "millimeters").text = "7"
+		etree.SubElement(scaling, "tenths").text = "40"
+
+	def add_part_list(self, root):
+		part_list = etree.SubElement(root, "part-list")
+		for part in self.score.parts:
+			score_part = etree.SubElement(part_list, "score-part", id=part.id)
+			etree.SubElement(score_part, "part-name").text = part.name
+			etree.SubElement(score_part, "part-abbreviation").text = part.abbreviation
+			if part.instrument_name is None and part.instrument_abbreviation is None:
+				continue
+			# One instrument per part
+			instrument_id = f"I{part.id}"
+			score_instrument = etree.SubElement(score_part, "score-instrument", id=instrument_id)
+			etree.SubElement(score_instrument, "instrument-name").text = str(part.instrument_name)
+			if part.instrument_abbreviation is not None:
+				etree.SubElement(score_instrument, "instrument-abbreviation").text = part.instrument_abbreviation
+			midi_instrument = etree.SubElement(score_part, "midi-instrument", id=instrument_id)
+			etree.SubElement(midi_instrument, "midi-channel").text = str(self.new_midi_channel() + 1)
+			# Piano
+			etree.SubElement(midi_instrument, "midi-program").text = "1"
+
+	def new_midi_channel(self):
+		# The lowest free channel, 9 (percussions) excepted
+		channel = 0
+		while channel in self.midi_channels or channel == 9:
+			channel += 1
+		self.midi_channels.append(channel)
+		return channel
+
+	##########
+	## Parts and measures
+	##########
+
+	def get_part(self, part):
+		'''
+		  A part is encoded with its staves: one for a single part, and
+		  one per part staff for a group, numbered in the notes
+		'''
+		mx_part = etree.Element("part", id=part.id)
+		if part.part_type == part.GROUP_PART:
+			staves = part.staff_group
+		else:
+			staves = [part]
+		multi_key = is_multi_attribute([staff_initial_ks(staff) for staff in staves], same_key)
+		multi_meter = is_multi_attribute([staff_initial_ts(staff) for staff in staves], same_time)
+		for staff in staves:
+			# As in music21, tuplets of measures with several voices only have
+			# brackets if no measure with a single voice has tuplets
+			self.voice_brackets[staff.id] = not has_single_voice_tuplets(staff)
+
+		for i_measure, measure in enumerate(staves[0].measures):
+			for staff in staves:
+				if staff.measures[i_measure].has_own_initial_ts:
+					self.current_ts[staff.id] = staff.measures[i_measure].initial_ts
+			mx_part.append(divider(f"Measure {measure.no}"))
+			mx_measure = etree.SubElement(mx_part, "measure", id=measure.id,
+										number=str(measure.no), implicit="no")
+			self.add_print(mx_measure, measure)
+			staff_measures = [staff.measures[i_measure] for staff in staves]
+			if len(staves) == 1:
+				attributes = self.get_attributes(measure, first=(i_measure == 0))
+				if len(attributes) > 0:
+					mx_measure.append(attributes)
+				self.add_staff_content(mx_measure, measure)
+			else:
+				self.add_staves(mx_measure, staff_measures, i_measure == 0, multi_key, multi_meter)
+		return mx_part
+
+	def add_print(self, mx_measure, measure):
+		if measure.new_page or measure.new_system:
+			mx_print = etree.SubElement(mx_measure, "print")
+			if measure.new_page:
+				mx_print.set("new-page", "yes")
+			if measure.new_system:
+				mx_print.set("new-system", "yes")
+
+	def get_attributes(self, measure, first=False, previous_measure=None):
+		'''
+		  Attributes at the beginning of a measure. The signatures of a staff
+		  are not repeated if the previous staff of the part has the same
+		'''
+		attributes = etree.Element("attributes")
+		if first:
+			etree.SubElement(attributes, "divisions").text = str(self.divisions)
+		if measure.has_own_initial_ks and not (previous_measure is not None
+						and previous_measure.has_own_initial_ks
+						and same_key(measure.initial_ks, previous_measure.initial_ks)):
+			attributes.append(key_element(measure.initial_ks))
+		if measure.has_own_initial_ts and not (previous_measure is not None
+						and previous_measure.has_own_initial_ts
+						and same_time(measure.initial_ts, previous_measure.initial_ts)):
+			attributes.append(time_element(measure.initial_ts))
+		initial_clef = measure_initial_clef(measure)
+		if initial_clef is not None:
+			attributes.append(clef_element(initial_clef))
+		return attributes
+
+	def add_staves(self, mx_measure, staff_measures, first, multi_key, multi_meter):
+		'''
+		  The staves of a group share the measure: each staff is written after
+		  the previous one, and numbered in notes, directions and clefs
+		'''
+		# Position in the measure, in divisions, after the staves written so far
+		position = 0
+		voice_numbers = []
+		for i_staff, measure in enumerate(staff_measures):
+			no_staff = i_staff + 1
+			previous_measure = staff_measures[i_staff - 1] if i_staff > 0 else None
+			attributes = self.get_attributes(measure, first, previous_measure)
+
+			if no_staff == 1:
+				if len(attributes) > 0:
+					mx_measure.append(attributes)
+				if first:
+					self.set_initial_staves(attributes, staff_measures, multi_key, multi_meter)
+			elif position != 0:
+				backup = etree.SubElement(mx_measure, "backup")
+				etree.SubElement(backup, "duration").text = str(position)
+				position = 0
+
+			if no_staff > 1 and not first and len(attributes) > 0:
+				for clef in attributes.findall("clef"):
+					clef.set("number", str(no_staff))
+				mx_measure.append(attributes)
+
+			staff_elements = self.get_staff_content(measure, no_staff)
+			if no_staff == 1:
+				voice_numbers = set_first_staff_voices(staff_elements)
+			else:
+				set_next_staff_voices(staff_elements, voice_numbers)
+				voice_numbers = voice_numbers + [int(el.text) for el in iter_voices(staff_elements)]
+			for element in staff_elements:
+				if element.tag == "note" and element.find("chord") is None:
+					position += int(element.findtext("duration"))
+				elif element.tag == "forward":
+					position += int(element.findtext("duration"))
+				elif element.tag == "backup":
+					position -= int(element.findtext("duration"))
+				mx_measure.append(element)
+
+	def set_initial_staves(self, attributes, staff_measures, multi_key, multi_meter):
+		'''
+		  The first attributes of a group give the number of staves, and
+		  the initial clef (and signatures, if they differ) of each staff
+		'''
+		clef1 = attributes.find("clef")
+		if clef1 is not None:
+			clef1.set("number", "1")
+		staves = etree.Element("staves")
+		staves.text = str(len(staff_measures))
+		insert_before(attributes, staves, ["clef"])
+		if multi_key and attributes.find("key") is not None:
+			attributes.find("key").set("number", "1")
+		if multi_meter and attributes.find("time") is not None:
+			attributes.find("time").set("number", "1")
+
+		staves_parts = [measure.part for measure in staff_measures]
+		for i_staff, staff in enumerate(staves_parts[1:], start=1):
+			no_staff = i_staff + 1
+			clef = staff_first_clef(staff)
+			if clef is not None:
+				# The initial clef is a copy, without its id
+				clef_el = clef_element(clef, with_id=False)
+				clef_el.set("number", str(no_staff))
+				if clef_el.find("line") is None:
+					etree.SubElement(clef_el, "line").text = ""
+					clef_el.insert(1, clef_el[-1])
+				attributes.append(clef_el)
+			if multi_meter:
+				ts = staff_first_written(staff, staves_parts[i_staff - 1], "ts")
+				if ts is not None:
+					time_el = time_element(ts)
+					time_el.set("number", str(no_staff))
+					insert_before(attributes, time_el, ["staves"])
+			if multi_key:
+				ks = staff_first_written(staff, staves_parts[i_staff - 1], "ks")
+				if ks is not None:
+					key_el = key_element(ks)
+					key_el.set("number", str(no_staff))
+					insert_before(attributes, key_el, ["time", "staves"])
+
+	##########
+	## Measure content
+	##########
+
+	def add_staff_content(self, mx_measure, measure):
+		for element in self.get_staff_content(measure):
+			mx_measure.append(element)
+
+	def get_staff_content(self, measure, no_staff=None):
+		'''
+		  The notes, clefs and directions of a measure on a staff. A single
+		  voice is written without voice number. Several voices are written
+		  one after the other, each one after a backup to the measure start
+		'''
+		elements = []
+		bar_duration = get_bar_duration(measure, self.current_ts.get(measure.part.id))
+		voices = get_voices(measure)
+		clefs = sorted([(m21.common.opFrac(position), clef) for position, clef in measure.clefs
+						if position > 0], key=lambda item: item[0])
+
+		if len(voices) <= 1:
+			if len(voices) == 0:
+				events = []
+			else:
+				events = voices[0].events
+			self.add_voice_content(elements, events, None, measure, bar_duration, clefs, no_staff, True)
+			return elements
+
+		# Clefs inside the measure come first, then the voices. Clefs
+		# beyond the end of the voices are preceded by hidden rests
+		voices_end = max([bar_duration] + [voice.get_duration() for voice in voices])
+		offset = 0
+		for position, clef in clefs:
+			if offset < voices_end and position > offset:
+				self.add_move(elements, "forward", min(position, voices_end) - offset, no_staff)
+				offset = min(position, voices_end)
+			if position > offset:
+				self.add_hidden_rest(elements, m21.duration.Duration(position - offset),
+									None, measure, no_staff)
+				offset = position
+			self.add_clef_change(elements, clef, no_staff)
+		if offset > 0:
+			self.add_move(elements, "backup", offset)
+		for i_voice, voice in enumerate(voices):
+			offset = self.add_voice_content(elements, voice.events, voice.id, measure, bar_duration,
+											[], no_staff, self.voice_brackets[measure.part.id])
+			if i_voice < len(voices) - 1 and offset > 0:
+				self.add_move(elements, "backup", offset)
+		return elements
+
+	def add_voice_content(self, elements, events, voice_id, measure, bar_duration, clefs, no_staff,
+						with_brackets):
+		'''
+		  Write a sequence of events, completed by hidden rests up to the bar
+		  duration, and the clefs met in the sequence. Returns the offset at
+		  the end of the sequence
+		'''
+		sequence = get_sequence(events, bar_duration)
+		if with_brackets:
+			brackets = tuplet_brackets([dur for _, _, dur in sequence])
+		else:
+			brackets = [None] * len(sequence)
+		items = [(item_offset, EVENT_ITEM, event, dur, bracket)
+					for (item_offset, event, dur), bracket in zip(sequence, brackets)]
+		offset = max(bar_duration, sum_durations(events))
+		for position, clef in clefs:
+			items.append((position, CLEF_ITEM, clef, None, None))
+		# Stable sort: clefs before the notes at the same offset
+		items.sort(key=lambda item: (item[0], item[1]))
+
+		cursor = 0
+		for item_offset, kind, obj, dur, bracket in items:
+			if kind == CLEF_ITEM:
+				if item_offset > cursor:
+					# Clef beyond the end of the voice
+					self.add_hidden_rest(elements, m21.duration.Duration(item_offset - cursor),
+										voice_id, measure, no_staff)
+					cursor = item_offset
+				self.add_clef_change(elements, obj, no_staff)
+				continue
+			if obj is None:
+				self.add_hidden_rest(elements, dur, voice_id, measure, no_staff)
+			else:
+				for decoration in obj.decorations:
+					elements.append(self.get_direction(decoration, no_staff))
+				elements.extend(self.get_event_elements(obj, voice_id, measure, bracket, no_staff))
+			cursor = m21.common.opFrac(item_offset + dur.quarterLength)
+		return max(cursor, offset)
+
+	def add_move(self, elements, tag, quarter_length, no_staff=None):
+		move = etree.Element(tag)
+		etree.SubElement(move, "duration").text = str(self.get_duration(quarter_length))
+		if no_staff is not None and tag == "forward":
+			etree.SubElement(move, "staff").text = str(no_staff)
+		elements.append(move)
+
+	def add_clef_change(self, elements, clef, no_staff):
+		attributes = etree.Element("attributes")
+		clef_el = clef_element(clef)
+		if no_staff is not None and no_staff > 1:
+			clef_el.set("number", str(no_staff))
+		attributes.append(clef_el)
+		elements.append(attributes)
+
+	def add_hidden_rest(self, elements, dur, voice_id, measure, no_staff):
+		full_measure = self.is_full_measure(measure, dur)
+		for piece in split_duration(dur):
+			note = etree.Element("note")
+			note.set("print-object", "no")
+			note.set("print-spacing", "yes")
+			rest = etree.SubElement(note, "rest")
+			etree.SubElement(note, "duration").text = str(self.get_duration(piece.quarterLength))
+			self.add_voice_and_type(note, voice_id, piece, full_measure, rest)
+			if no_staff is not None:
+				etree.SubElement(note, "staff").text = str(no_staff)
+			elements.append(note)
+
+	def is_full_measure(self, measure, dur):
+		# A rest that fills the bar of the time signature in effect
+		current_ts = self.current_ts.get(measure.part.id)
+		return current_ts is not None and dur.quarterLength == current_ts.barDuration().quarterLength
+
+	def add_voice_and_type(self, note, voice_id, piece, full_measure, rest=None):
+		if voice_id is not None:
+			etree.SubElement(note, "voice").text = str(voice_id)
+		if full_measure:
+			rest.set("measure", "yes")
+			return
+		etree.SubElement(note, "type").text = MUSICXML_TYPES.get(piece.type, piece.type)
+		for _ in range(piece.dots):
+			etree.SubElement(note, "dot")
+
+	def get_direction(self, decoration, no_staff):
+		'''
+		  A dynamics, placed before the event it is attached to
+		'''
+		dynamic = decoration.m21_object
+		direction = etree.Element("direction")
+		if dynamic.placement is not None:
+			direction.set("placement", dynamic.placement)
+		direction_type = etree.SubElement(direction, "direction-type")
+		dynamics = etree.SubElement(direction_type, "dynamics")
+		for attribute, value in (("default-x", dynamic.style.absoluteX), ("default-y", dynamic.style.absoluteY),
+								("relative-x", dynamic.style.relativeX), ("relative-y", dynamic.style.relativeY)):
+			if value is not None:
+				dynamics.set(attribute, str(m21.common.numToIntOrFloat(value)))
+		if dynamic.value in m21.musicxml.xmlObjects.DYNAMIC_MARKS:
+			etree.SubElement(dynamics, dynamic.value)
+		else:
+			etree.SubElement(dynamics, "other-dynamics").text = str(dynamic.value)
+		if no_staff is not None:
+			etree.SubElement(direction, "staff").text = str(no_staff)
+		if dynamic.volumeScalar is not None:
+			etree.SubElement(direction, "sound", dynamics=str(int(dynamic.volumeScalar * 127)))
+		return direction
+
+	##########
+	## Events
+	##########
+
+	def get_event_elements(self, event, voice_id, measure, bracket, no_staff):
+		'''
+		  The <note> elements of an event: one per note for a chord. An event
+		  whose duration has no single note type is split in tied notes
+		'''
+		dur = event.duration.m21_duration
+		full_measure = event.is_rest() and self.is_full_measure(measure, dur)
+		pieces = split_duration(dur)
+		elements = []
+		for i_piece, piece in enumerate(pieces):
+			first_piece = (i_piece == 0)
+			last_piece = (i_piece == len(pieces) - 1)
+			if event.is_chord():
+				notes = event.notes
+			else:
+				notes = [event]
+			for i_note, note in enumerate(notes):
+				tie = note.m21_event.tie if not event.is_rest() else None
+				if len(pieces) > 1:
+					tie = split_tie(tie, first_piece, last_piece)
+				elements.append(self.get_note(note, event, i_note, piece, tie, voice_id,
+											full_measure, bracket if first_piece else None,
+											first_piece, last_piece, no_staff))
+		return elements
+
+	def get_note(self, note, event, i_note, piece, tie, voice_id, full_measure, bracket,
+				first_piece, last_piece, no_staff):
+		'''
+		  A <note> element, for a note, a rest or a note of a chord (event)
+		'''
+		m21_note = note.m21_event
+		first_note = (i_note == 0)
+		mx_note = etree.Element("note")
+		color = get_color(m21_note)
+		if event is not note and get_color(event.m21_event) is not None:
+			color = get_color(event.m21_event)
+		if color is not None:
+			mx_note.set("color", color)
+		if first_piece and is_valid_id(note.id):
+			mx_note.set("id", note.id)
+		if not note.visible:
+			mx_note.set("print-object", "no")
+			mx_note.set("print-spacing", "yes")
+
+		if not first_note:
+			etree.SubElement(mx_note, "chord")
+		rest = None
+		if note.is_rest():
+			rest = etree.SubElement(mx_note, "rest")
+		else:
+			pitch = etree.SubElement(mx_note, "pitch")
+			etree.SubElement(pitch, "step").text = note.pitch_class
+			if note.alter is not None:
+				etree.SubElement(pitch, "alter").text = str(m21.common.numToIntOrFloat(
+														note.alter.m21_accidental.alter))
+			etree.SubElement(pitch, "octave").text = str(note.octave)
+		etree.SubElement(mx_note, "duration").text = str(self.get_duration(piece.quarterLength))
+		if tie is not None:
+			for tie_type in tie_types(tie.type):
+				etree.SubElement(mx_note, "tie", type=tie_type)
+		self.add_voice_and_type(mx_note, voice_id, piece, full_measure, rest)
+
+		if note.is_note() and first_piece:
+			accidental = note.alter.m21_accidental if note.alter is not None else None
+			if accidental is not None and accidental.displayStatus in (True, None):
+				etree.SubElement(mx_note, "accidental").text = MUSICXML_ACCIDENTALS.get(accidental.name,
+																					accidental.name)
+		if len(piece.tuplets) > 0:
+			mx_note.append(time_modification_element(piece.tuplets))
+		if not note.is_rest():
+			stem_direction = note.stem_direction
+			if first_note and event.m21_event.stemDirection != "unspecified":
+				stem_direction = event.m21_event.stemDirection
+			if stem_direction not in (None, "unspecified"):
+				etree.SubElement(mx_note, "stem").text = "none" if stem_direction == "noStem" else stem_direction
+			if color is not None:
+				etree.SubElement(mx_note, "notehead", color=color, parentheses="no").text = "normal"
+		if no_staff is not None:
+			etree.SubElement(mx_note, "staff").text = str(no_staff)
+		if first_note and not event.is_rest():
+			# Beams, including the pseudo-beams that disable automatic beaming
+			for beam in event.m21_event.beams:
+				etree.SubElement(mx_note, "beam", number=str(beam.number)).text = beam_type(beam)
+
+		# Marks of a split note go on its last part, those of a split chord on its first one
+		with_marks = first_piece if event.is_chord() else last_piece
+		notations = self.get_notations(event.m21_event, first_note, tie, with_marks,
+									bracket, piece.tuplets)
+		if len(notations) > 0:
+			etree.SubElement(mx_note, "notations").extend(notations)
+		if first_note and first_piece:
+			for lyric in event.m21_event.lyrics:
+				if lyric.text is not None:
+					mx_note.append(lyric_element(lyric))
+		return mx_note
+
+	def get_notations(self, m21_event, first_note, tie, with_marks, bracket, tuplets):
+		notations = []
+		ornaments = None
+		if with_marks:
+			for expression in m21_event.expressions:
+				if isinstance(expression, m21.expressions.ArpeggioMark):
+					notations.append(expression_element(expression))
+				elif first_note:
+					mx_expression = expression_element(expression)
+					if isinstance(expression, m21.expressions.Ornament):
+						if ornaments is None:
+							ornaments = etree.Element("ornaments")
+						ornaments.append(mx_expression)
+					else:
+						notations.append(mx_expression)
+		if tie is not None and tie.style != "hidden":
+			for tie_type in tie_types(tie.type):
+				notations.append(etree.Element("tied", type=tie_type))
+		if first_note and with_marks and len(m21_event.articulations) > 0:
+			articulations = etree.Element("articulations")
+			for articulation in m21_event.articulations:
+				articulations.append(articulation_element(articulation))
+			notations.append(articulations)
+		if ornaments is not None:
+			notations.append(ornaments)
+		if first_note and bracket is not None and len(tuplets) == 1:
+			notations.extend(tuplet_elements(tuplets[0], bracket))
+		return notations
+
+
+##########
+## Model helpers
+##########
+
+def measure_initial_clef(measure):
+	# The clef at the beginning of the measure
+	for position, clef in measure.clefs:
+		if position == 0:
+			return clef
+	return None
+
+def staff_first_clef(staff):
+	# The first clef met on a staff
+	for measure in staff.measures:
+		if measure_initial_clef(measure) is not None:
+			return measure_initial_clef(measure)
+		for position, clef in sorted(measure.clefs, key=lambda item: item[0]):
+			return clef
+	return None
+
+def staff_initial_ks(staff):
+	for measure in staff.measures:
+		if measure.has_own_initial_ks:
+			return measure.initial_ks
+	return None
+
+def staff_initial_ts(staff):
+	for measure in staff.measures:
+		if measure.has_own_initial_ts:
+			return measure.initial_ts
+	return None
+
+def staff_first_written(staff, previous_staff, kind):
+	'''
+	  The first key (kind "ks") or time (kind "ts") signature written
+	  on a staff, i.e., not identical to that of the previous staff
+	'''
+	for measure, previous_measure in zip(staff.measures, previous_staff.measures):
+		if kind == "ks":
+			if measure.has_own_initial_ks and not (previous_measure.has_own_initial_ks
+						and same_key(measure.initial_ks, previous_measure.initial_ks)):
+				return measure.initial_ks
+		else:
+			if measure.has_own_initial_ts and not (previous_measure.has_own_initial_ts
+						and same_time(measure.initial_ts, previous_measure.initial_ts)):
+				return measure.initial_ts
+	return None
+
+def same_key(ks, other):
+	return ks.m21_key_signature.sharps == other.m21_key_signature.sharps
+
+def same_time(ts, other):
+	return ts.numer == other.numer and ts.denom == other.denom
+
+def is_multi_attribute(signatures, same):
+	# True if the first signature of a staff differs from that of the first staff
+	initial = None
+	for signature in signatures:
+		if initial is None:
+			initial = signature
+		elif signature is not None and not same(signature, initial):
+			return True
+	return False
+
+
+def get_voices(measure):
+	# The voices of a measure, empty voices excepted
+	return [voice for voice in measure.voices if len(voice.events) > 0]
+
+def get_bar_duration(measure, current_ts):
+	'''
+	  The duration voices are completed to: that of the time signature
+	  in effect, or else that of the longest voice
+	'''
+	if current_ts is not None:
+		return current_ts.barDuration().quarterLength
+	return max([sum_durations(voice.events) for voice in measure.voices]
+				+ [m21.common.opFrac(position) for position, clef in measure.clefs], default=0)
+
+def sum_durations(events):
+	total = 0
+	for event in events:
+		total = m21.common.opFrac(total + event.duration.m21_duration.quarterLength)
+	return total
+
+def get_sequence(events, bar_duration):
+	'''
+	  The events of a voice with their offset and duration, followed by
+	  a hidden rest (None) that completes the voice up to the bar duration
+	'''
+	sequence = []
+	offset = 0
+	for event in events:
+		sequence.append((offset, event, event.duration.m21_duration))
+		offset = m21.common.opFrac(offset + event.duration.m21_duration.quarterLength)
+	if offset < bar_duration:
+		sequence.append((offset, None, m21.duration.Duration(m21.common.opFrac(bar_duration - offset))))
+	return sequence
+
+def has_single_voice_tuplets(staff):
+	# True if a measure of the staff with a single voice has tuplets
+	current_ts = None
+	for measure in staff.measures:
+		if measure.has_own_initial_ts:
+			current_ts = measure.initial_ts
+		voices = get_voices(measure)
+		if len(voices) > 1:
+			continue
+		events = voices[0].events if len(voices) == 1 else []
+		for _, _, dur in get_sequence(events, get_bar_duration(measure, current_ts)):
+			if len(dur.tuplets) > 0:
+				return True
+	return False
+
+
+##########
+## Voices of the staves of a group
+##########
+
+def iter_voices(elements):
+	for element in elements:
+		voice = element.find("voice")
+		if voice is not None:
+			yield voice
+
+def set_first_staff_voices(elements):
+	'''
+	  Notes of the first staff are in voice 1 when written without voice.
+	  Returns the voice numbers used
+	'''
+	numbers = [int(voice.text) for voice in iter_voices(elements)]
+	if len(numbers) > 0:
+		return numbers
+	for element in elements:
+		if element.tag == "note":
+			voice = etree.Element("voice")
+			voice.text = "1"
+			insert_before(element, voice, ["type", "dot", "accidental", "time-modification",
+										"stem", "notehead", "notehead-text", "staff"])
+	return []
+
+def set_next_staff_voices(elements, voice_numbers):
+	'''
+	  Voices of the next staves: numbered after those of the previous
+	  staves
+	'''
+	lacked_voices = (len(voice_numbers) == 0)
+	max_voice = max(voice_numbers, default=1)
+	for element in elements:
+		if element.tag != "note":
+			continue
+		voice = element.find("voice")
+		if voice is not None:
+			if lacked_voices:
+				voice.text = str(int(voice.text) + 1)
+		else:
+			voice = etree.Element("voice")
+			voice.text = str(max_voice + 1)
+			insert_before(element, voice, ["type", "dot", "accidental", "time-modification",
+										"stem", "notehead", "notehead-text", "staff"])
+
+
+##########
+## Durations and tuplets
+##########
+
+def split_duration(dur):
+	'''
+	  The parts of a duration, each with a note type. A complex duration
+	  (e.g., 5/4) gives several parts
+	'''
+	if dur.type != "complex":
+		return [dur]
+	return [m21.duration.Duration(type=component.type, dots=component.dots)
+			for component in dur.components]
+
+def split_tie(tie, first_piece, last_piece):
+	# The tie of a part of a split note
+	if first_piece:
+		tie_type = "continue" if tie is not None and tie.type in ("stop", "continue") else "start"
+	elif last_piece:
+		tie_type = "continue" if tie is not None and tie.type in ("start", "continue") else "stop"
+	else:
+		tie_type = "continue"
+	return m21.tie.Tie(tie_type)
+
+def beam_type(beam):
+	if beam.type == "partial":
+		return BEAM_HOOKS.get(beam.direction, "forward hook")
+	return BEAM_TYPES[beam.type]
+
+def tie_types(tie_type):
+	# A "continue" tie is a stop followed by a start
+	if tie_type == "continue":
+		return ["stop", "start"]
+	return [tie_type]
+
+def tuplet_brackets(durations):
+	'''
+	  The first and last tuplet of each group of tuplets in a sequence
+	  of durations are the start and stop of a bracket. Same algorithm
+	  as music21 makeTupletBrackets
+	'''
+	brackets = []
+	tuplets = [dur.tuplets[0] if len(dur.tuplets) == 1 else None for dur in durations]
+	completion_count = 0
+	completion_target = None
+	previous = None
+	for i_dur, (tuplet, dur) in enumerate(zip(tuplets, durations)):
+		following = tuplets[i_dur + 1] if i_dur < len(tuplets) - 1 else None
+		bracket = None
+		if tuplet is not None:
+			completion_count = m21.common.opFrac(completion_count + dur.quarterLength)
+			if previous is None or completion_target is None:
+				if following is None:
+					# A single tuplet
+					bracket = "startStop"
+					completion_count = 0
+				else:
+					bracket = "start"
+					completion_target = tuplet.totalTupletLength()
+			elif following is None or completion_count >= completion_target:
+				bracket = "stop"
+				completion_target = None
+				completion_count = 0
+		brackets.append(bracket)
+		previous = tuplet
+	return brackets
+
+def time_modification_element(tuplets):
+	if len(tuplets) == 1:
+		tuplet = tuplets[0]
+	else:
+		multiplier = m21.common.opFrac(1)
+		for tuplet in tuplets:
+			multiplier *= tuplet.tupletMultiplier()
+		fraction = m21.common.fractions.Fraction(multiplier).limit_denominator(1000)
+		tuplet = m21.duration.Tuplet(fraction.denominator, fraction.numerator)
+	time_modification = etree.Element("time-modification")
+	etree.SubElement(time_modification, "actual-notes").text = str(tuplet.numberNotesActual)
+	etree.SubElement(time_modification, "normal-notes").text = str(tuplet.numberNotesNormal)
+	if tuplet.durationNormal is not None:
+		etree.SubElement(time_modification, "normal-type").text = MUSICXML_TYPES.get(
+											tuplet.durationNormal.type, tuplet.durationNormal.type)
+		for _ in range(tuplet.durationNormal.dots):
+			etree.SubElement(time_modification, "normal-dot")
+	return time_modification
+
+def tuplet_elements(tuplet, bracket):
+	if bracket == "startStop":
+		types = ["start", "stop"]
+	else:
+		types = [bracket]
+	elements = []
+	for tuplet_type in types:
+		mx_tuplet = etree.Element("tuplet", type=tuplet_type, number="1")
+		if tuplet_type == "start":
+			with_bracket = tuplet.bracket not in (False, None) and bracket != "startStop"
+			mx_tuplet.set("bracket", "yes" if with_bracket else "no")
+			if tuplet.placement is not None:
+				mx_tuplet.set("placement", tuplet.placement)
+			for tag, number, dur in (("tuplet-actual", tuplet.numberNotesActual, tuplet.durationActual),
+									("tuplet-normal", tuplet.numberNotesNormal, tuplet.durationNormal)):
+				tuplet_part = etree.SubElement(mx_tuplet, tag)
+				etree.SubElement(tuplet_part, "tuplet-number").text = str(number)
+				if dur is not None:
+					etree.SubElement(tuplet_part, "tuplet-type").text = MUSICXML_TYPES.get(dur.type, dur.type)
+					for _ in range(dur.dots):
+						etree.SubElement(tuplet_part, "tuplet-dot")
+		elements.append(mx_tuplet)
+	return elements
+
+
+##########
+## Notation elements
+##########
+
+def key_element(key_signature):
+	key = etree.Element("key")
+	set_id(key, key_signature.m21_key_signature)
+	etree.SubElement(key, "fifths").text = str(key_signature.m21_key_signature.sharps)
+	return key
+
+def time_element(time_signature):
+	time = etree.Element("time")
+	set_id(time, time_signature.m21_time_signature)
+	symbol = time_signature.m21_time_signature.symbol
+	if symbol != "":
+		time.set("symbol", symbol)
+	etree.SubElement(time, "beats").text = str(time_signature.numer)
+	etree.SubElement(time, "beat-type").text = str(time_signature.denom)
+	return time
+
+def clef_element(clef, with_id=True):
+	m21_clef = clef.m21_clef
+	mx_clef = etree.Element("clef")
+	if with_id:
+		set_id(mx_clef, m21_clef)
+	etree.SubElement(mx_clef, "sign").text = m21_clef.sign if m21_clef.sign is not None else "G"
+	if m21_clef.line is not None:
+		etree.SubElement(mx_clef, "line").text = str(m21_clef.line)
+	if m21_clef.octaveChange not in (0, None):
+		etree.SubElement(mx_clef, "clef-octave-change").text = str(m21_clef.octaveChange)
+	return mx_clef
+
+def expression_element(expression):
+	if isinstance(expression, m21.expressions.ArpeggioMark):
+		if expression.type == "non-arpeggio":
+			mx_expression = etree.Element("non-arpeggiate")
+		else:
+			mx_expression = etree.Element("arpeggiate")
+			if expression.type != "normal":
+				mx_expression.set("direction", expression.type)
+	elif isinstance(expression, m21.expressions.Trill):
+		mx_expression = etree.Element("trill-mark")
+	elif isinstance(expression, m21.expressions.Fermata):
+		mx_expression = etree.Element("fermata")
+	else:
+		mx_expression = etree.Element("other-ornament")
+	if getattr(expression, "placement", None) is not None:
+		mx_expression.set("placement", expression.placement)
+	if isinstance(expression, m21.expressions.Fermata):
+		mx_expression.set("type", str(expression.type))
+		if expression.shape in ("angled", "square"):
+			mx_expression.text = expression.shape
+	return mx_expression
+
+def articulation_element(articulation):
+	name = "other-articulation"
+	for m21_class, mx_name in m21.musicxml.xmlObjects.ARTICULATION_MARKS_REV.items():
+		if isinstance(articulation, m21_class):
+			name = mx_name
+			break
+	mx_articulation = etree.Element(name)
+	if articulation.placement is not None:
+		mx_articulation.set("placement", articulation.placement)
+	if name == "strong-accent":
+		mx_articulation.set("type", articulation.pointDirection)
+	return mx_articulation
+
+def lyric_element(lyric):
+	mx_lyric = etree.Element("lyric")
+	if lyric.identifier is not None:
+		mx_lyric.set("name", str(lyric.identifier))
+	if lyric.number is not None:
+		mx_lyric.set("number", str(lyric.number))
+	if lyric.syllabic is not None:
+		etree.SubElement(mx_lyric, "syllabic").text = lyric.syllabic
+	etree.SubElement(mx_lyric, "text").text = lyric.text or ""
+	return mx_lyric
+
+
+##########
+## XML helpers
+##########
+
+def divider(text):
+	# A comment between parts and measures, as in music21 documents
+	low = math.floor((60 - min(len(text), 60)) / 2)
+	high = math.ceil((60 - min(len(text), 60)) / 2)
+	return etree.Comment("=" * low + " " + text + " " + "=" * high)
+
+def insert_before(element, child, tags):
+	# Insert a child before the first child with one of the tags, or at the end
+	for i_child, current in enumerate(element):
+		if current.tag in tags:
+			element.insert(i_child, child)
+			return
+	element.append(child)
+
+def get_color(m21_object):
+	if not m21_object.hasStyleInformation or not m21_object.style.color:
+		return None
+	color = m21_object.style.color
+	if color.startswith("#"):
+		return color.upper()
+	try:
+		return webcolors.name_to_hex(color).upper()
+	except ValueError:
+		return color
+
+def set_id(element, m21_object):
+	# The id of a signature or clef, as known in the Music21 objects: the
+	# ids of signatures merged in the model are kept synchronized there
+	if is_valid_id(m21_object.id):
+		element.set("id", m21_object.id)
+
+def is_valid_id(value):
+	return m21.musicxml.xmlObjects.isValidXSDID(value)
@@ -0,0 +1,184 @@
+# import the logging library
+import logging
+
+import base64
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+import verovio
+
+from .scorecache import file_digest
+from .toolkits import ToolkitPool
+
+logger = logging.getLogger(__name__)
+
+'''
+  A content-addressed store of the artifacts rendered from a score:
+  the SVG of each page, the MIDI file and the MEI fragment of each page.
+
+  The artifacts of a document are rendered together, with a given set
+  of Verovio options, in a directory named after the hash of the document
+  and of the options. An artifact never changes once written: its name
+  is a strong ETag.
+'''
+
+# Bump if the layout of the entries changes
+CACHE_FORMAT_VERSION = 1
+
+SVG_ARTIFACT = "svg"
+MIDI_ARTIFACT = "midi"
+MEI_ARTIFACT = "mei"
+
+class RenderCache:
+	"""
+		Disk store of rendered artifacts
+	"""
+
+	# Artifacts and their content types
+	CONTENT_TYPES = {SVG_ARTIFACT: "image/svg+xml",
+				MIDI_ARTIFACT: "audio/midi",
+				MEI_ARTIFACT: "application/xml"}
+
+	# Options that can be given with a request, and their allowed values.
+	# Each value is a distinct rendering: the set is kept small
+	QUERY_OPTIONS = {"scale": (20, 25, 35, 50, 75, 100),
+				"pageWidth": (1000, 1500, 2100, 2500, 3000),
+				"pageHeight": (1000, 1500, 2970, 4000, 60000)}
+
+	def __init__(self, cache_dir, options={}):
+		self.cache_dir = cache_dir
+		# Default rendering options
+		self.options = options
+
+		# Path -> (mtime, size, digest): avoids hashing unchanged files
+		self.digests = {}
+		# Toolkits shared by all renderings: the options are set before each one
+		self.pool = ToolkitPool()
+		self.lock = threading.Lock()
+
+		tk = verovio.toolkit()
+		self.renderer_version = f"{tk.getVersion()}-{CACHE_FORMAT_VERSION}"
+		# Options of a request left to their default are reset on a reused toolkit
+		default_options = tk.getDefaultOptions()
+		self.query_defaults = {option: default_options[option] for option in RenderCache.QUERY_OPTIONS}
+
+	def get_digest(self, file_path):
+		"""
+		  Return the digest of a file, recomputed only if the file changed
+		"""
+		stat = os.stat(file_path)
+		with self.lock:
+			known = self.digests.get(file_path)
+		if known is not None and known[0] == stat.st_mtime_ns and known[1] == stat.st_size:
+			return known[2]
+		digest = file_digest(file_path)
+		with self.lock:
+			self.digests[file_path] = (stat.st_mtime_ns, stat.st_size, digest)
+		return digest
+
+	@staticmethod
+	def parse_options(query):
+		"""
+		  Rendering options given with a request, set to the nearest
+		  allowed value. Raises ValueError if a value is not a number
+		"""
+		options = {}
+		for option, allowed in RenderCache.QUERY_OPTIONS.items():
+			if option in query:
+				value = int(query[option])
+				options[option] = min(allowed, key=lambda allowed_value: abs(allowed_value - value))
+		return options
+
+	def get_options(self, options=None):
+		render_options = {**self.query_defaults, **self.options}
+		if options is not None:
+			render_options.update(options)
+		return render_options
+
+	def make_variant(self, options):
+		# The options and the renderer determine the artifacts of a document
+		variant_str = f"{json.dumps(options, sort_keys=True)}:{self.renderer_version}"
+		return hashlib.sha256(variant_str.encode("utf-8")).hexdigest()[:16]
+
+	def entry_path(self, digest, variant):
+		return os.path.join(self.cache_dir, digest[:2], digest, variant)
+
+	@staticmethod
+	def artifact_name(artifact, page=1):
+		if artifact == MIDI_ARTIFACT:
+			return "score.midi"
+		elif artifact == SVG_ARTIFACT:
+			return f"page-{page}.svg"
+		elif artifact == MEI_ARTIFACT:
+			return f"page-{page}.mei"
+		raise ValueError (f"Unknown artifact {artifact}")
+
+	def get_artifact(self, file_path, artifact, page=1, options=None):
+		"""
+		  Path and ETag of an artifact, rendered if necessary. None
+		  if the page does not exist
+		"""
+		entry = self.render(file_path, options)
+		path = os.path.join(entry, RenderCache.artifact_name(artifact, page))
+		if not os.path.exists(path):
+			return None
+		digest, variant = entry.split(os.sep)[-2:]
+		return path, f'"{digest[:16]}-{variant}-{os.path.basename(path)}"'
+
+	def get_nb_pages(self, file_path, options=None):
+		with open(os.path.join(self.render(file_path, options), "pages.json")) as f:
+			return json.load(f)["nb_pages"]
+
+	def render(self, file_path, options=None):
+		"""
+		  Render the artifacts of a document, if not already done. Returns
+		  the directory of the artifacts
+		"""
+		options = self.get_options(options)
+		entry = self.entry_path(self.get_digest(file_path), self.make_variant(options))
+		if not os.path.exists(entry):
+			self.render_entry(file_path, entry, options)
+		return entry
+
+	def render_entry(self, file_path, entry, options):
+		with open(file_path, "rb") as f:
+			content = f.read()
+		# Render in a temp dir, then rename: concurrent readers never see a partial entry
+		tmp_entry = f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp"
+		os.makedirs(tmp_entry, exist_ok=True)
+		try:
+			with self.pool.toolkit() as tk:
+				tk.setOptions(options)
+				ToolkitPool.load(tk, content)
+				nb_pages = tk.getPageCount()
+				for page in range(1, nb_pages + 1):
+					with open(os.path.join(tmp_entry, RenderCache.artifact_name(SVG_ARTIFACT, page)), "w") as f:
+						f.write(tk.renderToSVG(page))
+					with open(os.path.join(tmp_entry, RenderCache.artifact_name(MEI_ARTIFACT, page)), "w") as f:
+						f.write(tk.getMEI({"pageNo": page}))
+				with open(os.path.join(tmp_entry, RenderCache.artifact_name(MIDI_ARTIFACT)), "wb") as f:
+					f.write(base64.b64decode(tk.renderToMIDI()))
+			with open(os.path.join(tmp_entry, "pages.json"), "w") as f:
+				json.dump({"nb_pages": nb_pages}, f)
+			try:
+				os.rename(tmp_entry, entry)
+			except OSError:
+				# Rendered by another process in the meantime
+				if not os.path.exists(entry):
+					raise
+		finally:
+			shutil.rmtree(tmp_entry, ignore_errors=True)
+
+	def invalidate(self, file_path):
+		"""
+		  Remove the artifacts of a file (called when it is replaced)
+		"""
+		if not os.path.exists(file_path):
+			return
+		digest = self.get_digest(file_path)
+		with self.lock:
+			self.digests.pop(file_path, None)
+		shutil.rmtree(os.path.join(self.cache_dir, digest[:2], digest), ignore_errors=True)
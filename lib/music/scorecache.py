@@ -0,0 +1,183 @@
+# import the logging library
+import logging
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from importlib.metadata import version
+
+import music21 as m21
+from music21 import freezeThaw
+
+import lib.music.Score as score_mod
+
+logger = logging.getLogger(__name__)
+
+'''
+  A content-addressed cache of parsed scores.
+
+  Parsing a MEI or MusicXML document with music21 takes seconds for large
+  scores. The cache keeps, on disk, a frozen (pickled) version of the music21
+  stream obtained from a document. The key of an entry is the hash of the
+  document content, combined with the versions of music21 and converter21
+  (the pickle is not portable across versions). A small in-process LRU
+  keeps the most recently used Score objects.
+'''
+
+# Bump if the layout of cached entries changes
+CACHE_FORMAT_VERSION = 1
+
+# Size of the chunks read when hashing a file
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(file_path):
+	"""
+	  SHA-256 digest of a file content
+	"""
+	h = hashlib.sha256()
+	with open(file_path, "rb") as f:
+		for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+			h.update(chunk)
+	return h.hexdigest()
+
+
+class ScoreCache:
+	"""
+		Two-level cache (memory LRU + disk) of Score objects
+	"""
+
+	def __init__(self, cache_dir, lru_size=16, enabled=True):
+		self.cache_dir = cache_dir
+		self.lru_size = lru_size
+		self.enabled = enabled
+
+		# Key -> Score, most recently used last
+		self.lru = OrderedDict()
+		# Path -> (mtime, size, digest): avoids hashing unchanged files
+		self.digests = {}
+		self.lock = threading.Lock()
+
+		# Versions of the converters: part of the key
+		self.converter_version = "%s-%s-%s" % (m21.VERSION_STR,
+				version("converter21"), CACHE_FORMAT_VERSION)
+
+	def get_digest(self, xml_path):
+		"""
+		  Return the digest of a file, recomputed only if the file changed
+		"""
+		stat = os.stat(xml_path)
+		with self.lock:
+			known = self.digests.get(xml_path)
+		if known is not None and known[0] == stat.st_mtime_ns and known[1] == stat.st_size:
+			return known[2]
+		digest = file_digest(xml_path)
+		with self.lock:
+			self.digests[xml_path] = (stat.st_mtime_ns, stat.st_size, digest)
+		return digest
+
+	def make_key(self, digest, format):
+		key_str = f"{digest}:{format}:{self.converter_version}"
+		return hashlib.sha256(key_str.encode("utf-8")).hexdigest()
+
+	def entry_path(self, key):
+		return os.path.join(self.cache_dir, key[:2], key + ".p")
+
+	def get_score(self, xml_path, format):
+		"""
+		  Get the Score of a MEI or MusicXML document, from the
+		  cache if possible
+		"""
+		if not self.enabled:
+			return ScoreCache.parse(xml_path, format)
+
+		key = self.make_key(self.get_digest(xml_path), format)
+
+		# Memory first
+		with self.lock:
+			if key in self.lru:
+				self.lru.move_to_end(key)
+				return self.lru[key]
+
+		# Then disk
+		score = self.load_entry(key)
+		if score is None:
+			# Cache miss: parse the document and store the result
+			score = ScoreCache.parse(xml_path, format)
+			if score.m21_score is not None:
+				self.store_entry(key, score)
+
+		if score.m21_score is not None:
+			self.remember(key, xml_path, score)
+		return score
+
+	def remember(self, key, xml_path, score):
+		# We note the path in order to invalidate entries by path
+		score.cache_path = xml_path
+		with self.lock:
+			self.lru[key] = score
+			self.lru.move_to_end(key)
+			while len(self.lru) > self.lru_size:
+				self.lru.popitem(last=False)
+
+	def load_entry(self, key):
+		entry = self.entry_path(key)
+		if not os.path.exists(entry):
+			return None
+		try:
+			with open(entry, "rb") as f:
+				thawer = freezeThaw.StreamThawer()
+				thawer.openStr(f.read())
+			score = score_mod.Score()
+			score.m21_score = thawer.stream
+			score.load_component(score.m21_score)
+			return score
+		except Exception as ex:
+			# A corrupted or incompatible entry: drop it
+			logger.warning (f"Unable to read cached score {entry}: {ex}")
+			self.remove_entry(key)
+			return None
+
+	def store_entry(self, key, score):
+		entry = self.entry_path(key)
+		try:
+			os.makedirs(os.path.dirname(entry), exist_ok=True)
+			freezer = freezeThaw.StreamFreezer(score.m21_score, fastButUnsafe=False)
+			data = freezer.writeStr(fmt="pickle")
+			# Write in a temp file, then rename: concurrent readers never see a partial entry
+			tmp_entry = f"{entry}.{os.getpid()}.tmp"
+			with open(tmp_entry, "wb") as f:
+				f.write(data)
+			os.replace(tmp_entry, entry)
+		except Exception as ex:
+			logger.warning (f"Unable to store score {key} in the cache: {ex}")
+
+	def remove_entry(self, key):
+		entry = self.entry_path(key)
+		if os.path.exists(entry):
+			os.remove(entry)
+
+	def invalidate(self, xml_path):
+		"""
+		  Forget everything we know about a file (called when it is replaced)
+		"""
+		with self.lock:
+			known = self.digests.pop(xml_path, None)
+			for key in [k for k, s in self.lru.items() if getattr(s, "cache_path", None) == xml_path]:
+				del self.lru[key]
+		if known is not None:
+			# The content is about to change: the disk entries are useless
+			for format in ("mei", "musicxml"):
+				self.remove_entry(self.make_key(known[2], format))
+
+	def clear(self):
+		with self.lock:
+			self.lru.clear()
+			self.digests.clear()
+
+	@staticmethod
+	def parse(xml_path, format):
+		score = score_mod.Score()
+		score.load_from_xml(xml_path, format)
+		return score
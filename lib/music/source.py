@@ -341,6 +341,9 @@ class Manifest:
 		self.url = url
 		# List of pages
 		self.pages = []
+		# Index of the pages by number. As with a scan
+		# of the list, the first one added wins
+		self.pages_by_number = {}
 		# List of parts. A dictionary because parts'id is unique
 		self.parts = {}
 		# Groups = parts with more than on staff
@@ -352,14 +355,13 @@ class Manifest:
 		
 	def add_page(self, page):
 		self.pages.append(page)
+		self.pages_by_number.setdefault(page.number, page)
 
 	def get_page(self, nb):
-		for page in self.pages:
-			if page.number == nb:
-				return page
-		
-		# Oups should never happpen
-		raise score_mod.CScoreModelError (f"Searching a non existing page : {nb}" )
+		if nb not in self.pages_by_number:
+			# Oups should never happpen
+			raise score_mod.CScoreModelError (f"Searching a non existing page : {nb}" )
+		return self.pages_by_number[nb]
 
 	def nb_pages_of_music(self):
 		return self.last_music_page - self.first_music_page  + 1
@@ -479,6 +481,8 @@ class Manifest:
 	def create_groups(self):
 		# Collect groups found in pages.
 		# Warning: in an extreme case we must manage group at the system level
+		# Groups are recomputed: parts may have been merged since the last call
+		self.groups = {}
 		for page in self.pages:
 			page.create_groups()
 			for id_part, staves in page.groups.items():
@@ -527,6 +531,7 @@ class MnfPage:
 		self.height = height
 		self.number = nb
 		self.systems  = []
+		self.systems_by_number = {}
 		self.groups = {}
 
 	def nb_systems(self):
@@ -540,14 +545,13 @@ class MnfPage:
 
 	def add_system(self, system):
 		self.systems.append(system)
+		self.systems_by_number.setdefault(system.number, system)
 		
 	def get_system(self, nb):
-		for system in self.systems:
-			if system.number == nb:
-				return system
-		
-		# Oups should never happpen
-		raise score_mod.CScoreModelError (f"Searching a non existing system {nb} in page {self.number}")
+		if nb not in self.systems_by_number:
+			# Oups should never happpen
+			raise score_mod.CScoreModelError (f"Searching a non existing system {nb} in page {self.number}")
+		return self.systems_by_number[nb]
 	
 	@staticmethod
 	def from_json (json_mnf, manifest):
@@ -571,6 +575,7 @@ class MnfPage:
 	def create_groups(self):
 		# Collect groups found in systems.
 		# Warning: in an extreme case we must manage group at the system level
+		self.groups = {}
 		for system in self.systems:
 			system.create_groups()
 			for id_part, staves in system.groups.items():
@@ -596,6 +601,9 @@ class MnfSystem:
 		self.number = number
 		self.staves  = []
 		self.measures  = []
+		# Indexes: staves by id, measures by number in the system
+		self.staves_by_id = {}
+		self.measures_by_number = {}
 		self.groups = {}
 		self.region = MnfRegion(region)
 
@@ -609,27 +617,26 @@ class MnfSystem:
 			
 	def add_staff(self, staff):
 		self.staves.append(staff)
+		self.staves_by_id.setdefault(staff.id, staff)
 		
 	def get_staff(self, id_staff):
-		for staff in self.staves:
-			if staff.id == id_staff:
-				return staff
-		
-		# Oups should never happpen
-		raise score_mod.CScoreModelError (f"Searching a non existing staff {id_staff} in system {self.number}")
+		if id_staff not in self.staves_by_id:
+			# Oups should never happpen
+			raise score_mod.CScoreModelError (f"Searching a non existing staff {id_staff} in system {self.number}")
+		return self.staves_by_id[id_staff]
 
 	def nb_measures(self):
 		return len(self.measures)
 
 	def add_measure(self, measure):
 		self.measures.append(measure)
+		self.measures_by_number.setdefault(measure.number_in_system, measure)
 		
 	def get_measure(self, no_measure):
-		for measure in self.measures:
-			if measure.number_in_system == no_measure:
-				return measure
-		# Oups should never happpen
-		raise score_mod.CScoreModelError (f"Searching the manifest for a non existing measure {no_measure} in system {self.number}")
+		if no_measure not in self.measures_by_number:
+			# Oups should never happpen
+			raise score_mod.CScoreModelError (f"Searching the manifest for a non existing measure {no_measure} in system {self.number}")
+		return self.measures_by_number[no_measure]
 
 	@staticmethod
 	def from_json (json_mnf, page):
@@ -662,6 +669,7 @@ class MnfSystem:
 
 	def create_groups(self):
 		# identify parts that spread over several staves (ie keyboards)
+		self.groups = {}
 		parts_staves = {}
 		for staff in self.staves:
 			for part in staff.parts:
@@ -0,0 +1,106 @@
+# import the logging library
+import logging
+
+import base64
+import os
+import threading
+from contextlib import contextmanager
+
+import verovio
+
+logger = logging.getLogger(__name__)
+
+'''
+  A pool of Verovio toolkits, for the conversions to MEI, MIDI and SVG.
+
+  A toolkit is not thread-safe: it is lent to one conversion at a time,
+  and given back to the pool afterwards. Documents are loaded from strings
+  (loadData), never from temporary files shared by the processes.
+'''
+
+class ToolkitPool:
+	"""
+		Reusable Verovio toolkits of a process
+	"""
+
+	def __init__(self, options={}, max_idle=4):
+		# Options set once, when a toolkit is created
+		self.options = options
+		# Nb of toolkits kept when they are not used
+		self.max_idle = max_idle
+
+		self.idle = []
+		self.lock = threading.Lock()
+		# Toolkits are not shared with forked processes
+		self.pid = os.getpid()
+
+	def acquire(self):
+		with self.lock:
+			if self.pid != os.getpid():
+				self.idle = []
+				self.pid = os.getpid()
+			if len(self.idle) > 0:
+				return self.idle.pop()
+		tk = verovio.toolkit()
+		if len(self.options) > 0:
+			tk.setOptions(self.options)
+		return tk
+
+	def release(self, tk):
+		with self.lock:
+			if self.pid == os.getpid() and len(self.idle) < self.max_idle:
+				self.idle.append(tk)
+
+	@contextmanager
+	def toolkit(self):
+		'''
+		  A toolkit, given back to the pool at the end of the block
+		'''
+		tk = self.acquire()
+		try:
+			yield tk
+		finally:
+			self.release(tk)
+
+	@staticmethod
+	def load(tk, content):
+		# Load a document (MusicXML, MEI, Kern, ...). The format is detected
+		if isinstance(content, bytes):
+			content = content.decode("utf-8")
+		if not tk.loadData(content):
+			raise ToolkitError (f"Verovio is unable to load the document: {tk.getLog()}")
+
+	@staticmethod
+	def convert(tk, content, to="mei", page=1):
+		'''
+		  Convert a document with a toolkit. MIDI files are returned
+		  as bytes, other formats as strings
+		'''
+		ToolkitPool.load(tk, content)
+		if to == "mei":
+			return tk.getMEI()
+		elif to == "midi":
+			return base64.b64decode(tk.renderToMIDI())
+		elif to == "svg":
+			return tk.renderToSVG(page)
+		raise ToolkitError (f"Unknown output format {to}")
+
+	def to_mei(self, content):
+		with self.toolkit() as tk:
+			return ToolkitPool.convert(tk, content, "mei")
+
+	def to_midi(self, content):
+		with self.toolkit() as tk:
+			return ToolkitPool.convert(tk, content, "midi")
+
+	def to_svg(self, content, page=1):
+		with self.toolkit() as tk:
+			return ToolkitPool.convert(tk, content, "svg", page)
+
+
+class ToolkitError(Exception):
+	pass
+
+
+# The pool of the process
+toolkit_pool = ToolkitPool()
@@ -4,9 +4,14 @@ from fractions import Fraction
 import logging
 from django.conf import settings
 
+import numpy as np
+
 # Get an instance of a logger
 logger = logging.getLogger(__name__)
 
+# Number of a diatonic interval, from the gap of staff positions (unisons count as seconds)
+DIATONIC_NUMBERS = np.array([2, 2, 3, 4, 5, 6, 7])
+
 class Distance_neuma:
     """Implementation  of the specific rhytmic distance for Neulma"""
  
@@ -107,6 +112,118 @@ class Distance_neuma:
         
         return cost_alignment
 
+    @staticmethod
+    def rhythmic_distances(s, starts, ends, pattern):
+        """
+        Rhythmic distance (see distance()) between a pattern and each of its
+        occurrences in a sequence, computed in batch on the arrays of the
+        sequence. An occurrence is the range of items [starts[i], ends[i]].
+
+        NaN when the blocks of an occurrence do not match those of the pattern
+        (distance() raises a ValueError in that case)
+        """
+        distances = np.full(len(starts), np.nan)
+        if len(starts) == 0:
+            return distances
+        if len(pattern.get_rhythm_values()[0]) == 0:
+            distances[:] = 100
+            return distances
+
+        pattern_arrays = pattern.get_arrays()
+        nb_blocks = np.count_nonzero(pattern_arrays["pitch"][1:] != pattern_arrays["pitch"][:-1]) + 1
+        pattern_durations, pattern_valid = Distance_neuma.block_durations(pattern_arrays,
+                                        np.array([0]), np.array([len(pattern.items) - 1]), nb_blocks)
+        durations, valid = Distance_neuma.block_durations(s.get_arrays(), starts, ends, nb_blocks)
+        if pattern_valid[0]:
+            distances[valid] = np.abs(durations[valid] - pattern_durations[0]).sum(axis=1)
+
+        # An occurrence without rhythm (see get_rhythms())
+        is_timed = s.get_arrays()["duration"] != 0
+        nb_timed = np.concatenate(([0], np.cumsum(is_timed)))
+        no_rhythm = ~is_timed[starts] | (nb_timed[ends + 1] - nb_timed[starts + 1] == 0)
+        distances[no_rhythm] = 100
+        return distances
+
+    @staticmethod
+    def block_durations(arrays, starts, ends, nb_blocks):
+        """Normalized durations of the blocks (see find_blocks_range()) of
+        ranges of items, when they have nb_blocks blocks"""
+        pitches = arrays["pitch"]
+        # A block starts where the pitch changes
+        changes = np.flatnonzero(pitches[1:] != pitches[:-1]) + 1
+        first = np.searchsorted(changes, starts, side="right")
+        last = np.searchsorted(changes, ends, side="right")
+        valid = (last - first) == nb_blocks - 1
+
+        bounds = np.empty((len(starts), nb_blocks + 1), dtype=np.int64)
+        bounds[:, 0] = starts
+        bounds[:, -1] = ends + 1
+        if nb_blocks > 1 and len(changes) > 0:
+            inner = np.minimum(first[:, None] + np.arange(nb_blocks - 1), len(changes) - 1)
+            bounds[:, 1:-1] = changes[inner]
+        elif nb_blocks > 1:
+            valid[:] = False
+            bounds[:, 1:-1] = bounds[:, :1]
+
+        cumulated = np.concatenate(([0.0], np.cumsum(arrays["duration"])))
+        durations = cumulated[bounds[:, 1:]] - cumulated[bounds[:, :-1]]
+        totals = durations.sum(axis=1)
+        valid &= totals != 0
+        return durations / np.where(valid, totals, 1)[:, None], valid
+
+    @staticmethod
+    def melodic_distances(s, starts, ends, pattern):
+        """
+        Melodic distance (see melodic_distance()) between a pattern and each of
+        its occurrences in a sequence, computed in batch. NaN when the number of
+        intervals of an occurrence differs from the pattern
+        """
+        distances = np.full(len(starts), np.nan)
+        if len(starts) == 0:
+            return distances
+        pattern_values = pattern.get_interval_values(settings.DIATONIC_DESCR)[2]
+        if len(pattern_values) == 0:
+            distances[:] = 100
+            return distances
+        nb_intervals = len(pattern_values)
+        pattern_codes = np.array([Distance_neuma.interval_code(value) for value in pattern_values])
+
+        arrays = s.get_arrays()
+        notes = np.flatnonzero(~arrays["is_rest"])
+        gaps = np.diff(arrays["pitch"][notes])
+        changes = np.flatnonzero(gaps != 0)
+        gaps = gaps[changes]
+        # The note where each interval ends
+        change_ends = notes[changes + 1]
+
+        # The first note of each occurrence: intervals are measured from there
+        first = np.searchsorted(notes, starts)
+        has_notes = first < len(notes)
+        first_notes = notes[np.minimum(first, len(notes) - 1)] if len(notes) > 0 else starts
+        has_notes &= first_notes <= ends
+        lo = np.searchsorted(change_ends, first_notes, side="right")
+        hi = np.searchsorted(change_ends, ends, side="right")
+        counts = np.where(has_notes, hi - lo, 0)
+
+        valid = counts == nb_intervals
+        if np.any(valid):
+            intervals = lo[valid][:, None] + np.arange(nb_intervals)
+            to_pos = change_ends[intervals]
+            from_pos = np.concatenate((first_notes[valid][:, None], to_pos[:, :-1]), axis=1)
+            staff_steps = np.abs(arrays["staff"][to_pos] - arrays["staff"][from_pos]) % 7
+            codes = DIATONIC_NUMBERS[staff_steps] * np.sign(gaps[intervals])
+            distances[valid] = (codes != pattern_codes).sum(axis=1) / nb_intervals
+        # An occurrence without interval (see get_melodic_distance())
+        distances[counts == 0] = 100
+        return distances
+
+    @staticmethod
+    def interval_code(value):
+        """A diatonic interval as a signed integer: "3D" becomes -3"""
+        if value[-1] == 'D':
+            return -int(value[:-1])
+        return int(value[:-1])
+
     @staticmethod
     def simplified_interval_for_blocks(s):
 
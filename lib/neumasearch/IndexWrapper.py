@@ -8,15 +8,18 @@ from elasticsearch import Elasticsearch
 from elasticsearch_dsl import Search, Index
 from elasticsearch_dsl import Document, Integer, Text, Object, Nested, InnerDoc
 from elasticsearch_dsl import Q
-from elasticsearch.helpers import bulk
+from elasticsearch.helpers import bulk, parallel_bulk
 
+import itertools
 import json
 from operator import itemgetter
 
 from manager.models import Corpus, Opus
+import lib.music.constants as constants_mod
 from music import *
 from .Sequence import Sequence
 from .MusicSummary import MusicSummary
+from .SearchResults import SearchResults
 
 # import the logging library
 import logging
@@ -28,6 +31,9 @@ logger.setLevel(logging.WARNING)
 # Debug level for HTTP requests
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
+# Max. from + size of a search request (index.max_result_window)
+ES_MAX_RESULT_WINDOW = 10000
+
 class IndexWrapper:
 	"""
 	
@@ -84,63 +90,29 @@ class IndexWrapper:
 	def index_opus (self, opus):
 		""" 
 		Add of replace an Opus in the ElasticSeaerch index
-		
+
+		The score is parsed to get the music summary, and the descriptors
+		are taken from the DB. See IndexingPipeline to do both in one pass.
 		"""
 		
 		print ("Index Opus " + opus.ref)
-		# First time that we index this Opus
 		try:
 			score = opus.get_score()
 
 			# New change: store MS in ES
 			music_summary = MusicSummary.get_music_summary(score)
 			music_summary.opus_id = opus.ref
-			msummary_for_es = music_summary.encode()
-
-			if opus.composer is not None:
-				composer = opus.composer.name_and_dates()
-			else:
-				composer = None
-			opus_index = OpusIndex(
-				meta={'id': opus.ref, 'index': settings.ELASTIC_SEARCH["index"]},
-				corpus_ref=opus.corpus.ref,
-				ref=opus.ref,
-				local_ref=opus.local_ref(),
-				summary = msummary_for_es,
-				title=opus.title,
-				composer=composer
-			)
-			
-			# Add features if any
-			for meta in opus.metadata:
-				if meta.meta_key == OpusMeta.MK_KEY_TONIC:
-					opus_index.key = meta.meta_value
-				if meta.meta_key == OpusMeta.MK_KEY_MODE:
-					opus_index.mode = meta.meta_value
-				if meta.meta_key == OpusMeta.MK_NUM_OF_PARTS:
-					opus_index.nb_of_parts = meta.meta_value
-				
-			# Add descriptors to opus index
-			for descriptor in opus.descriptor_set.all():
-				#print ("Add descriptor for voice " + descriptor.voice, " type " + descriptor.type)
-				opus_index.add_descriptor(descriptor)
-			# Saving the opus_index object triggers insert or replacement in ElasticSearch
-			opus_index.save(using=self.elastic_search,id=opus.ref)
-
+			opus_index = OpusIndex.from_opus(opus, music_summary, opus.descriptor_set.all())
+			self.save_opus_index(opus_index)
 		except Exception as ex:
 			print ("Error met when trying to index: " + str(ex))
-			#When the analysis finish, no value would be assigned to mel_pat_dict etc.. thus simply return void
-		
 		return
 
-
-		# Add descriptors to opus index
-		for descriptor in opus.descriptor_set.all():
-			#print ("Add descriptor for voice " + descriptor.voice, " type " + descriptor.type)
-			opus_index.add_descriptor(descriptor)
-
-		# Saving the opus_index object triggers insert or replacement in ElasticSearch
-		opus_index.save(using=self.elastic_search,id=opus.ref)
+	def save_opus_index (self, opus_index):
+		"""
+		Saving the opus_index object triggers insert or replacement in ElasticSearch
+		"""
+		opus_index.save(using=self.elastic_search, id=opus_index.ref)
 
 	def get_all_corpora(self):
 		"""
@@ -161,31 +133,6 @@ class IndexWrapper:
 
 		return corpora
 
-	def ranked_search(self, search_context):
-		"""
-		Run a search with internal ES ranking
-		"""
-		
-		# Create the standard search object
-		std_query = self.get_search(search_context)
-		 
-		# Create the ranked search object
-		search = Search(using=self.elastic_search)
-		
-		with open(self.query_dir + '/' + 'ranked_search.json', 'r') as query_file:
-			query = json.loads(query_file.read())
- 
-		query['query']['function_score']['functions'][0]['script_score']['script']['params']['query'] = search_context.get_pattern_sequence().encode()
-		 
-		# Set the correct query part of the ranked search
-		query['query']['function_score']['query'] = std_query.to_dict()['query']
-
-		#query['query']['function_score']
-		print ("Ranked search query " + str(query).replace("\"", "\\\"").replace("'", "\""))
-			   
-		search.from_dict(query)
-		return search
-
 	def search(self, search_context):
 		'''
 		Search function: sends a combined query to ElasticSearch
@@ -205,110 +152,27 @@ class IndexWrapper:
 			   + "'  Keywords: '" + search_context.keywords + "'"
 			   + "'  Pattern: [" + str(pattern_sequence) + "]")
 		
-		# Get search query
-		if settings.ES_RANKED_SEARCH:
-			# We use our own internal ranked search
-			search = self.ranked_search(search_context)
-		else:
-			search = self.get_search(search_context)
-			 
+		# Get search query. With ES_RANKED_SEARCH, the hits are ranked by
+		# SearchResults, from the distances computed on the music summaries
+		search = self.get_search(search_context)
+
 		# Get results
 		
 		#query = Q("multi_match", query='King', fields=['title', 'body'])
 		#search = Search(using=self.elastic_search).query(query)
 		logger.info ("Search doc sent to ElasticSearch: " + str(search.to_dict()))
 		print ("Search doc sent to ElasticSearch: " + str(search.to_dict()).replace("'", "\""))
-		results = search.execute()
-
-		# Create the result by decoding the opus got from ElasticSearch
-		opera = []
-		# Utiliser scan() au lieu de parcourir 'results' pour obtenir tous les résultats
-		count_match_for_exact_search = 0
-		# Philippe la boucle  "for hit in search.scan()" plante sur Humanum...
-		for hit in search:
-			try:
-				if "ref" in hit:
-					opus = Opus.objects.get(ref=hit["ref"])
-					matching_ids = []
-					distance = 0
-					best_occurrence = None
-					# Find the occurrences in MusicSummary, if search type is pattern search
-					# Using MusicSummary to locate hits in the results returned by elasticsearch
-					if search_context.is_pattern_search():
-						msummary = MusicSummary()
-						if opus.summary:
-							with open(opus.summary.path, "r") as summary_file:
-								msummary_content = summary_file.read()
-							msummary.decode(msummary_content)
-
-							pattern_sequence = search_context.get_pattern_sequence()
-
-							#No mirror search mode for exact search
-							if search_context.search_type == EXACT_SEARCH:
-								mirror_setting = False
-								count_match_for_exact_search+=1
-								occurrences = msummary.find_exact_matches(pattern_sequence, search_context.search_type)
-
-							if search_context.search_type == MELODIC_SEARCH or search_context.search_type == DIATONIC_SEARCH or search_context.search_type == RHYTHMIC_SEARCH:
-								#return the sequences that match and the distances
-								mirror_setting = search_context.is_mirror_search()
-
-								# Find the occurrences of matches within the opus, 
-								# and measure the melodic or rhythmic distance depending on context
-								# If there is more than one match in an opus,
-								# we only take the distance between the best match(with least distance with the query)
-								# The "best_occurrence" here should be a pattern sequence.
-								best_occurrence, distance = msummary.get_best_occurrence(pattern_sequence, search_context.search_type, mirror_setting)
-								logger.info ("Found best occurrence : " + str(best_occurrence) + " with distance " + str(distance))
-
-							#Find matching ids for the matches to highlight
-							matching_ids = msummary.find_matching_ids(pattern_sequence, search_context.search_type, mirror_setting)
-						else:
-							logger.warning("No summary for Opus " + opus.ref)
-					#If search by keywords
-					elif search_context.is_keyword_search():
-
-						'''
-							Instead of getting MusicSummary and locate the pattern when the search type is pattern search, 
-							here we directly get scores from the opus that match in the search,
-							and find if the keyword is in the lyrics of the opus.
-						'''
-						best_occurrence = ""
-						#always "" in keyword search mode because it is supposed to be a pattern sequence
-						distance = 0
-						#No distance measurement for keyword search
-						matching_ids = []
-						#IDs of matching M21 objects
-						print("#######################################")
-						score = opus.get_score()
-						#Find the matching id by locating keywords in the score
-						for voice in score.get_all_voices():
-							#get lyrics of the current voice
-							curr_lyrics = voice.get_lyrics()
-							if curr_lyrics != None:
-								if search_context.keywords in curr_lyrics:
-									#There is a match within the current lyrics
-									occurrences, curr_matching_ids = voice.search_in_lyrics(search_context.keywords)
-									if occurrences > 0:
-										#If there is a match
-										print("Found occurrence in opus_id:  ", opus.id)
-										print("Appeared in voice: ", voice.id, ", occurrences: ", occurrences)
-										for m_id in curr_matching_ids:
-											matching_ids.append(m_id)
-					opera.append({"opus": opus, "matching_ids": json.dumps(matching_ids), "distance": distance, "best_occurrence": str(best_occurrence)})
-			except Opus.DoesNotExist:
-				logger.warning (f"Opus {hit['ref']} found in ES but not in the DB")
-		
-		# Sort results by score
-		if settings.ES_RANKED_SEARCH:
-			#print("Ranked within elasticsearch!")
-			#If search type is melodic/rhythmic, so the rhythmic/melodic distance is calculatable
-			if search_context.search_type == MELODIC_SEARCH or search_context.search_type == RHYTHMIC_SEARCH or search_context.search_type == DIATONIC_SEARCH:
-				opera = sorted(opera, key=itemgetter('distance'))
-				for o in opera:
-					print(str(o["best_occurrence"]) + " : " + str(o["distance"]))
-		
-		return opera
+		# Only the refs are read: each page of results is then completed from the DB
+		search = search.source(["ref"])
+
+		def get_refs(start, stop):
+			if stop > ES_MAX_RESULT_WINDOW:
+				# All the hits, for ranking: scroll (the ES order is lost)
+				return [hit["ref"] for hit in itertools.islice(search.scan(), start, stop) if "ref" in hit]
+			# Philippe la boucle  "for hit in search.scan()" plante sur Humanum...
+			return [hit["ref"] for hit in search[start:stop] if "ref" in hit]
+
+		return SearchResults(search_context, search.count(), get_refs)
 
 	def export_all(self, output_dir):
 		es = Elasticsearch()
@@ -410,13 +274,26 @@ class IndexWrapper:
 		print ("Deleting index " + settings.ELASTIC_SEARCH["index"])
 		self.elastic_search.indices.delete(index=settings.ELASTIC_SEARCH["index"], ignore=[400, 404])
 
-	def bulk_indexing():
+	def bulk_indexing(self, actions, thread_count=4, chunk_size=50):
 		'''
-			Index all descriptor objects into ElasticSearch
+			Index a stream of documents with the ES bulk helper, over
+			the connection of this wrapper. The actions are dicts
+			as produced by OpusIndex.to_dict(include_meta=True)
+
+			Returns the number of documents indexed, and the list of failures
 		'''
-		OpusIndex.init(index=settings.ELASTIC_SEARCH["index"])
-		Descriptor = apps.get_model('manager', 'descriptor')
-		bulk(client=self.elas, actions=(b.indexing() for b in Descriptor.objects.all().iterator()))
+		nb_indexed = 0
+		failures = []
+		for ok, info in parallel_bulk(self.elastic_search, actions,
+						thread_count=thread_count, chunk_size=chunk_size,
+						raise_on_error=False, raise_on_exception=False):
+			if ok:
+				nb_indexed += 1
+			else:
+				# info is a dict such as {"index": {"_id": ..., "error": ...}}
+				for op_info in info.values():
+					failures.append((op_info.get("_id"), str(op_info.get("error"))))
+		return nb_indexed, failures
 
 class DescriptorIndex(InnerDoc):
 	'''
@@ -470,6 +347,38 @@ class OpusIndex(Document):
 	diatonic = Nested(
 		doc_class=DescriptorIndex,
 	)
+	@staticmethod
+	def from_opus(opus, music_summary, descriptors):
+		'''
+		  Create the document of an opus, from its summary and descriptors
+		'''
+		if opus.composer is not None:
+			composer = opus.composer.name_and_dates()
+		else:
+			composer = None
+		opus_index = OpusIndex(
+			meta={'id': opus.ref, 'index': settings.ELASTIC_SEARCH["index"]},
+			corpus_ref=opus.corpus.ref,
+			ref=opus.ref,
+			local_ref=opus.local_ref(),
+			summary = music_summary.encode(),
+			title=opus.title,
+			composer=composer
+		)
+
+		# Add features if any
+		for meta in opus.metadata:
+			if meta["key"] == constants_mod.MK_KEY_TONIC:
+				opus_index.key = meta["value"]
+			if meta["key"] == constants_mod.MK_KEY_MODE:
+				opus_index.mode = meta["value"]
+			if meta["key"] == constants_mod.MK_NUM_OF_PARTS:
+				opus_index.nb_of_parts = meta["value"]
+
+		for descriptor in descriptors:
+			opus_index.add_descriptor(descriptor)
+		return opus_index
+
 	'''
 	  Add a new descriptor to the OpusIndex. Must be done before sending the latter to ES
 	'''
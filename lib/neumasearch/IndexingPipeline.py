@@ -0,0 +1,110 @@
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+
+from manager.models import Descriptor, score_cache
+
+from .MusicSummary import MusicSummary
+from .IndexWrapper import OpusIndex
+
+# import the logging library
+import logging
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+class IndexingPipeline:
+	"""
+		Produce everything needed to index an opus from a single parse of its score
+
+		The score is parsed once. The music summary, the melodic, diatonic,
+		rhythmic and notes descriptors, the lyrics and the ElasticSearch
+		document are all derived from this in-memory score. Descriptors are
+		written in the DB with a single bulk insert.
+	"""
+
+	# Descriptor types produced for each voice of the summary, with the
+	# method of Sequence that computes the n-gram encoding
+	VOICE_DESCRIPTORS = [(settings.MELODY_DESCR, "get_melody_encoding"),
+						(settings.DIATONIC_DESCR, "get_diatonic_encoding"),
+						(settings.RHYTHM_DESCR, "get_rhythm_encoding"),
+						(settings.NOTES_DESCR, "get_note_encoding")]
+
+	def __init__(self, opus):
+		self.opus = opus
+		self.score = None
+		self.music_summary = None
+		# Descriptor objects, not yet saved
+		self.descriptors = []
+
+	def load_score(self):
+		if self.score is None:
+			self.score = self.opus.get_score()
+		return self.score
+
+	def compute_summary(self):
+		self.music_summary = MusicSummary.get_music_summary(self.load_score())
+		self.music_summary.opus_id = self.opus.ref
+		return self.music_summary
+
+	def compute_descriptors(self):
+		"""
+		   Compute all the descriptors of the opus, in memory
+		"""
+		if self.music_summary is None:
+			self.compute_summary()
+
+		self.descriptors = []
+		for part_id, part in self.music_summary.parts.items():
+			for voice_id, voice in part.items():
+				for descr_type, encoding_method in IndexingPipeline.VOICE_DESCRIPTORS:
+					self.descriptors.append(Descriptor(opus=self.opus,
+							part=part_id, voice=voice_id, type=descr_type,
+							value=getattr(voice, encoding_method)()))
+		self.descriptors += self.compute_lyrics()
+		return self.descriptors
+
+	def compute_lyrics(self):
+		"""
+		   Lyrics descriptors, one per voice with lyrics
+		"""
+		voices = [voice for voice in self.load_score().get_all_voices() if voice.has_lyrics()]
+
+		# The M21 MEI parser may loose the lyrics: in that case we take
+		# them from the MusicXML (a cache hit, most of the time)
+		if len(voices) == 0 and self.opus.mei and self.opus.musicxml:
+			mxml_score = score_cache.get_score(self.opus.musicxml.path, "musicxml")
+			if mxml_score.m21_score is not None:
+				voices = [voice for voice in mxml_score.get_all_voices() if voice.has_lyrics()]
+
+		lyrics = []
+		for voice in voices:
+			lyrics.append(Descriptor(opus=self.opus, part=settings.ALL_PARTS,
+						voice=voice.id, type=settings.LYRICS_DESCR,
+						value=voice.get_lyrics()))
+		return lyrics
+
+	def save(self):
+		"""
+		   Store the summary file, and replace the descriptors of the opus
+		"""
+		self.opus.summary.save("summary.bin", ContentFile(self.music_summary.encode_binary()))
+		with transaction.atomic():
+			Descriptor.objects.filter(opus=self.opus).delete()
+			Descriptor.objects.bulk_create(self.descriptors)
+
+	def make_opus_index(self):
+		return OpusIndex.from_opus(self.opus, self.music_summary, self.descriptors)
+
+	def run(self):
+		"""
+		   Parse, compute and save. Returns the ElasticSearch document, or None
+		   if the score cannot be parsed
+		"""
+		print ("Produce descriptors for opus " + self.opus.ref)
+		if self.load_score().m21_score is None:
+			logger.warning (f"Unable to parse the score of opus {self.opus.ref}: not indexed")
+			return None
+		self.compute_descriptors()
+		self.save()
+		return self.make_opus_index()
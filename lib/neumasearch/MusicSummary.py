@@ -4,7 +4,11 @@ from .constants import MELODIC_SEARCH, RHYTHMIC_SEARCH,DIATONIC_SEARCH
 import jsonpickle, json
 from operator import itemgetter
 from .Sequence import Sequence, Item
+from .SummaryFile import SummaryFile
+from .PatternMatcher import PatternMatcher
+from .Distance_neuma import Distance_neuma
 import music21 as m21
+import numpy as np
 
 # import the logging library
 import logging
@@ -23,10 +27,25 @@ class MusicSummary:
 		MS objects are serialized in JSON for storaae with and Opus. The music summary
 		associated with an Opus is then loaded as search time to identify occurrences
 		of pattern searches.
+		
+		The summary file of an Opus uses a compact binary format (see SummaryFile)
+		which is memory-mapped, each voice being decoded on first access. Files
+		produced before are still in JSON.
 	"""
 	def __init__(self) :
 		self.opus_id = ""
 		self.parts = {}
+		# Occurrences of the patterns searched so far (see find_occurrences)
+		self.occurrences = {}
+
+	def __getstate__(self):
+		# The occurrences are not serialized
+		return {"opus_id": self.opus_id, "parts": self.parts}
+
+	def __setstate__(self, state):
+		self.opus_id = state["opus_id"]
+		self.parts = state["parts"]
+		self.occurrences = {}
 		
 	def decode(self, json_string):
 		'''
@@ -46,6 +65,17 @@ class MusicSummary:
 					# Decode the sequence from the voice
 					self.parts[part_id][voice_id].decode(voice)
 
+	@staticmethod
+	def load(file_path):
+		'''
+		   Load a summary file, in the binary format or in JSON
+		'''
+		music_summary = MusicSummary()
+		if not SummaryFile.read(file_path, music_summary):
+			with open(file_path, "r") as summary_file:
+				music_summary.decode(summary_file.read())
+		return music_summary
+
 	def add_part(self, part_id):
 		'''Initializes a part'''
 		self.parts[part_id] = {}
@@ -60,50 +90,64 @@ class MusicSummary:
 		'''
 		return jsonpickle.encode(self, unpicklable=False)
 
-	
+	def encode_binary(self):
+		'''
+		   Encode a music summary in the binary format
+		'''
+		return SummaryFile.encode(self)
+
+	def find_occurrences(self, pattern, search_type, mirror_setting = False):
+		""" 
+			Find the occurrences of a pattern (a Sequence object) in the voices.
+			
+			The pattern (and its mirror) is compiled once in a matcher, which scans
+			each voice in a single pass. The result is kept: positions, matching ids
+			and sequences of a same search are all obtained from it.
+		"""
+		key = (str(pattern), search_type, mirror_setting)
+		if key not in self.occurrences:
+			matcher = PatternMatcher(pattern.get_search_patterns(search_type, mirror_setting))
+			occurrences = dict()
+			for part_id, part in self.parts.items():
+				occurrences[part_id] = dict()
+				for voice_id, voice in part.items():
+					occurrences[part_id][voice_id] = voice.find_occurrences(matcher, search_type)
+			self.occurrences[key] = occurrences
+		return self.occurrences[key]
+
 	def find_positions(self, pattern, search_type, mirror_setting = False):
 		""" 
 			Find the position of a pattern in the voices
 			
 			The pattern parameter is a Sequence object
-			If 'rhythm' is True, the pattern will be decoded as a rhythm, otherwise, as a melody
 			Called by views.py
 		"""
-		occurrences = dict()
-		for part_id, part in self.parts.items():
-			occurrences[part_id] = dict()
-			for voice_id, voice in part.items():
-				#Calling find_positions() in Sequence.py
-				occurrences[part_id][voice_id] = voice.find_positions(pattern, search_type, mirror_setting)
-		return occurrences
+		return self.find_occurrences(pattern, search_type, mirror_setting)
 
 	def find_matching_ids(self, pattern, search_type, mirror_setting = False):
 
 		ids = list()
-		for part_id, part in self.parts.items():
-			for voice_id, voice in part.items():
-				#Calling find_positions() in Sequence.py
-				occurrences = voice.find_positions(pattern, search_type, mirror_setting)
+		for part_id, part in self.find_occurrences(pattern, search_type, mirror_setting).items():
+			for voice_id, occurrences in part.items():
+				voice = self.parts[part_id][voice_id]
 				for occ in occurrences: 
 					for i in occ:
-						# print ("Item match  " + str(i) + " : " + str(voice.items[i]))
 						ids.append(voice.items[i].id)
 		return ids
 
 	def find_sequences(self, pattern, search_type, mirror_setting = False):
 
 		sequences = list()
-		for part_id, part in self.parts.items():
+		for part_id, part in self.find_occurrences(pattern, search_type, mirror_setting).items():
 			#Iterate over parts in MusicSummary
-			for voice_id, voice in part.items():
+			for voice_id, occurrences in part.items():
 				'''
-					In every part, iterate over sequences of several voices
+					In every part, iterate over the occurrences in the sequences of several voices
 					Note that the "voice" here is not a Voice object, but a "Sequence"
 					If iterating over items within sequence is needed,
 					Use "for item in voice.get_items_from_sequence()"
 				'''
-				#Calling find_positions() in Sequence.py
-				occurrences = voice.find_positions(pattern, search_type, mirror_setting)
+				voice = self.parts[part_id][voice_id]
 				for o in occurrences:
 					s = Sequence()
 					for ir in o:
@@ -164,6 +208,32 @@ class MusicSummary:
 			#logger.error ("Opus " + self.opus_id + " and pattern " + str([pattern]) + ": no occurrence found?")
 			return "", 1000000
 
+	def get_best_distance(self, pattern, search_type, mirror_setting = False):
+		"""
+		  Distance of the best occurrence: same value as get_best_occurrence(), but
+		  the distances of the occurrences of a voice are computed in batch, without
+		  building the occurrences. Used to rank the results of a search
+		"""
+		best_distance = None
+		for part_id, part in self.find_occurrences(pattern, search_type, mirror_setting).items():
+			for voice_id, occurrences in part.items():
+				if len(occurrences) == 0:
+					continue
+				voice = self.parts[part_id][voice_id]
+				starts = np.array([occurrence.start for occurrence in occurrences])
+				ends = np.array([occurrence.stop - 1 for occurrence in occurrences])
+				if search_type == RHYTHMIC_SEARCH:
+					distances = Distance_neuma.melodic_distances(voice, starts, ends, pattern)
+				else:
+					distances = Distance_neuma.rhythmic_distances(voice, starts, ends, pattern)
+				# Occurrences whose distance cannot be computed are ignored
+				distances = distances[~np.isnan(distances)]
+				if len(distances) > 0 and (best_distance is None or distances.min() < best_distance):
+					best_distance = float(distances.min())
+		if best_distance is None:
+			return 1000000
+		return best_distance
+
 	@staticmethod
 	def get_music_summary(score):
 		'''Produce a compact representation of a score for search operations'''
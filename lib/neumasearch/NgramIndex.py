@@ -0,0 +1,450 @@
+from django.conf import settings
+from django.db.models import Q
+
+import fcntl
+import itertools
+import json
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+from manager.models import Opus, Descriptor
+from .constants import MELODIC_SEARCH, RHYTHMIC_SEARCH, DIATONIC_SEARCH, EXACT_SEARCH
+from .SearchResults import SearchResults
+
+# import the logging library
+import logging
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+'''
+  A local inverted index of the n-gram descriptors, which answers pattern
+  searches without ElasticSearch.
+
+  Layout of the index file:
+    - the magic string, the format version and the size of the header
+    - a JSON header: the indexed opera, the vocabulary of each type of
+      descriptor, and the position of each array in the data section
+    - the data section: NumPy arrays, memory-mapped when the file is loaded
+'''
+
+MAGIC = b"NGIX"
+# Bump if the layout changes
+FORMAT_VERSION = 1
+# Version (unsigned short) and header size (unsigned int)
+PREAMBLE = struct.Struct("<HI")
+# Arrays of the data section are aligned on this size
+ALIGNMENT = 8
+
+# Separator of the n-grams in a descriptor (see Sequence.join_ngrams)
+NGRAM_SEPARATOR = " N "
+# A posting is encoded as voice number * POSITION_RANGE + position
+POSITION_RANGE = 1 << 32
+# Nb of opera whose descriptors are read in one query
+UPDATE_CHUNK_SIZE = 500
+
+
+def padding(size):
+	return (ALIGNMENT - size % ALIGNMENT) % ALIGNMENT
+
+
+def smallest_dtype(max_value):
+	for dtype in (np.uint8, np.uint16, np.uint32):
+		if max_value <= np.iinfo(dtype).max:
+			return np.dtype(dtype)
+	return np.dtype(np.int64)
+
+
+class NgramIndex:
+	"""
+		Inverted index of the melodic, diatonic, rhythmic and notes descriptors.
+
+		For each type of descriptor, an n-gram is mapped to its postings: the
+		voices (of an opus) where it occurs, and its positions in these voices.
+		Postings are stored in NumPy arrays sorted by n-gram: the postings of
+		n-gram t are in [offsets[t], offsets[t+1]). A pattern is found with a
+		phrase query: its n-grams must occur at consecutive positions of a voice.
+
+		Opera re-indexed since the file was loaded are kept in memory: their
+		former postings are ignored and the new ones are added, until save()
+		merges everything in a new file. Writers take a lock on the file, and
+		merge the changes written by other processes in the meantime.
+
+		The search() method has the same contract as IndexWrapper.search().
+	"""
+
+	# Descriptor searched for each type of search
+	SEARCH_DESCRIPTORS = {MELODIC_SEARCH: settings.MELODY_DESCR, DIATONIC_SEARCH: settings.DIATONIC_DESCR,
+						RHYTHMIC_SEARCH: settings.RHYTHM_DESCR, EXACT_SEARCH: settings.NOTES_DESCR}
+
+	# One index per process
+	instance = None
+
+	def __init__(self, index_path):
+		self.index_path = index_path
+		# Modification time of the loaded file
+		self.mtime = None
+
+		# Document number -> [opus id, opus ref]
+		self.opera = []
+		# Opus id -> document number, for the indexed opera
+		self.doc_numbers = {}
+		# Voice number -> document number
+		self.voice_docs = np.zeros(0, dtype=np.int64)
+		# Descriptor type -> {n-gram: n-gram number}
+		self.terms = {}
+		# Descriptor type -> (offsets, voices, positions)
+		self.postings = {}
+
+		# Changes since the file was loaded
+		self.deleted_docs = set()
+		self.new_voice_docs = []
+		# Descriptor type -> {n-gram: list of postings}
+		self.new_postings = {}
+		# Ids of the opera read again since the file was loaded
+		self.updated_opera = set()
+		self.lock = threading.Lock()
+
+	@staticmethod
+	def get_index():
+		'''
+		   The index of the process, loaded from settings.NGRAM_INDEX_PATH
+		'''
+		if NgramIndex.instance is None:
+			NgramIndex.instance = NgramIndex(settings.NGRAM_INDEX_PATH)
+		NgramIndex.instance.reload_if_changed()
+		return NgramIndex.instance
+
+	@staticmethod
+	def build(index_path=None):
+		'''
+		   Build the index from the Descriptor table
+		'''
+		index = NgramIndex(index_path or settings.NGRAM_INDEX_PATH)
+		index.update_opera(Opus.objects.values_list("id", flat=True))
+		# The new index replaces the file, whatever it contains
+		index.save(merge=False)
+		return index
+
+	def has_changes(self):
+		return len(self.deleted_docs) > 0 or len(self.new_voice_docs) > 0
+
+	def reload_if_changed(self):
+		'''
+		   Load the file if it was rewritten (e.g., by an indexing process)
+		'''
+		try:
+			mtime = os.stat(self.index_path).st_mtime_ns
+		except FileNotFoundError:
+			if self.mtime is None and not self.has_changes():
+				logger.warning (f"No n-gram index in {self.index_path}: run scan_corpus -a ngram_index")
+			return
+		if mtime != self.mtime and not self.has_changes():
+			with self.lock:
+				self.load()
+
+	def load(self):
+		with open(self.index_path, "rb") as f:
+			if f.read(len(MAGIC)) != MAGIC:
+				raise ValueError(f"{self.index_path} is not an n-gram index")
+			version, header_size = PREAMBLE.unpack(f.read(PREAMBLE.size))
+			if version != FORMAT_VERSION:
+				raise ValueError(f"{self.index_path} has format version {version}, expected {FORMAT_VERSION}")
+			header = json.loads(f.read(header_size).decode("utf-8"))
+			mtime = os.fstat(f.fileno()).st_mtime_ns
+			# The mapping remains valid once the file is closed (or replaced)
+			buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+		data_start = len(MAGIC) + PREAMBLE.size + header_size
+		data_start += padding(data_start)
+
+		def get_array(name):
+			offset, dtype, count = header["arrays"][name]
+			if count == 0:
+				return np.zeros(0, dtype=dtype)
+			return np.frombuffer(buffer, dtype=dtype, count=count, offset=data_start + offset)
+
+		self.opera = header["opera"]
+		self.doc_numbers = {opus_id: doc for doc, (opus_id, opus_ref) in enumerate(self.opera)}
+		self.voice_docs = get_array("voice_docs")
+		self.terms = {}
+		self.postings = {}
+		for descr_type, terms in header["terms"].items():
+			self.terms[descr_type] = {term: term_no for term_no, term in enumerate(terms)}
+			self.postings[descr_type] = (get_array(descr_type + "/offsets"),
+							get_array(descr_type + "/voices"), get_array(descr_type + "/positions"))
+		self.deleted_docs = set()
+		self.new_voice_docs = []
+		self.new_postings = {}
+		self.updated_opera = set()
+		self.mtime = mtime
+
+	def get_voice_docs(self):
+		if len(self.new_voice_docs) == 0:
+			return self.voice_docs
+		return np.concatenate((self.voice_docs, np.array(self.new_voice_docs, dtype=np.int64)))
+
+	@staticmethod
+	def split_ngrams(descriptor_value):
+		return [ngram for ngram in descriptor_value.split(NGRAM_SEPARATOR) if ngram != ""]
+
+	def remove_opus(self, opus_id):
+		doc = self.doc_numbers.pop(opus_id, None)
+		if doc is not None:
+			self.deleted_docs.add(doc)
+
+	def add_opus(self, opus_id, opus_ref, descriptors):
+		'''
+		   Add (or replace) an opus, given its descriptors as tuples (type, part, voice, value)
+		'''
+		self.remove_opus(opus_id)
+		doc = len(self.opera)
+		self.opera.append([opus_id, opus_ref])
+		self.doc_numbers[opus_id] = doc
+
+		voice_numbers = {}
+		for descr_type, part, voice, value in descriptors:
+			if (part, voice) not in voice_numbers:
+				voice_numbers[(part, voice)] = len(self.voice_docs) + len(self.new_voice_docs)
+				self.new_voice_docs.append(doc)
+			voice_key = voice_numbers[(part, voice)] * POSITION_RANGE
+			type_postings = self.new_postings.setdefault(descr_type, {})
+			for position, ngram in enumerate(NgramIndex.split_ngrams(value)):
+				type_postings.setdefault(ngram, []).append(voice_key + position)
+
+	def update_opera(self, opus_ids):
+		'''
+		   Read again the descriptors of some opera in the DB. The changes
+		   remain in memory until save() is called
+		'''
+		opus_ids = list(opus_ids)
+		self.updated_opera.update(opus_ids)
+		descr_types = list(NgramIndex.SEARCH_DESCRIPTORS.values())
+		for start in range(0, len(opus_ids), UPDATE_CHUNK_SIZE):
+			chunk = opus_ids[start:start + UPDATE_CHUNK_SIZE]
+			# An opus without descriptors is no longer indexed
+			for opus_id in chunk:
+				self.remove_opus(opus_id)
+			rows = Descriptor.objects.filter(opus_id__in=chunk, type__in=descr_types).order_by(
+					"opus_id").values_list("opus_id", "opus__ref", "type", "part", "voice", "value")
+			for (opus_id, opus_ref), opus_rows in itertools.groupby(rows.iterator(), key=lambda row: row[0:2]):
+				self.add_opus(opus_id, opus_ref, [row[2:] for row in opus_rows])
+
+	def refresh(self, opus_ids):
+		'''
+		   Update some opera, and write the index
+		'''
+		self.update_opera(opus_ids)
+		self.save()
+
+	def get_postings(self, descr_type, ngram):
+		'''
+		   The postings of an n-gram (voice number * POSITION_RANGE + position)
+		'''
+		parts = []
+		if ngram in self.terms.get(descr_type, {}):
+			term_no = self.terms[descr_type][ngram]
+			offsets, voices, positions = self.postings[descr_type]
+			start, end = offsets[term_no], offsets[term_no + 1]
+			parts.append(voices[start:end].astype(np.int64) * POSITION_RANGE + positions[start:end])
+		if ngram in self.new_postings.get(descr_type, {}):
+			parts.append(np.array(self.new_postings[descr_type][ngram], dtype=np.int64))
+		if len(parts) == 0:
+			return np.zeros(0, dtype=np.int64)
+		postings = np.concatenate(parts)
+		if len(self.deleted_docs) > 0:
+			docs = self.get_voice_docs()[postings // POSITION_RANGE]
+			postings = postings[~np.isin(docs, list(self.deleted_docs))]
+		return postings
+
+	def find_phrase(self, descr_type, ngrams):
+		'''
+		   The ids of the opera where the n-grams occur at consecutive positions of a voice
+		'''
+		if len(ngrams) == 0:
+			return set()
+		matches = None
+		for i, ngram in enumerate(ngrams):
+			# Where the phrase should start, if the i-th n-gram is there
+			starts = self.get_postings(descr_type, ngram) - i
+			matches = starts if matches is None else np.intersect1d(matches, starts, assume_unique=True)
+			if len(matches) == 0:
+				return set()
+		docs = np.unique(self.get_voice_docs()[matches // POSITION_RANGE])
+		return set(self.opera[doc][0] for doc in docs.tolist())
+
+	@staticmethod
+	def get_phrases(search_context):
+		'''
+		   The n-gram encodings searched for a pattern: the pattern, and its mirror if required
+		'''
+		search_type = search_context.search_type
+		mirror_setting = search_context.is_mirror_search()
+		if search_type == RHYTHMIC_SEARCH:
+			phrases = [search_context.get_rhythmic_pattern()]
+		elif search_type == EXACT_SEARCH:
+			phrases = [search_context.get_notes_pattern()]
+		elif search_type == DIATONIC_SEARCH and mirror_setting:
+			phrases = search_context.get_diatonic_pattern(True)
+		elif search_type == DIATONIC_SEARCH:
+			phrases = [search_context.get_diatonic_pattern()]
+		elif mirror_setting:
+			phrases = search_context.get_melodic_pattern(True)
+		else:
+			phrases = [search_context.get_melodic_pattern()]
+		# An empty string if the pattern is too short
+		if phrases == "":
+			return []
+		return list(phrases)
+
+	def search(self, search_context):
+		'''
+		   Search function: same results as IndexWrapper.search(), without ElasticSearch
+		'''
+		if search_context.keywords == "Keywords":
+			# Sometimes the default text is sent as such
+			search_context.keywords = ''
+
+		print("Search in the n-gram index with corpus '" + search_context.ref
+			   + "'  Keywords: '" + search_context.keywords + "'"
+			   + "'  Pattern: [" + str(search_context.get_pattern_sequence()) + "]")
+
+		opera = Opus.objects.all()
+		# Do we search in a specific corpus?
+		if search_context.ref and search_context.ref != "all":
+			opera = opera.filter(ref__startswith=search_context.ref + settings.NEUMA_ID_SEPARATOR)
+
+		# Do we search for keywords? In titles, composers, refs and lyrics
+		if search_context.keywords:
+			keywords = search_context.keywords
+			opera = opera.filter(Q(title__icontains=keywords) | Q(composer__last_name__icontains=keywords)
+						| Q(ref__icontains=keywords)
+						| Q(descriptor__type=settings.LYRICS_DESCR, descriptor__value__icontains=keywords)).distinct()
+
+		# Do we search a pattern?
+		if search_context.is_pattern_search():
+			descr_type = NgramIndex.SEARCH_DESCRIPTORS.get(search_context.search_type, settings.MELODY_DESCR)
+			opus_ids = set()
+			for phrase in NgramIndex.get_phrases(search_context):
+				opus_ids |= self.find_phrase(descr_type, NgramIndex.split_ngrams(phrase))
+			opera = opera.filter(id__in=opus_ids)
+
+		refs = opera.order_by("ref").values_list("ref", flat=True)
+		return SearchResults(search_context, refs.count(), lambda start, stop: list(refs[start:stop]))
+
+	@contextmanager
+	def write_lock(self):
+		'''
+		   Lock held by the process that writes the index file
+		'''
+		os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+		with open(self.index_path + ".lock", "a") as lock_file:
+			fcntl.flock(lock_file, fcntl.LOCK_EX)
+			try:
+				yield
+			finally:
+				fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+	def merge_written_changes(self):
+		'''
+		   If another process wrote the file since it was loaded (or created
+		   it, if there was no file then), load its version and read again
+		   the opera updated here
+		'''
+		try:
+			mtime = os.stat(self.index_path).st_mtime_ns
+		except FileNotFoundError:
+			return
+		if mtime != self.mtime:
+			updated_opera = self.updated_opera
+			self.load()
+			self.update_opera(updated_opera)
+
+	def save(self, merge=True):
+		'''
+		   Merge the changes with the posting arrays, and write the index file.
+		   With merge=False, the changes written by other processes are lost
+		'''
+		with self.lock, self.write_lock():
+			if merge:
+				self.merge_written_changes()
+			# Renumber the documents and voices that remain
+			live_docs = [doc for doc in range(len(self.opera)) if doc not in self.deleted_docs]
+			doc_map = np.full(len(self.opera), -1, dtype=np.int64)
+			doc_map[live_docs] = np.arange(len(live_docs))
+			voice_docs = doc_map[self.get_voice_docs()]
+			live_voices = voice_docs >= 0
+			voice_map = np.full(len(voice_docs), -1, dtype=np.int64)
+			voice_map[live_voices] = np.arange(np.count_nonzero(live_voices))
+
+			opera = [self.opera[doc] for doc in live_docs]
+			arrays = {"voice_docs": voice_docs[live_voices]}
+			terms = {}
+			for descr_type in set(self.terms.keys()) | set(self.new_postings.keys()):
+				term_numbers = dict(self.terms.get(descr_type, {}))
+				term_parts, posting_parts = [], []
+				if descr_type in self.postings:
+					offsets, voices, positions = self.postings[descr_type]
+					term_parts.append(np.repeat(np.arange(len(offsets) - 1), np.diff(offsets)))
+					posting_parts.append(voices.astype(np.int64) * POSITION_RANGE + positions)
+				for ngram, postings in self.new_postings.get(descr_type, {}).items():
+					if ngram not in term_numbers:
+						term_numbers[ngram] = len(term_numbers)
+					term_parts.append(np.full(len(postings), term_numbers[ngram], dtype=np.int64))
+					posting_parts.append(np.array(postings, dtype=np.int64))
+				if len(posting_parts) == 0:
+					continue
+
+				term_nos = np.concatenate(term_parts)
+				postings = np.concatenate(posting_parts)
+				voices = postings // POSITION_RANGE
+				kept = live_voices[voices]
+				term_nos, voices, positions = term_nos[kept], voice_map[voices[kept]], postings[kept] % POSITION_RANGE
+
+				# N-grams that still occur somewhere, renumbered
+				used_terms = np.unique(term_nos)
+				term_map = np.full(len(term_numbers), -1, dtype=np.int64)
+				term_map[used_terms] = np.arange(len(used_terms))
+				term_nos = term_map[term_nos]
+
+				order = np.lexsort((positions, voices, term_nos))
+				term_nos, voices, positions = term_nos[order], voices[order], positions[order]
+				counts = np.bincount(term_nos, minlength=len(used_terms))
+				ngrams = list(term_numbers.keys())
+				terms[descr_type] = [ngrams[term_no] for term_no in used_terms.tolist()]
+				arrays[descr_type + "/offsets"] = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+				arrays[descr_type + "/voices"] = voices.astype(smallest_dtype(voices.max(initial=0)))
+				arrays[descr_type + "/positions"] = positions.astype(smallest_dtype(positions.max(initial=0)))
+
+			self.write(opera, terms, arrays)
+			self.load()
+		print (f"N-gram index saved in {self.index_path}: {len(opera)} opera")
+
+	def write(self, opera, terms, arrays):
+		header = {"opera": opera, "terms": terms, "arrays": {}}
+		offset = 0
+		blocks = []
+		for name, array in arrays.items():
+			header["arrays"][name] = [offset, array.dtype.str, len(array)]
+			block = array.tobytes()
+			block += b"\0" * padding(len(block))
+			blocks.append(block)
+			offset += len(block)
+
+		json_header = json.dumps(header).encode("utf-8")
+		preamble = MAGIC + PREAMBLE.pack(FORMAT_VERSION, len(json_header)) + json_header
+		preamble += b"\0" * padding(len(preamble))
+
+		os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+		# Write in a temp file, then rename: readers never see a partial index
+		tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+		with open(tmp_path, "wb") as f:
+			f.write(preamble)
+			for block in blocks:
+				f.write(block)
+		os.replace(tmp_path, self.index_path)
@@ -0,0 +1,60 @@
+from collections import deque
+
+
+class PatternMatcher:
+	"""
+		Find all the occurrences of a set of patterns (lists of symbols) in a
+		list of symbols, in a single pass (Aho-Corasick automaton).
+
+		Used for pattern search: the patterns are the encoding of the
+		searched pattern, and possibly of its mirror.
+	"""
+
+	def __init__(self, patterns):
+		self.patterns = patterns
+		# The automaton: transitions, failure links and patterns recognized in each state
+		self.transitions = [{}]
+		self.failures = [0]
+		self.outputs = [[]]
+
+		for pattern_no, pattern in enumerate(patterns):
+			# An empty pattern matches nothing
+			if len(pattern) == 0:
+				continue
+			state = 0
+			for symbol in pattern:
+				if symbol not in self.transitions[state]:
+					self.transitions.append({})
+					self.failures.append(0)
+					self.outputs.append([])
+					self.transitions[state][symbol] = len(self.transitions) - 1
+				state = self.transitions[state][symbol]
+			self.outputs[state].append(pattern_no)
+
+		# Failure links, breadth first: the longest proper suffix that is a prefix of a pattern
+		queue = deque(self.transitions[0].values())
+		while queue:
+			state = queue.popleft()
+			for symbol, next_state in self.transitions[state].items():
+				queue.append(next_state)
+				failure = self.failures[state]
+				while failure != 0 and symbol not in self.transitions[failure]:
+					failure = self.failures[failure]
+				self.failures[next_state] = self.transitions[failure].get(symbol, 0)
+				self.outputs[next_state] = self.outputs[next_state] + self.outputs[self.failures[next_state]]
+
+	def find_all(self, symbols):
+		"""
+			Return the occurrences as a list of tuples (pattern number, first position, last position),
+			sorted by pattern, then by position
+		"""
+		matches = []
+		state = 0
+		for pos, symbol in enumerate(symbols):
+			while state != 0 and symbol not in self.transitions[state]:
+				state = self.failures[state]
+			state = self.transitions[state].get(symbol, 0)
+			for pattern_no in self.outputs[state]:
+				matches.append((pattern_no, pos - len(self.patterns[pattern_no]) + 1, pos))
+		matches.sort()
+		return matches
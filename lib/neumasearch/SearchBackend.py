@@ -0,0 +1,15 @@
+from django.conf import settings
+
+from .constants import NGRAM_BACKEND
+from .IndexWrapper import IndexWrapper
+from .NgramIndex import NgramIndex
+
+
+def get_search_backend():
+	'''
+	   The object that runs the searches, according to settings.SEARCH_BACKEND.
+	   Both have a search(search_context) method with the same results
+	'''
+	if settings.SEARCH_BACKEND == NGRAM_BACKEND:
+		return NgramIndex.get_index()
+	return IndexWrapper()
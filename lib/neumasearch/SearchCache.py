@@ -0,0 +1,79 @@
+from django.conf import settings
+from django.core.cache import cache
+
+import hashlib
+import json
+
+# Cache key of the index generation, bumped each time opera are indexed
+GENERATION_KEY = "neumasearch:generation"
+
+
+class SearchCache:
+	"""
+		Cache of search results, in the Django cache framework.
+
+		Entries are keyed by a hash of the normalized search context, and by the
+		generation of the index: indexing bumps the generation, so the entries
+		computed before are no longer reached (they expire after
+		settings.SEARCH_CACHE_TIMEOUT). The cache must be shared by the processes
+		(e.g., Memcached, Redis or the database) for indexing to invalidate the
+		results seen by the web server.
+	"""
+
+	@staticmethod
+	def get_key(search_context, name):
+		'''
+		   The key of an entry: the name of what is cached, and the search criteria
+		'''
+		keywords = search_context.keywords
+		if keywords == "Keywords":
+			keywords = ""
+		criteria = {"ref": search_context.ref, "search_type": search_context.search_type,
+					"pattern": search_context.pattern, "keywords": keywords,
+					# Not set in a context restored from the session
+					"mirror": bool(getattr(search_context, "mirror_search", False)),
+					"backend": settings.SEARCH_BACKEND, "ranked": settings.ES_RANKED_SEARCH}
+		digest = hashlib.sha1(json.dumps(criteria, sort_keys=True).encode("utf-8")).hexdigest()
+		return f"neumasearch:{name}:{SearchCache.get_generation()}:{digest}"
+
+	@staticmethod
+	def get_generation():
+		generation = cache.get(GENERATION_KEY)
+		if generation is None:
+			cache.add(GENERATION_KEY, 0, timeout=None)
+			generation = cache.get(GENERATION_KEY, 0)
+		return generation
+
+	@staticmethod
+	def bump_generation():
+		'''
+		   Invalidate all the entries. Called when opera are indexed
+		'''
+		try:
+			cache.incr(GENERATION_KEY)
+		except ValueError:
+			# No generation yet
+			cache.add(GENERATION_KEY, 1, timeout=None)
+
+	@staticmethod
+	def get(key):
+		if not settings.SEARCH_CACHE_ENABLED:
+			return None
+		return cache.get(key)
+
+	@staticmethod
+	def set(key, value):
+		if settings.SEARCH_CACHE_ENABLED:
+			cache.set(key, value, timeout=settings.SEARCH_CACHE_TIMEOUT)
+
+	@staticmethod
+	def get_or_set(search_context, name, compute):
+		'''
+		   A value computed for a search context, from the cache if possible
+		'''
+		key = SearchCache.get_key(search_context, name)
+		value = SearchCache.get(key)
+		if value is None:
+			value = compute()
+			SearchCache.set(key, value)
+		return value
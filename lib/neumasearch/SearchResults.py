@@ -0,0 +1,228 @@
+from django.conf import settings
+
+import heapq
+import json
+
+from manager.models import Opus
+from .constants import MELODIC_SEARCH, RHYTHMIC_SEARCH, DIATONIC_SEARCH, EXACT_SEARCH
+from .MusicSummary import MusicSummary
+from .SearchCache import SearchCache
+
+# import the logging library
+import logging
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+# Distance of an opus without occurrence (see MusicSummary.get_best_occurrence)
+NO_DISTANCE = 1000000
+# Nb of opera fetched in one query to rank the hits
+RANKING_CHUNK_SIZE = 500
+
+
+class SearchResults:
+	"""
+		The result list of a search, built one page at a time.
+
+		A search backend gives the number of hits, and a function that returns
+		the refs of the hits in [start, stop). When the list is sliced (by a
+		Paginator), the opera of the slice are fetched in a single query and
+		the matches are located in their summaries: the other hits are never read.
+
+		With ranked search (settings.ES_RANKED_SEARCH), the hits are sorted by
+		distance. The distance of every hit is computed in batch (see
+		MusicSummary.get_best_distance()), and a heap keeps the best ones
+		up to the requested page: only the rows displayed are completed.
+	"""
+
+	def __init__(self, search_context, count, get_refs):
+		self.search_context = search_context
+		self.get_refs = get_refs
+		# Ranking reads every hit: it is not limited to the first ones
+		if self.is_ranked():
+			self.nb_hits = count
+		else:
+			self.nb_hits = min(count, settings.MAX_ITEMS_IN_RESULT)
+		# The best refs found by the last ranking
+		self.top_refs = []
+		self.top_size = 0
+		# What was computed so far: refs of the pages, and matches of the opera
+		self.pages = {}
+		self.matches = {}
+		# Where this state is saved, if the results are cached
+		self.cache_key = None
+
+	@staticmethod
+	def run(backend, search_context):
+		'''
+		   Run a search with a backend, or resume it from the search cache.
+		   Opera seen before are not searched again, and the backend is only
+		   queried for the pages that were not displayed yet
+		'''
+		cache_key = SearchCache.get_key(search_context, "results")
+		state = SearchCache.get(cache_key)
+		if state is None:
+			results = backend.search(search_context)
+		else:
+			logger.info ("Search results found in the cache")
+			results = SearchResults(search_context, state["nb_hits"],
+						lambda start, stop: backend.search(search_context).get_refs(start, stop))
+			for name, value in state.items():
+				setattr(results, name, value)
+		results.cache_key = cache_key
+		return results
+
+	def save(self):
+		if self.cache_key is not None:
+			SearchCache.set(self.cache_key, {"nb_hits": self.nb_hits, "top_refs": self.top_refs,
+							"top_size": self.top_size, "pages": self.pages, "matches": self.matches})
+
+	def count(self):
+		return self.nb_hits
+
+	def __len__(self):
+		return self.count()
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			start, stop, step = index.indices(self.count())
+			return self.get_rows(start, stop)[::step]
+		if index < 0:
+			index += self.count()
+		if index < 0 or index >= self.count():
+			raise IndexError("Search result index out of range")
+		return self.get_rows(index, index + 1)[0]
+
+	def __iter__(self):
+		return iter(self[:])
+
+	def is_ranked(self):
+		return (settings.ES_RANKED_SEARCH and self.search_context.is_pattern_search()
+			and self.search_context.search_type in [MELODIC_SEARCH, RHYTHMIC_SEARCH, DIATONIC_SEARCH])
+
+	def get_rows(self, start, stop):
+		'''
+		   The results in [start, stop): the opera, with their matches
+		'''
+		if start >= stop:
+			return []
+		page = f"{start}:{stop}"
+		if page not in self.pages:
+			if self.is_ranked():
+				self.pages[page] = self.get_top_refs(stop)[start:stop]
+			else:
+				self.pages[page] = self.get_refs(start, stop)
+		refs = self.pages[page]
+
+		opera = {opus.ref: opus for opus in Opus.objects.filter(ref__in=refs)}
+		rows = []
+		for ref in refs:
+			if ref not in opera:
+				logger.warning (f"Opus {ref} found in the index but not in the DB")
+				continue
+			if ref not in self.matches:
+				result = SearchResults.get_opus_result(opera[ref], self.search_context)
+				self.matches[ref] = {"matching_ids": result["matching_ids"], "distance": result["distance"],
+							"best_occurrence": result["best_occurrence"]}
+			rows.append(dict(self.matches[ref], opus=opera[ref]))
+		self.save()
+		return rows
+
+	def get_top_refs(self, nb_refs):
+		'''
+		   The nb_refs refs with the smallest distances, sorted
+		'''
+		if self.top_size < nb_refs:
+			pattern_sequence = self.search_context.get_pattern_sequence()
+			refs = self.get_refs(0, self.nb_hits)
+			# Bounded heap of (-distance, -rank, ref): the worst kept hit is on top
+			heap = []
+			for start in range(0, len(refs), RANKING_CHUNK_SIZE):
+				ranks = {ref: start + i for i, ref in enumerate(refs[start:start + RANKING_CHUNK_SIZE])}
+				for opus in Opus.objects.filter(ref__in=ranks.keys()).only("ref", "summary"):
+					distance = SearchResults.get_opus_distance(opus, pattern_sequence, self.search_context)
+					# For equal distances, the order of the backend is kept
+					hit = (-distance, -ranks[opus.ref], opus.ref)
+					if len(heap) < nb_refs:
+						heapq.heappush(heap, hit)
+					elif hit > heap[0]:
+						heapq.heapreplace(heap, hit)
+			top_hits = sorted(heap, reverse=True)
+			self.top_refs = [ref for distance, rank, ref in top_hits]
+			self.top_size = nb_refs
+		return self.top_refs
+
+	@staticmethod
+	def get_opus_distance(opus, pattern_sequence, search_context):
+		'''
+		   Distance between the pattern and its best occurrence in an opus
+		'''
+		if not opus.summary:
+			logger.warning("No summary for Opus " + opus.ref)
+			return NO_DISTANCE
+		msummary = MusicSummary.load(opus.summary.path)
+		return msummary.get_best_distance(pattern_sequence, search_context.search_type,
+								search_context.is_mirror_search())
+
+	@staticmethod
+	def find_lyrics_ids(opus, keywords):
+		'''
+		   Ids of the elements whose lyrics contain the keywords (the
+		   result list and the page of an opus highlight them)
+		'''
+		matching_ids = []
+		score = opus.get_score()
+		for voice in score.get_all_voices():
+			#get lyrics of the current voice
+			curr_lyrics = voice.get_lyrics()
+			if curr_lyrics != None and keywords in curr_lyrics:
+				occurrences, curr_matching_ids = voice.search_in_lyrics(keywords)
+				if occurrences > 0:
+					matching_ids.extend(curr_matching_ids)
+		return matching_ids
+
+	@staticmethod
+	def get_opus_result(opus, search_context):
+		'''
+		   Locate the matches of a search in an opus. Returns a row of the
+		   result list, with the ids of matching elements and the distance
+		   of the best occurrence
+		'''
+		matching_ids = []
+		distance = 0
+		best_occurrence = None
+		# Find the occurrences in MusicSummary, if search type is pattern search
+		# Using MusicSummary to locate hits in the results returned by elasticsearch
+		if search_context.is_pattern_search():
+			if opus.summary:
+				msummary = MusicSummary.load(opus.summary.path)
+
+				pattern_sequence = search_context.get_pattern_sequence()
+
+				#No mirror search mode for exact search
+				if search_context.search_type == EXACT_SEARCH:
+					mirror_setting = False
+
+				if search_context.search_type == MELODIC_SEARCH or search_context.search_type == DIATONIC_SEARCH or search_context.search_type == RHYTHMIC_SEARCH:
+					#return the sequences that match and the distances
+					mirror_setting = search_context.is_mirror_search()
+
+					# Find the occurrences of matches within the opus, 
+					# and measure the melodic or rhythmic distance depending on context
+					# If there is more than one match in an opus,
+					# we only take the distance between the best match(with least distance with the query)
+					# The "best_occurrence" here should be a pattern sequence.
+					best_occurrence, distance = msummary.get_best_occurrence(pattern_sequence, search_context.search_type, mirror_setting)
+					logger.info ("Found best occurrence : " + str(best_occurrence) + " with distance " + str(distance))
+
+				#Find matching ids for the matches to highlight
+				matching_ids = msummary.find_matching_ids(pattern_sequence, search_context.search_type, mirror_setting)
+			else:
+				logger.warning("No summary for Opus " + opus.ref)
+		#If search by keywords
+		elif search_context.is_keyword_search():
+			# No occurrence nor distance: the matches are located in the lyrics
+			best_occurrence = ""
+			distance = 0
+			matching_ids = SearchResults.find_lyrics_ids(opus, search_context.keywords)
+		return {"opus": opus, "matching_ids": json.dumps(matching_ids), "distance": distance, "best_occurrence": str(best_occurrence)}
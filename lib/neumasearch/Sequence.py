@@ -3,13 +3,24 @@ import jsonpickle
 import string
 from fractions import Fraction
 from .Distance_neuma import *
+from .PatternMatcher import PatternMatcher
 
 from .constants import MELODIC_SEARCH,RHYTHMIC_SEARCH,EXACT_SEARCH,DIATONIC_SEARCH
 import music21 as m21
+import numpy as np
 
 INTERVAL_SEPARATOR = "|"
 DURATION_UNIT = 16
 
+# Position of steps on the staff, in an octave
+STAFF_STEPS = {"C": 0, "D": 1, "E": 2, "F": 3, "G": 4, "A": 5, "B": 6}
+# Semitones from A, for each step on the staff
+STEP_SEMITONES = np.array([-9, -7, -5, -4, -2, 0, 2])
+# Name of a diatonic interval, from its number of staff steps modulo 7: the
+# generic interval of music21, reduced to an octave. Unisons (augmented, since
+# repeated notes are ignored) and octaves count as seconds
+DIATONIC_NAMES = np.array(['2', '2', '3', '4', '5', '6', '7'])
+
 
 class Sequence:
     """
@@ -19,7 +30,20 @@ class Sequence:
     def __init__(self):
         # A sequence is a list of music items
         self.items = []
+        # The items as arrays (see get_arrays), computed on demand
+        self.arrays = None
+        # Symbols for each type of search (see get_symbols), computed on demand
+        self.symbols = {}
         return
+
+    def __getstate__(self):
+        # Only the items are serialized
+        return {"items": self.items}
+
+    def __setstate__(self, state):
+        self.items = state["items"]
+        self.arrays = None
+        self.symbols = {}
         
     def decode(self, json_obj):
         """
@@ -36,6 +60,8 @@ class Sequence:
  
     def add_item(self, item):
         self.items.append(item)
+        self.arrays = None
+        self.symbols = {}
     
     def get_items_from_sequence(self):
         return self.items
@@ -76,47 +102,37 @@ class Sequence:
             Rhythms are encoded as a list of objects (dict). Each object
             contains the pos of the first event, the pos of the last event,
             and the interval value.
+
+            Events without duration (grace notes) are ignored, and do not
+            count in positions. Rests get the value -1, so that they disrupt
+            a consecutive "rhythm pattern".
         '''
+        values, pitch_changes = self.get_rhythm_values()
         rhythms = []
-        previous_item = None
-        # Scan the items
-        i_pos = 0
-        current_pos = i_pos
-
-        for item in self.items:
-                        
-            if previous_item is None:
-                previous_item = item
-            else:
-                # Prevent division by zero
-                if item.duration == 0 or previous_item.duration == 0:
-                    continue
-                if item.get_index() == previous_item.get_index():
-                    pitch_change = False
-                else:
-                    pitch_change = True
-
-                #gap is the ratio between the current note length and the previous one
-
-                gap = Fraction(Fraction.from_float(item.duration), Fraction.from_float(previous_item.duration)).limit_denominator(max_denominator=10000)
-
-                rhythm = {"start_pos": str(current_pos), "end_pos": str(i_pos), 
-                          "value": str(gap), "pitch_change": pitch_change}
-
-                if item.is_rest != True:
-                    rhythms.append(rhythm)
-                else:
-                    rhythm = {"start_pos": str(current_pos), "end_pos": str(i_pos), 
-                          "value": str(-1), "pitch_change": pitch_change}
-                    #Set value to -1, to make sure that the rest is not ignored, and it disrupts a consecutive "rhythm pattern"
-                    rhythms.append(rhythm)
-
-                previous_item = item
-                current_pos = i_pos
-            i_pos += 1
-
+        for pos in range(len(values)):
+            rhythms.append({"start_pos": str(pos), "end_pos": str(pos + 1),
+                    "value": values[pos], "pitch_change": pitch_changes[pos]})
         return rhythms
 
+    def get_rhythm_values(self):
+        '''
+            Values and pitch changes of the rhythms, in batch
+        '''
+        arrays = self.get_arrays()
+        kept = Sequence.get_timed_events(arrays["duration"] != 0)
+        if len(kept) < 2:
+            return [], []
+        durations = arrays["duration"][kept]
+        pitches = arrays["pitch"][kept]
+
+        # The gap is the ratio between the current note length and the previous one
+        gaps = Sequence.map_pairs(durations[1:], durations[:-1],
+            lambda d, prev_d: str(Fraction(Fraction.from_float(d),
+                     Fraction.from_float(prev_d)).limit_denominator(max_denominator=10000)))
+        is_rest = arrays["is_rest"][kept][1:].tolist()
+        values = ["-1" if rest else gap for rest, gap in zip(is_rest, gaps)]
+        return values, (pitches[1:] != pitches[:-1]).tolist()
+
     def get_exact_rhythms(self):
         '''
         Some modification on get_rhythms() to encode note lengths instead of ratio between notes.
@@ -175,124 +191,119 @@ class Sequence:
             contains the pos of the first event, the pos of the last event,
             and the interval value.
 
-            The list "diatonic_intervals" stores diatonic intervals(for example, an ascending fifth is a diatonic interval),
-            while the list "intervals" stores the number of semitones as value.
+            With the diatonic descriptor, the value is the diatonic interval
+            (for example, an ascending fifth), reduced to no more than an octave.
+            Otherwise, the value is the number of semitones.
         """
-        dict_wordtonum = {"Unison": '2', "Second": '2', "Third": '3', "Fourth": '4', "Fifth": '5', "Sixth": '6', "Seventh": '7'}
-        #P.S.: Unison as "2" instead of "0" for a reason, see explanation later
         intervals = []
-        diatonic_intervals = []
-        previous_item = None
-        # Scan the items
-        i_pos = 0
-        current_pos = i_pos
-        for item in self.items:
-            # We ignore rests
-            if item.is_rest: 
-                # If the rest is a full measure, part of a multi-measure rest: we need to adjust
-                i_pos += 1
-                continue
-
-            if previous_item is None:
-                previous_item = item
-            else:
-                # Compute the number of semi-tones
-                gap = item.get_index() - previous_item.get_index()
-
-                if gap != 0:
-                    #if we find a new note with different pitch
-                    if gap > 0:
-                        #if the semi-tone difference between the current and the previous item > 0, then it is an ascending interval
-                        direction = 'A'
-                    else:
-                        #otherwise, it is a descending interval.
-                        direction = 'D'
-
-                    if descriptor == settings.DIATONIC_DESCR:
-                        """
-                        Get diatonic interval name via music21, and store as a dictionary. 
-                        Each object contains the position of the first event, the position of the last event,
-                        and diatonic interval name. The interval is reduced to no more than an octave.
-
-                        P.S:
-                        For obtaining original interval name(not reduced to an octave), may change "directedsimpleNiceName" to "niceName".
-                        For not getting the direction info(descending or ascending), may change "directedSimpleNiceName" to "simpleNiceName".
-                        """
-
-                        #Transfer items to music21 note objects
-                        m21_item = item.get_music21_note()
-                        m21_pre_item = previous_item.get_music21_note()
-
-                        #Calculate interval with music21
-                        """
-                            "directedSimpleNiceName" examples: "Descending Doubly-Diminished Fifth", "Ascending Perfect Fourth", "Ascending Doubly-Augmented Fourth"
-                            "simpleName" examples: dd5, P5, AA4. There's no direction information
-                            Since the program only executes here when a new note with different pitch is detected, the "unison" here should be an augmented unison, a.k.a minor second
-                        """
-                        m21_interval_directed = m21.interval.Interval(noteStart=m21_pre_item, noteEnd=m21_item).directedSimpleNiceName
-                        
-                        arr_diatonic = m21_interval_directed.split(" ")
-                        """
-                        #This part is no longer necessary because we could tell direction by gap value                            
-                        if arr_diatonic[0] == "Ascending": direction = 'A'
-                        elif arr_diatonic[0] == "Descending": direction = 'D'
-                        else: direction = ''
-                        """
-                        m21_generic = dict_wordtonum[arr_diatonic[-1]]
-                        #m21_generic_interval = m21.interval.GenericInterval(arr_diatonic[-1])
-
-                        m21_interval = m21_generic + direction
-
-                        dia_interval = {"start_pos": current_pos, "end_pos": i_pos, "value": m21_interval}
-                        diatonic_intervals.append(dia_interval)
-
-
-                    # For getting semitone numbers of the current interval
-                    num_interval = str(abs(gap)) + direction
-                    interval = {"start_pos": current_pos, "end_pos": i_pos, "value": num_interval}
-                    intervals.append(interval)
-
-                    previous_item = item
-                    current_pos = i_pos
+        for start, end, value in zip(*self.get_interval_values(descriptor)):
+            intervals.append({"start_pos": start, "end_pos": end, "value": value})
+        return intervals
 
-            i_pos += 1
+    def get_interval_values(self, descriptor=settings.MELODY_DESCR):
+        """
+            Start positions, end positions and values of the intervals, in batch
+        """
+        arrays = self.get_arrays()
+        notes = np.flatnonzero(~arrays["is_rest"])
+        if len(notes) < 2:
+            return [], [], []
+        gaps = np.diff(arrays["pitch"][notes])
+        # Repeated notes are ignored
+        changes = np.flatnonzero(gaps != 0)
+        gaps = gaps[changes]
+        end_pos = notes[changes + 1]
+        # An interval starts where the previous one ends (the first one, at 0)
+        start_pos = np.concatenate(([0], end_pos[:-1]))
+        # ...but it is measured from the first note, for the first one
+        from_pos = np.concatenate((notes[:1], end_pos[:-1]))
 
         if descriptor == settings.DIATONIC_DESCR:
-            #by diatonic interval names
-            return diatonic_intervals
+            staff_steps = np.abs(arrays["staff"][end_pos] - arrays["staff"][from_pos]) % 7
+            values = DIATONIC_NAMES[staff_steps].tolist()
         else:
-            #by number of semitones
-            return intervals
+            values = np.abs(gaps).astype(str).tolist()
+        # Ascending or descending
+        directions = np.where(gaps > 0, 'A', 'D').tolist()
+        return start_pos.tolist(), end_pos.tolist(), [value + direction for value, direction in zip(values, directions)]
 
     def get_notes(self):
         #Get notes for exact search
         notes = []
-        previous_item = None
-        # Scan the items
-        i_pos = 0
-        current_pos = i_pos
-        for item in self.items:
-            if previous_item is None:
-                previous_item = item
-            else:
-                # Prevent division by zero
-                item_duration = Fraction.from_float(item.duration).limit_denominator(max_denominator=100)
-                previous_item_duration = Fraction.from_float(previous_item.duration).limit_denominator(max_denominator=100)
-                if item_duration == 0 or previous_item_duration == 0:
-                    continue
-                rhythm = Fraction(item_duration, previous_item_duration).limit_denominator(max_denominator=100)
-                pitch_temp = item.get_index() - previous_item.get_index()
-                if pitch_temp > 0:
-                    pitch = str(pitch_temp)+'A'
-                else:
-                    pitch = str(abs(pitch_temp))+'D'
-                note = {"start_pos": str(current_pos), "end_pos": str(i_pos), "rhythm": str(rhythm), "pitch": str(pitch)}
-                notes.append(note)
-                previous_item = item
-                current_pos = i_pos
-            i_pos += 1
+        pitches, rhythms = self.get_note_values()
+        for pos in range(len(pitches)):
+            notes.append({"start_pos": str(pos), "end_pos": str(pos + 1), "rhythm": rhythms[pos], "pitch": pitches[pos]})
         return notes
 
+    def get_note_values(self):
+        """
+            Pitch intervals and duration ratios of the notes, in batch
+        """
+        arrays = self.get_arrays()
+        # Durations are approximated by fractions, computed once per distinct duration
+        durations, duration_codes = np.unique(arrays["duration"], return_inverse=True)
+        duration_codes = duration_codes.reshape(-1)
+        fractions = [Fraction.from_float(d).limit_denominator(max_denominator=100) for d in durations.tolist()]
+        is_timed = np.array([f != 0 for f in fractions], dtype=bool)[duration_codes]
+
+        kept = Sequence.get_timed_events(is_timed)
+        if len(kept) < 2:
+            return [], []
+        duration_codes = duration_codes[kept]
+        rhythms = Sequence.map_pairs(duration_codes[1:], duration_codes[:-1],
+            lambda d, prev_d: str(Fraction(fractions[d], fractions[prev_d]).limit_denominator(max_denominator=100)))
+        pitches = []
+        for gap in np.diff(arrays["pitch"][kept]).tolist():
+            if gap > 0:
+                pitches.append(str(gap) + 'A')
+            else:
+                pitches.append(str(abs(gap)) + 'D')
+        return pitches, rhythms
+
+    def get_arrays(self):
+        """
+            The items as NumPy arrays, for batch computations: pitch index,
+            staff position (diatonic step + 7 * octave), duration and rest flag
+        """
+        if self.arrays is None or len(self.arrays["pitch"]) != len(self.items):
+            self.symbols = {}
+            items = self.items
+            steps = np.array([STAFF_STEPS[item.step] for item in items], dtype=np.int64)
+            octaves = np.array([item.octave for item in items], dtype=np.int64)
+            alterations = np.array([item.alteration for item in items], dtype=np.int64)
+            self.set_arrays(steps, octaves, alterations,
+                        np.array([item.duration for item in items], dtype=np.float64),
+                        np.array([item.is_rest for item in items], dtype=bool))
+        return self.arrays
+
+    def set_arrays(self, steps, octaves, alterations, durations, is_rest):
+        # Same pitch index as Item.get_index()
+        self.arrays = {"pitch": octaves * 12 + STEP_SEMITONES[steps] + alterations,
+                       "staff": steps + 7 * octaves, "duration": durations, "is_rest": is_rest}
+
+    @staticmethod
+    def get_timed_events(is_timed):
+        """
+            Positions of the events kept for rhythms: events without duration
+            are ignored, except the first one. If the first one has no duration,
+            nothing is kept.
+        """
+        if len(is_timed) == 0 or not is_timed[0]:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(([0], np.flatnonzero(is_timed[1:]) + 1))
+
+    @staticmethod
+    def map_pairs(values, prev_values, function):
+        """
+            Apply a function to each pair (values[i], prev_values[i]). The function
+            is called once per distinct pair: a voice has few distinct durations.
+        """
+        if len(values) == 0:
+            return []
+        pairs, pair_codes = np.unique(np.stack((values, prev_values), axis=1), axis=0, return_inverse=True)
+        results = [function(value, prev_value) for value, prev_value in pairs.tolist()]
+        return [results[code] for code in pair_codes.reshape(-1).tolist()]
+
     @staticmethod
     def get_intervals_as_list(intervals):
         """
@@ -319,62 +330,71 @@ class Sequence:
     
     def find_positions(self, pattern, search_type, mirror_setting = False):
         """
-         Find the position(s) of a pattern in the sequence
-         p_intervals: the encoded pattern to search for
-         s_intervals: all the intervals/sequences from each voice
-         m_intervals: mirror pattern of the original pattern
-         the goal is to find p_intervals_list in s_intervals_list
+         Find the position(s) of a pattern in the sequence. Returns the
+         ranges of items of each occurrence: occurrences of the pattern
+         first, then of its mirror when mirror_setting is True
         """
-        occurrences = []
-
-        if search_type == RHYTHMIC_SEARCH:
-            p_intervals = pattern.get_rhythms()
-            s_intervals = self.get_rhythms()
-            m_intervals = ""
-
-        elif search_type == MELODIC_SEARCH:
-            p_intervals = pattern.get_intervals(settings.MELODY_DESCR)
-            m_intervals = pattern.get_mirror_intervals(p_intervals)
-            s_intervals = self.get_intervals(settings.MELODY_DESCR)
+        matcher = PatternMatcher(pattern.get_search_patterns(search_type, mirror_setting))
+        return self.find_occurrences(matcher, search_type)
 
-        elif search_type == EXACT_SEARCH:
-            p_intervals = pattern.get_notes()
-            s_intervals = self.get_notes()
-
-        elif search_type == DIATONIC_SEARCH:
-            p_intervals = pattern.get_intervals(settings.DIATONIC_DESCR)
-            m_intervals = pattern.get_mirror_intervals(p_intervals)
-            s_intervals = self.get_intervals(settings.DIATONIC_DESCR)
-        else:
-            #if search type is not defined, default setting is melody search
-            p_intervals = pattern.get_intervals(settings.MELODY_DESCR)
-            s_intervals = self.get_intervals(settings.MELODY_DESCR)
-
-        # Get intervals as list, e.g. ['2', '2', '2']
-        if search_type == EXACT_SEARCH:
-            p_intervals_list = self.notes_to_symbols(p_intervals)
-            s_intervals_list = self.notes_to_symbols(s_intervals)
-        else:
-            p_intervals_list = pattern.get_intervals_as_list(p_intervals)
-            m_intervals_list = pattern.get_intervals_as_list(m_intervals)
-            s_intervals_list = pattern.get_intervals_as_list(s_intervals)
-        
-        # Find patterns positions in list
-        occurrences_indexes = self.find_sub_list(p_intervals_list, s_intervals_list)
+    def find_occurrences(self, matcher, search_type):
+        """
+         Run a matcher on the symbols of the sequence. The symbols are computed
+         once for each search type, and a single pass finds all the occurrences
+        """
+        symbols, start_pos, end_pos = self.get_symbols(search_type)
+        occurrences = []
+        for pattern_no, first, last in matcher.find_all(symbols):
+            occurrences.append(range(start_pos[first], end_pos[last] + 1))
+        return occurrences
 
-        #If it is mirror search, the function also finds the positions of mirror patterns
-        if mirror_setting == True:
-            mirror_occ_indexes = self.find_sub_list(m_intervals_list, s_intervals_list)
+    def get_search_patterns(self, search_type, mirror_setting = False):
+        """
+         The symbols of a pattern, and of its mirror for melodic and
+         diatonic searches, if required
+        """
+        symbols = self.get_symbols(search_type)[0]
+        if mirror_setting and search_type in (MELODIC_SEARCH, DIATONIC_SEARCH):
+            return [symbols, [Sequence.get_mirror_value(value) for value in symbols]]
+        return [symbols]
 
-            #Add mirror pattern occurrences into occurrences_indexes
-            for occ in mirror_occ_indexes:
-                occurrences_indexes.append(occ)
-        
-        for tuple in occurrences_indexes:
-            # Get start and end positions
-            occurrences.append(range(int(s_intervals[tuple[0]]["start_pos"]), int(s_intervals[tuple[1]]["end_pos"]) + 1))
+    def get_symbols(self, search_type):
+        """
+         The symbols for a type of search, e.g. ['2A', '2A', '3D'] for a
+         melodic search, with the positions of the first and last item of each symbol
+        """
+        # Forgets the symbols if the items changed
+        self.get_arrays()
+        if search_type not in self.symbols:
+            if search_type == RHYTHMIC_SEARCH:
+                values = self.get_rhythm_values()[0]
+                start_pos = list(range(len(values)))
+                end_pos = list(range(1, len(values) + 1))
+            elif search_type == EXACT_SEARCH:
+                pitches, rhythms = self.get_note_values()
+                # Same symbols as notes_to_symbols()
+                values = ['(' + pitch + '|' + rhythm + ')' for pitch, rhythm in zip(pitches, rhythms)]
+                start_pos = list(range(len(values)))
+                end_pos = list(range(1, len(values) + 1))
+            elif search_type == DIATONIC_SEARCH:
+                start_pos, end_pos, values = self.get_interval_values(settings.DIATONIC_DESCR)
+            else:
+                #if search type is not defined, default setting is melody search
+                start_pos, end_pos, values = self.get_interval_values(settings.MELODY_DESCR)
+            self.symbols[search_type] = (values, start_pos, end_pos)
+        return self.symbols[search_type]
 
-        return occurrences
+    @staticmethod
+    def get_mirror_value(value):
+        """
+         Change the direction of an interval: "2A" becomes "2D", and conversely
+        """
+        mirror_dir = ''
+        if value[-1] == 'A':
+            mirror_dir = 'D'
+        elif value[-1] == 'D':
+            mirror_dir = 'A'
+        return value[:-1] + mirror_dir
 
     def get_mirror_intervals(self, intervals):
         """
@@ -389,20 +409,9 @@ class Sequence:
         mirror_intervals = []
 
         for i in intervals:
-            #Get the original intervals one by one
-            curr_start_pos = i["start_pos"]
-            curr_end_pos = i["end_pos"]
-            curr_value = i["value"]
-            
-            mirror_dir = ''
-            if curr_value[-1] == 'A':
-                mirror_dir = 'D'
-            elif curr_value[-1] == 'D':
-                mirror_dir = 'A'
-            #Change the direction of the interval
-            mirror_value = curr_value[:-1] + mirror_dir
-
-            mirror_interval = {"start_pos": curr_start_pos, "end_pos": curr_end_pos, "value": mirror_value}
+            #Get the original intervals one by one, and change their direction
+            mirror_interval = {"start_pos": i["start_pos"], "end_pos": i["end_pos"],
+                               "value": Sequence.get_mirror_value(i["value"])}
             mirror_intervals.append(mirror_interval)
 
         return mirror_intervals
@@ -417,12 +426,11 @@ class Sequence:
             Please find definition of "mirror patterns" in description of get_mirror_intervals()
 
         """
-        melody_list = self.get_intervals(settings.MELODY_DESCR)
-        melody_encoding = self.intervals_to_ngrams(melody_list, NGRAM_SIZE)
-
         if mirror_setting == False:
-            return melody_encoding
+            return self.values_to_ngrams(self.get_interval_values(settings.MELODY_DESCR)[2], NGRAM_SIZE)
         elif mirror_setting == True:
+            melody_list = self.get_intervals(settings.MELODY_DESCR)
+            melody_encoding = self.intervals_to_ngrams(melody_list, NGRAM_SIZE)
             mirror_melody = self.get_mirror_intervals(melody_list)
             return melody_encoding, self.intervals_to_ngrams(mirror_melody)
 
@@ -434,12 +442,11 @@ class Sequence:
             this function returns the original diatonic encodings, and the mirrored diatonic encodings, both as a list of n-grams.
 
         """
-        dia_list = self.get_intervals(settings.DIATONIC_DESCR)
-        dia_encoding = self.intervals_to_ngrams(dia_list, NGRAM_SIZE)
-
         if mirror_setting == False:
-            return dia_encoding
+            return self.values_to_ngrams(self.get_interval_values(settings.DIATONIC_DESCR)[2], NGRAM_SIZE)
         elif mirror_setting == True:
+            dia_list = self.get_intervals(settings.DIATONIC_DESCR)
+            dia_encoding = self.intervals_to_ngrams(dia_list, NGRAM_SIZE)
             mirror_dia = self.get_mirror_intervals(dia_list)
             return dia_encoding, self.intervals_to_ngrams(mirror_dia)
 
@@ -447,15 +454,18 @@ class Sequence:
         """
             Get rhythm and decompose in ngram text for rhythmic search
         """
-        rhythm_encoding = self.rhythms_to_ngrams(self.get_rhythms(), NGRAM_SIZE)
-        return rhythm_encoding
+        values, pitch_changes = self.get_rhythm_values()
+        # Surround ratios with parentheses
+        return Sequence.join_ngrams(["(" + value + ")" for value in values], NGRAM_SIZE)
 
     def get_note_encoding(self, NGRAM_SIZE = 3):
         """
             Get note and decompose in ngram text for exact search
         """
-        note_encoding = self.to_ngrams(self.notes_to_symbols(self.get_notes()), NGRAM_SIZE)
-        return note_encoding
+        pitches, rhythms = self.get_note_values()
+        # Same symbols as notes_to_symbols()
+        symbols = ['(' + pitch + '|' + rhythm + ')' for pitch, rhythm in zip(pitches, rhythms)]
+        return Sequence.join_ngrams(symbols)
 
     """
     def rhythms_to_symbols(self, dict):
@@ -482,45 +492,30 @@ class Sequence:
         #
         #   Splits rhythms ratios into ngrams with size NGRAM_SIZE, e.g : (3/4)(2/3)(1/2) (2/3)(1/2)(1/2) ...
         #
-        nb_codes = len(dict)
-        text = ""
-        for i in range(nb_codes - NGRAM_SIZE + 1):
-            ngram = ""
-            for j in range(i, i + NGRAM_SIZE):
-                # Surround ratios with parentheses
-                ngram += "(" + str(dict[j]["value"]) + ")"
-            text += ngram + " N "
-        return text
+        # Surround ratios with parentheses
+        codes = ["(" + str(rhythm["value"]) + ")" for rhythm in dict]
+        return Sequence.join_ngrams(codes, NGRAM_SIZE)
 
     def intervals_to_ngrams(self, dict, NGRAM_SIZE = 3):
         #
         #   Splits intervals into ngrams with size NGRAM_SIZE, for both melodic and diatonic searches
         #
-        nb_codes = len(dict)
-        phrase = ""
-        for i in range(nb_codes - NGRAM_SIZE + 1):
-            #ngram no longer needs to begin with a separator ';' because it's absolute value
-            ngram = ""
-            for j in range(i, i + NGRAM_SIZE): 
-                ngram = ngram + str(dict[j]["value"]) + ";"
-            phrase += ngram + " N "
-        return phrase
+        #ngram no longer needs to begin with a separator ';' because it's absolute value
+        return self.values_to_ngrams([interval["value"] for interval in dict], NGRAM_SIZE)
+
+    def values_to_ngrams(self, values, NGRAM_SIZE = 3):
+        return Sequence.join_ngrams([str(value) + ";" for value in values], NGRAM_SIZE)
 
     def to_ngrams(self, symbols, hash=False, NGRAM_SIZE = 3):
         #
         #   Splits symbol list into ngrams with size NGRAM_SIZE, used for exact search
         #
-        nb_codes = len(symbols)
-        phrase = ""
-        for i in range(nb_codes - NGRAM_SIZE + 1):
-            ngram = ""
-            for j in range(i, i + NGRAM_SIZE):
-                ngram = ngram + str(symbols[j]) + ""
-            #if hash:
-            #    phrase += self.hash_ngrams(ngram) + " "
-            else:
-                phrase += ngram + " N "
-        return phrase
+        return Sequence.join_ngrams([str(symbol) for symbol in symbols], NGRAM_SIZE)
+
+    @staticmethod
+    def join_ngrams(codes, NGRAM_SIZE = 3):
+        # Each ngram is followed by the " N " separator
+        return "".join(["".join(codes[i:i + NGRAM_SIZE]) + " N " for i in range(len(codes) - NGRAM_SIZE + 1)])
     """
     @staticmethod
     def hash_ngrams(ngram):
@@ -536,17 +531,6 @@ class Sequence:
             hashed = hashed.replace(c1, c2)
         return hashed
     """
-    @staticmethod
-    def find_sub_list(sub_list, l):
-        # Find sublists in list
-        # Returns a list of the first and last indexes of the matching sublists
-        results = []
-        sll = len(sub_list)
-        for ind in (i for i, e in enumerate(l) if e == sub_list[0]):
-            if l[ind:ind + sll] == sub_list:
-                results.append((ind, ind + sll - 1))
-        return results
-
     def __str__(self):
         s = ""
         sep = ""
@@ -0,0 +1,187 @@
+import json
+import mmap
+import struct
+
+import numpy as np
+
+from .Item import Item
+from .Sequence import Sequence
+
+# import the logging library
+import logging
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+'''
+  Compact binary storage of music summaries.
+
+  Layout of a file:
+    - the magic string, the format version and the size of the header
+    - a JSON header: opus id, and for each voice the position of its
+      items and of its id table in the data section
+    - the data section: for each voice, an array of fixed-size records
+      (see ITEM_DTYPE) followed by the ids of the items, UTF-8, one per line
+
+  The file is memory-mapped when read, and a voice is decoded only when
+  it is accessed.
+'''
+
+MAGIC = b"NMSB"
+# Bump if the layout changes. Files with another version are ignored
+FORMAT_VERSION = 1
+# Version (unsigned short) and header size (unsigned int)
+PREAMBLE = struct.Struct("<HI")
+# Blocks of the data section are aligned on this size
+ALIGNMENT = 8
+
+# One record per item
+ITEM_DTYPE = np.dtype([("duration", "<f8"), ("pitch", "<i2"), ("step", "i1"),
+					("octave", "i1"), ("alteration", "i1"), ("flags", "u1")])
+# Bits of the flags field
+FLAG_REST = 1
+FLAG_TIED = 2
+
+STEPS = "CDEFGAB"
+# Same values as Item.get_index()
+STEP_OFFSETS = {"A": 0, "B": 2, "C": -9, "D": -7, "E": -5, "F": -4, "G": -2}
+
+
+def padding(size):
+	return (ALIGNMENT - size % ALIGNMENT) % ALIGNMENT
+
+
+class SummaryFile:
+	"""
+		Read and write music summaries in the binary format
+	"""
+
+	@staticmethod
+	def encode(music_summary):
+		'''
+		   Produce the binary representation of a music summary
+		'''
+		header = {"opus_id": music_summary.opus_id, "parts": {}}
+		blocks = []
+		offset = 0
+		for part_id, part in music_summary.parts.items():
+			header["parts"][part_id] = {}
+			for voice_id, voice in part.items():
+				records = SummaryFile.to_records(voice.items)
+				ids = "\n".join(str(item.id) for item in voice.items).encode("utf-8")
+				header["parts"][part_id][voice_id] = {"offset": offset, "count": len(records),
+										"ids_offset": offset + records.nbytes, "ids_size": len(ids)}
+				block = records.tobytes() + ids
+				block += b"\0" * padding(len(block))
+				blocks.append(block)
+				offset += len(block)
+
+		json_header = json.dumps(header).encode("utf-8")
+		preamble = MAGIC + PREAMBLE.pack(FORMAT_VERSION, len(json_header)) + json_header
+		preamble += b"\0" * padding(len(preamble))
+		return preamble + b"".join(blocks)
+
+	@staticmethod
+	def to_records(items):
+		records = np.zeros(len(items), dtype=ITEM_DTYPE)
+		for i, item in enumerate(items):
+			# Music21 leaves the octave undefined when it is implicit
+			octave = item.octave if item.octave is not None else 4
+			flags = 0
+			if item.is_rest:
+				flags |= FLAG_REST
+			if item.tied:
+				flags |= FLAG_TIED
+			records[i] = (item.duration, octave * 12 + STEP_OFFSETS[item.step] + item.alteration,
+						STEPS.index(item.step), octave, item.alteration, flags)
+		return records
+
+	@staticmethod
+	def read(file_path, music_summary):
+		'''
+		   Map a binary file and attach its (not yet decoded) voices to a
+		   music summary. Returns False if the file is not in the binary format
+		'''
+		with open(file_path, "rb") as f:
+			if f.read(len(MAGIC)) != MAGIC:
+				return False
+			version, header_size = PREAMBLE.unpack(f.read(PREAMBLE.size))
+			if version != FORMAT_VERSION:
+				logger.warning (f"Summary {file_path} has format version {version}, expected {FORMAT_VERSION}")
+				return False
+			header = json.loads(f.read(header_size).decode("utf-8"))
+			# The mapping remains valid once the file is closed
+			buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+		data_start = len(MAGIC) + PREAMBLE.size + header_size
+		data_start += padding(data_start)
+
+		music_summary.opus_id = header["opus_id"]
+		for part_id, voices in header["parts"].items():
+			music_summary.parts[part_id] = LazyVoices(buffer, data_start, voices)
+		return True
+
+	@staticmethod
+	def decode_voice(buffer, data_start, voice):
+		'''
+		   Decode the items of a voice
+		'''
+		records = np.frombuffer(buffer, dtype=ITEM_DTYPE, count=voice["count"],
+							offset=data_start + voice["offset"])
+		if voice["count"] > 0:
+			ids_start = data_start + voice["ids_offset"]
+			ids = buffer[ids_start:ids_start + voice["ids_size"]].decode("utf-8").split("\n")
+		else:
+			ids = []
+
+		sequence = Sequence()
+		durations = records["duration"].tolist()
+		steps = records["step"].tolist()
+		octaves = records["octave"].tolist()
+		alterations = records["alteration"].tolist()
+		flags = records["flags"].tolist()
+		for i in range(len(ids)):
+			item = Item()
+			item.id = ids[i]
+			item.duration = durations[i]
+			item.step = STEPS[steps[i]]
+			item.octave = octaves[i]
+			item.alteration = alterations[i]
+			item.is_rest = bool(flags[i] & FLAG_REST)
+			item.tied = bool(flags[i] & FLAG_TIED)
+			sequence.add_item(item)
+		# The arrays used for search operations come directly from the records
+		sequence.set_arrays(records["step"].astype(np.int64), records["octave"].astype(np.int64),
+						records["alteration"].astype(np.int64), records["duration"].astype(np.float64),
+						(records["flags"] & FLAG_REST) != 0)
+		return sequence
+
+
+class LazyVoices(dict):
+	"""
+		The voices of a part, decoded from the mapped file on first access
+	"""
+
+	def __init__(self, buffer, data_start, voices):
+		super().__init__((voice_id, None) for voice_id in voices.keys())
+		self.buffer = buffer
+		self.data_start = data_start
+		self.voices = voices
+
+	def __getitem__(self, voice_id):
+		sequence = super().__getitem__(voice_id)
+		if sequence is None:
+			sequence = SummaryFile.decode_voice(self.buffer, self.data_start, self.voices[voice_id])
+			self[voice_id] = sequence
+		return sequence
+
+	def get(self, voice_id, default=None):
+		if voice_id in self:
+			return self[voice_id]
+		return default
+
+	def values(self):
+		return [self[voice_id] for voice_id in self.keys()]
+
+	def items(self):
+		return [(voice_id, self[voice_id]) for voice_id in self.keys()]
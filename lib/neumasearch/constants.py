@@ -7,3 +7,7 @@ EXACT_SEARCH = "exactSearch"
 MELODIC_SEARCH = "melodicSearch"
 RHYTHMIC_SEARCH = "rhythmicSearch"
 DIATONIC_SEARCH = "diatonicSearch"
+
+# Search backends (settings.SEARCH_BACKEND)
+ES_BACKEND = "elasticsearch"
+NGRAM_BACKEND = "ngram"
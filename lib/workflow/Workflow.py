@@ -6,6 +6,8 @@ from manager.models import (Corpus, Opus, Descriptor,
 import os
 import re
 import subprocess
+import time
+import multiprocessing
 
 
 from django.core.files import File
@@ -15,6 +17,7 @@ from django.template.response import SimpleTemplateResponse
 import ast
 
 from django.conf import settings
+from django.db import connections
 
 # For computing score diffs
 #from lib.musicdiff import DetailLevel
@@ -37,6 +40,10 @@ import lib.iiif.IIIF3 as iiif3_mod
 
 from lib.neumasearch.MusicSummary import MusicSummary
 from neumasearch.IndexWrapper import IndexWrapper
+from neumasearch.IndexingPipeline import IndexingPipeline
+from neumasearch.NgramIndex import NgramIndex
+from neumasearch.SearchCache import SearchCache
+from neumasearch.constants import NGRAM_BACKEND
 
 # Music analysis module
 import converter21
@@ -134,22 +141,62 @@ class Workflow:
 		return len(diff_list)
 	"""
 	@staticmethod
-	def index_corpus(corpus, recursion=True):
+	def index_corpus(corpus, recursion=True, jobs=1, index_wrapper=None):
 		"""
 		(Re)create the index for all the opuses of a corpus (and its descendants
 		if the recursion parameter is True)
 		"""
+		return Workflow.index_opera(Workflow.get_opera_ids(corpus, recursion), 
+								jobs, index_wrapper)
 
-		i=0
-		for opus in Opus.objects.filter(corpus__ref=corpus.ref):
-			Workflow.index_opus(opus)
-
-		# Recursive call
+	@staticmethod
+	def get_opera_ids(corpus, recursion=True):
+		"""
+		The ids of the opera of a corpus (and its descendants)
+		"""
+		opera_ids = list(Opus.objects.filter(corpus__ref=corpus.ref).values_list("id", flat=True))
 		if recursion:
-			children = corpus.get_children(False)
-			for child in children:
-				Workflow.index_corpus(child, recursion)
-			
+			for child in corpus.get_children(False):
+				opera_ids += Workflow.get_opera_ids(child, recursion)
+		return opera_ids
+
+	@staticmethod
+	def index_opera(opera_ids, jobs=1, index_wrapper=None):
+		"""
+		Index a list of opera. With jobs > 1, the descriptors are extracted
+		in a pool of processes. With the ElasticSearch backend, the documents 
+		are streamed to ElasticSearch with the bulk helper, over a single 
+		connection. With the n-gram backend, the descriptors are stored in 
+		the DB and the local n-gram index is refreshed: ElasticSearch is not used.
+		"""
+		ngram_backend = settings.SEARCH_BACKEND == NGRAM_BACKEND
+		if index_wrapper is None and not ngram_backend:
+			index_wrapper = IndexWrapper()
+		report = IndexingReport(len(opera_ids))
+
+		def send_documents(results):
+			documents = report.documents(results)
+			if ngram_backend:
+				return sum(1 for _document in documents), []
+			return index_wrapper.bulk_indexing(documents)
+
+		if jobs <= 1:
+			nb_indexed, es_failures = send_documents(map(index_opus_document, opera_ids))
+		else:
+			# Forked processes must not share the DB connections of the parent
+			connections.close_all()
+			with multiprocessing.Pool(jobs) as pool:
+				nb_indexed, es_failures = send_documents(
+						pool.imap_unordered(index_opus_document, opera_ids))
+		report.end(nb_indexed, es_failures)
+		print (report)
+		# The descriptors are in the DB: update the local n-gram index
+		if ngram_backend:
+			NgramIndex.get_index().refresh(opera_ids)
+		# Cached search results may be outdated
+		SearchCache.bump_generation()
+		return report
+
 	@staticmethod
 	def propagate(corpus, recursion=True):
 		"""
@@ -176,25 +223,36 @@ class Workflow:
 				Workflow.propagate(child, recursion)
 
 	@staticmethod
-	def index_opus(opus):
+	def index_opus(opus, index_wrapper=None):
 		'''
 		   Index an opus
 		   
-		   This functions produces the Opus descriptors which are
-		   stored in the DB. It then scans these descriptors and
-		   sends them to ElasticSearch
+		   The score is parsed once by an IndexingPipeline, which produces
+		   the Opus descriptors (stored in the DB) and the document
+		   sent to ElasticSearch. With the n-gram backend, the n-gram
+		   index is refreshed instead, and ElasticSearch is not used.
 		'''
 		
 		# Produce the Opus descriptors
-		Workflow.produce_opus_descriptor(opus)
+		try:
+			opus_index = IndexingPipeline(opus).run()
+		except  Exception as ex:
+			print ("Exception when trying to index opus " + opus.ref + " Message:" + str(ex))
+			return
 		print ("Descriptors produced")
 		# Compute and store features
 		#Workflow.extract_features_from_opus(opus)
 		#print ("Features extracted")
 
 		# Store the descriptors and the features in Elastic Search
-		index_wrapper = IndexWrapper()
-		index_wrapper.index_opus(opus)
+		if opus_index is not None:
+			if settings.SEARCH_BACKEND == NGRAM_BACKEND:
+				NgramIndex.get_index().refresh([opus.id])
+			else:
+				if index_wrapper is None:
+					index_wrapper = IndexWrapper()
+				index_wrapper.save_opus_index(opus_index)
+			SearchCache.bump_generation()
 
 	@staticmethod
 	def patterns_statistics_analyze(mel_dict, dia_dict, rhy_dict, mel_opus_dict, dia_opus_dict, rhy_opus_dict):
@@ -592,103 +650,26 @@ class Workflow:
 		"""
 		print ("Produce descriptors for opus " + opus.ref)
 		descriptors_dict = {}
+		# Keys of the dictionary returned in 'affiche' mode
+		dict_keys = {settings.MELODY_DESCR: "melodic", settings.DIATONIC_DESCR: "diatonic",
+					settings.RHYTHM_DESCR: "rhythmic", settings.NOTES_DESCR: "notes"}
+		for atype in dict_keys.values():
+			descriptors_dict[atype] = {}
 		try:
-				score = opus.get_score()
+				pipeline = IndexingPipeline(opus)
 
 				#If there is error while transforming MEI into XML format, skip this opus
-				if score.m21_score == None:
+				if pipeline.load_score().m21_score == None:
 					return
 
-				# First, compute the music summary and store it as a file
-				music_summary = MusicSummary.get_music_summary(score)
-				music_summary.opus_id = opus.ref
-				#opus.summary.save("summary.json", ContentFile(music_summary.encode()))
-				#print (json.dumps(json_summary, indent=4, separators=(',', ': ')))
-				types = "melodic", "diatonic", "rhythmic", "notes"
-				for atype in types:
-					descriptors_dict[atype] = {}
-
-				# Clean the current descriptors
-				Descriptor.objects.filter(opus=opus).delete()
-		
-				# Next, compute the descriptors for each Voice
-				for part_id, part in music_summary.parts.items():
-					for voice_id, voice in part.items():
-						# Melody descriptor
-						music_descr = voice.get_melody_encoding()
-						# print ("Voice " + str(voice_id)) # + " NGRAM encoding: " + music_descr)
-						# Store in Postgres
-						descriptor = Descriptor()
-						descriptor.opus = opus
-						descriptor.part = part_id
-						descriptor.voice = voice_id
-						descriptor.type = settings.MELODY_DESCR
-						descriptor.value = music_descr
-						if not affiche:
-							descriptor.save()
-						else:
-							# print(descriptor.to_dict())
-							descriptors_dict["melodic"][str(voice_id)]=descriptor.to_dict()
-
-						#Diatonic descriptor, store in Postgres
-						diatonic_descr = voice.get_diatonic_encoding()
-						descriptor = Descriptor()
-						descriptor.opus = opus
-						descriptor.part = part_id
-						descriptor.voice = voice_id
-						descriptor.type = settings.DIATONIC_DESCR
-						descriptor.value = diatonic_descr
-						if not affiche:
-							descriptor.save()
-						else:
-							# print(descriptor.to_dict())
-							descriptors_dict["diatonic"][str(voice_id)]=descriptor.to_dict()
-						
-						# Rhythm descriptor
-						rhythm_descr = voice.get_rhythm_encoding()
-						descriptor = Descriptor()
-						descriptor.opus = opus
-						descriptor.part = part_id
-						descriptor.voice = voice_id
-						descriptor.type = settings.RHYTHM_DESCR
-						descriptor.value = rhythm_descr
-						if not affiche:
-							descriptor.save()
-						else:
-							# print(descriptor.to_dict())
-							descriptors_dict["rhythmic"][str(voice_id)]=descriptor.to_dict()
-						
-						# Notes descriptor
-						notes_descr = voice.get_note_encoding()
-						descriptor = Descriptor()
-						descriptor.opus = opus
-						descriptor.part = part_id
-						descriptor.voice = voice_id
-						descriptor.type = settings.NOTES_DESCR
-						descriptor.value = notes_descr
-						if not affiche:
-							descriptor.save()
-						else:
-							# print(descriptor.to_dict())
-							descriptors_dict["notes"][str(voice_id)]=descriptor.to_dict()
-			   
-				# Hack: the M21 parser does not supply lyrics. Use the MusicXML for the moment				   
-				
-				if opus.musicxml:
-					score = Score()
-					score.load_from_xml(opus.musicxml.path, "musicxml")
-				
-				voices = score.get_all_voices()
-				for voice in voices:
-						if voice.has_lyrics():
-							# Store in Postgres
-							descriptor = Descriptor()
-							descriptor.opus = opus
-							descriptor.part = settings.ALL_PARTS
-							descriptor.voice = voice.id
-							descriptor.type = settings.LYRICS_DESCR
-							descriptor.value = voice.get_lyrics()
-							descriptor.save()
+				descriptors = pipeline.compute_descriptors()
+				if not affiche:
+					# Store in Postgres
+					pipeline.save()
+				else:
+					for descriptor in descriptors:
+						if descriptor.type in dict_keys:
+							descriptors_dict[dict_keys[descriptor.type]][str(descriptor.voice)]=descriptor.to_dict()
 
 		except  Exception as ex:
 			print ("Exception when trying to write descriptor for opus " + opus.ref + " Message:" + str(ex))
@@ -696,17 +677,18 @@ class Workflow:
 		return descriptors_dict
 
 	@staticmethod 
-	def import_zip(zip, parent_corpus, corpus_ref, options=[]):
-		list_imported = Corpus.import_from_zip(zip, parent_corpus, corpus_ref)
+	def import_zip(zip, parent_corpus, corpus_ref, options=[], jobs=None):
+		list_imported = Corpus.import_from_zip(zip, parent_corpus, corpus_ref, jobs)
 		
 		if Workflow.IMPOPT_SAVE_MEI in options:
 			for opus in list_imported:
 				print (f"Saving MEI file of {opus.ref} as reference MEI")
 				opus.copy_mei_as_source()
-		# Produce descriptors and index the corpus in ElasticSearch
+		# Produce descriptors and index the corpus in ElasticSearch, in a single bulk job
 		print (f"\n\nINDEXING IMPORTED OPUSES")
-		for opus in list_imported:
-			Workflow.index_opus(opus)
+		if jobs is None:
+			jobs = settings.IMPORT_JOBS
+		Workflow.index_opera([opus.id for opus in list_imported], jobs)
 		return list_imported
 	
 	@staticmethod 
@@ -969,6 +951,60 @@ def createJsonDescriptors(opus):
 		with open(filename, "w") as outfile:
 			outfile.write(json_object)
 
+class IndexingReport:
+	"""
+		Throughput and failures of an indexing run
+	"""
+	def __init__(self, nb_opera):
+		self.nb_opera = nb_opera
+		self.nb_indexed = 0
+		# List of (opus ref, error message)
+		self.failures = []
+		self.start_time = time.time()
+		self.end_time = None
+
+	def documents(self, results):
+		"""
+		  Filter the results of index_opus_document: yield the ES
+		  actions and keep the failures
+		"""
+		for opus_ref, action, error in results:
+			if action is None:
+				self.failures.append((opus_ref, error))
+			else:
+				yield action
+
+	def end(self, nb_indexed, es_failures):
+		self.end_time = time.time()
+		self.nb_indexed = nb_indexed
+		self.failures += es_failures
+
+	def __str__(self):
+		elapsed = (self.end_time or time.time()) - self.start_time
+		throughput = self.nb_indexed / elapsed if elapsed > 0 else 0
+		s = (f"{self.nb_indexed}/{self.nb_opera} opera indexed in {elapsed:.1f}s "
+			 f"({throughput:.2f} opus/s). {len(self.failures)} failure(s).")
+		for opus_ref, error in self.failures:
+			s += f"\n\t{opus_ref}: {error}"
+		return s
+
+def index_opus_document(opus_id):
+	"""
+	  Run the indexing pipeline of an opus, and return a triple 
+	  (opus ref, ES bulk action, error). Top-level function, so that it can
+	  be sent to a process pool.
+	"""
+	opus_ref = str(opus_id)
+	try:
+		opus = Opus.objects.get(id=opus_id)
+		opus_ref = opus.ref
+		opus_index = IndexingPipeline(opus).run()
+		if opus_index is None:
+			return (opus_ref, None, "unable to parse the score")
+		return (opus_ref, opus_index.to_dict(include_meta=True), None)
+	except Exception as ex:
+		return (opus_ref, None, str(ex))
+
 #
 # A top level function that calls import zip. Necessary for multi thearing, otherwise
 # we get a pickle erro
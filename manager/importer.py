@@ -0,0 +1,472 @@
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+import zipfile
+from xml.dom import minidom
+
+# import the logging library
+import logging
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connections, transaction
+
+import lib.music.collection as collection_mod
+from lib.music.toolkits import toolkit_pool
+
+from .models import Corpus, Opus, score_cache, decompose_zip_name
+
+logger = logging.getLogger(__name__)
+
+'''
+  Import of the zip files produced by Corpus.export_as_zip, in three stages:
+
+  1. the zip (and the zips of the sub-corpora) is scanned, the corpora are
+     created, and the opera to import are listed;
+  2. the files of the opera are converted (Kern or MusicXML to MEI) and their
+     metadata extracted, in a pool of processes, one batch at a time;
+  3. the opera of a batch are written in the DB in a single transaction.
+
+  A journal of the batches written is kept: an import that fails can be run
+  again, and only imports the remaining opera.
+'''
+
+# Reference records of Kern files not accepted by Verovio
+KERN_IGNORED_RECORDS = (b"!!!ARE: ", b"!!!AGN: ", b"!!!OTL: ", b"!!!YOR: ",
+					b"!!!SCA: ", b"!!!OCY: ", b"!! ")
+
+OPUS_EXTENSIONS = (".json", ".mei", ".xml", ".mxl", ".krn", ".mid")
+
+
+class ImportReport:
+	"""
+		Progress and failures of an import
+	"""
+	def __init__(self):
+		self.nb_corpora = 0
+		self.nb_opera = 0
+		# Opera imported by a previous run of the same import
+		self.nb_skipped = 0
+		self.nb_converted = 0
+		self.nb_committed = 0
+		# List of (opus ref, error message)
+		self.failures = []
+		self.start_time = time.time()
+
+	def __str__(self):
+		elapsed = time.time() - self.start_time
+		s = (f"{self.nb_corpora} corpora, {self.nb_committed}/{self.nb_opera} opera imported "
+			f"({self.nb_skipped} in a previous run, {self.nb_converted} converted) in {elapsed:.1f}s. "
+			f"{len(self.failures)} failure(s).")
+		for opus_ref, error in self.failures:
+			s += f"\n\t{opus_ref}: {error}"
+		return s
+
+
+class ImportJournal:
+	"""
+		The opera already written by an import, in a JSON file
+	"""
+	def __init__(self, key):
+		self.path = os.path.join(settings.IMPORT_JOURNAL_DIR, key + ".json")
+		self.committed = set()
+		if os.path.exists(self.path):
+			with open(self.path) as f:
+				self.committed = set(json.load(f)["committed"])
+			print (f"Resuming an import: {len(self.committed)} opera already imported")
+
+	def add(self, opus_refs):
+		self.committed.update(opus_refs)
+		os.makedirs(settings.IMPORT_JOURNAL_DIR, exist_ok=True)
+		tmp_path = self.path + ".tmp"
+		with open(tmp_path, "w") as f:
+			json.dump({"committed": sorted(self.committed)}, f)
+		os.replace(tmp_path, self.path)
+
+	def close(self):
+		# The import is complete
+		if os.path.exists(self.path):
+			os.remove(self.path)
+
+
+class ZipImporter:
+	"""
+		Import of a corpus zip file in a parent corpus
+	"""
+
+	def __init__(self, zfile, parent_corpus, zip_name, jobs=None,
+				batch_size=None, progress=None):
+		self.zfile = zfile
+		self.parent_corpus = parent_corpus
+		self.zip_name = zip_name
+		self.jobs = jobs if jobs is not None else settings.IMPORT_JOBS
+		self.batch_size = batch_size if batch_size is not None else settings.IMPORT_BATCH_SIZE
+		# Called with the report after each batch
+		self.progress = progress if progress is not None else print
+
+		self.report = ImportReport()
+		self.journal = ImportJournal(self.get_key())
+		# Opera to import: (corpus, zip file, opus ref, files of the opus)
+		self.plan = []
+
+	def get_key(self):
+		# An import is identified by its target and the content of the zip
+		signature = hashlib.sha1(f"{self.parent_corpus.ref}:{self.zip_name}".encode("utf-8"))
+		for info in self.zfile.infolist():
+			signature.update(f"{info.filename}:{info.CRC}:{info.file_size}".encode("utf-8"))
+		return signature.hexdigest()
+
+	def run(self):
+		'''
+		  Import the zip file. Returns the list of imported opera
+		'''
+		# Stage 1: corpora and list of opera
+		self.scan_corpus(self.zfile, self.parent_corpus, self.zip_name)
+		self.report.nb_opera = len(self.plan)
+
+		to_import = [item for item in self.plan if self.get_full_ref(item) not in self.journal.committed]
+		self.report.nb_skipped = len(self.plan) - len(to_import)
+
+		# Stages 2 and 3, one batch at a time
+		if self.jobs > 1 and len(to_import) > self.batch_size:
+			# Forked processes must not share the DB connections of the parent
+			connections.close_all()
+			with multiprocessing.Pool(self.jobs) as pool:
+				self.import_opera(to_import, pool.map)
+		else:
+			self.import_opera(to_import, map)
+
+		if len(self.report.failures) == 0:
+			self.journal.close()
+		else:
+			# Kept: running the import again only imports the opera that failed
+			print (f"Import journal kept in {self.journal.path}")
+		print (self.report)
+		return list(Opus.objects.filter(ref__in=[self.get_full_ref(item) for item in self.plan]))
+
+	@staticmethod
+	def get_full_ref(item):
+		corpus, zfile, opus_ref, opus_files_desc = item
+		return corpus.ref + settings.NEUMA_ID_SEPARATOR + opus_ref
+
+	def scan_corpus(self, zfile, parent_corpus, zip_name):
+		'''
+		  Create (or update) the corpus of a zip, and list its opera.
+		  The zips of the sub-corpora are read in place
+		'''
+		opus_files = {}
+		children = {}
+		found_corpus_data = False
+		found_cover = False
+		corpus_dict = {}
+		cover_data = ""
+		# Scan the content of the ZIP file to find the list of opus
+		for fname in zfile.namelist():
+			# Skip files with weird names
+			base, extension = decompose_zip_name (fname)
+			if base == "" or base.startswith('_') or  base.startswith('.'):
+				continue
+			# Look for the corpus data file
+			if base == "corpus" and extension == ".json":
+				found_corpus_data = True
+				corpus_dict = json.loads(zfile.read(fname).decode('utf-8'))
+			elif base == "cover" and extension == ".jpg":
+				found_cover = True
+				cover_data = zfile.read(fname)
+			elif extension == ".zip":
+				# If not a zip of source files: A zip file with a sub corpus
+				if not base.__contains__ ("source_files"):
+					children[base] = zipfile.ZipFile(zfile.open(fname))
+			# OK, there is an Opus there
+			elif extension in OPUS_EXTENSIONS:
+				opus_files[base] = {"mei": "",
+						"musicxml": "",
+						"compressed_xml": "",
+						"json": "",
+						"kern": "",
+						"source_files": ""}
+			else:
+				print ("Ignoring file %s%s" % (base, extension))
+
+		# Sanity
+		if not found_corpus_data:
+			logger.warning ("Missing corpus JSON file. Producing a skeleton with ref %s" % zip_name)
+			corpus_dict = {"local_ref": zip_name,
+				 "title": zip_name,
+				 "short_title": zip_name,
+				 "description": zip_name,
+				 "is_public": True,
+				 "short_description": zip_name,
+				 "copyright": "",
+				 "supervisors": ""
+				}
+		if not found_cover:
+			logger.warning ("Missing cover for corpus " + corpus_dict['local_ref'])
+
+		# Get the corpus, or create it
+		print ("Importing corpus %s in %s" % (corpus_dict['local_ref'], parent_corpus.ref) )
+		full_corpus_ref = Corpus.make_ref_from_local_and_parent(corpus_dict['local_ref'], parent_corpus.ref)
+		try:
+			corpus = Corpus.objects.get(ref=full_corpus_ref)
+		except Corpus.DoesNotExist as e:
+			# Create this corpus
+			corpus = Corpus (parent=parent_corpus, ref=full_corpus_ref)
+
+		# Load / replace content from the dictionary
+		corpus.from_dict(corpus_dict)
+		corpus.save()
+		# Take the cover image
+		if found_cover :
+			corpus.cover.save("cover.jpg", ContentFile(cover_data))
+		else:
+			# Good to know: sets the file field to blank string
+			corpus.cover = None
+		self.report.nb_corpora += 1
+
+		# Recursive scan of the children
+		for base in children.keys():
+			print ("*** Importing sub corpus " + base)
+			self.scan_corpus(children[base], corpus, base)
+
+		# Second scan: we note the files present for each opus
+		for fname in zfile.namelist():
+			(opus_ref, extension) = decompose_zip_name (fname)
+			if opus_ref in opus_files:
+				if extension == '.mxl':
+					 opus_files[opus_ref]["compressed_xml"] = fname
+				elif (extension == '.xml' or extension == '.musicxml'):
+					opus_files[opus_ref]["musicxml"] = fname
+				elif extension == '.mei':
+					opus_files[opus_ref]["mei"] = fname
+				elif extension == '.json':
+					opus_files[opus_ref]["json"] = fname
+				elif extension == '.mid':
+					opus_files[opus_ref]["midi"] = fname
+				elif extension == '.krn':
+					opus_files[opus_ref]["kern"] = fname
+				elif extension == ".szip":
+					# If a zip of source files
+					opus_files[opus_ref]["source_files"] = fname
+
+		for opus_ref, opus_files_desc in opus_files.items():
+			self.plan.append((corpus, zfile, opus_ref, opus_files_desc))
+
+	def import_opera(self, items, map_function):
+		for i in range(0, len(items), self.batch_size):
+			batch = items[i:i + self.batch_size]
+			# The titles of the existing opera, in a single query
+			titles = dict(Opus.objects.filter(ref__in=[ZipImporter.get_full_ref(item) for item in batch])
+									.values_list("ref", "title"))
+			tasks = [self.make_task(item, titles) for item in batch]
+			# Stage 2: conversions
+			results = list(map_function(convert_opus, tasks))
+			self.report.nb_converted += len(results)
+			# Stage 3: DB
+			self.commit_batch(batch, results)
+			self.progress(self.report)
+
+	def make_task(self, item, titles):
+		# The content of the files of an opus, for a conversion process
+		corpus, zfile, opus_ref, opus_files_desc = item
+		full_opus_ref = ZipImporter.get_full_ref(item)
+		title = titles.get(full_opus_ref, opus_ref)
+		if opus_files_desc["json"] != "":
+			# The title given by the metadata
+			try:
+				title = collection_mod.CollectionItem.from_dict(json.loads(
+						zfile.read(opus_files_desc["json"]).decode('utf-8'))).title
+			except Exception as ex:
+				logger.warning (f"Invalid metadata for opus {full_opus_ref}: {ex}")
+		task = {"opus_ref": opus_ref, "title": title}
+		for file_type in ("mei", "musicxml", "compressed_xml", "kern"):
+			if opus_files_desc[file_type] != "":
+				task[file_type] = zfile.read(opus_files_desc[file_type])
+		return task
+
+	def commit_batch(self, batch, results):
+		committed = []
+		with transaction.atomic():
+			for item, result in zip(batch, results):
+				full_opus_ref = ZipImporter.get_full_ref(item)
+				if result["error"] is not None:
+					self.report.failures.append((full_opus_ref, result["error"]))
+					continue
+				try:
+					# A failure only cancels the opus
+					with transaction.atomic():
+						self.commit_opus(item, result)
+					committed.append(full_opus_ref)
+				except Exception as ex:
+					print ("Error importing opus  " + str(ex))
+					logger.error ("Error importing opus " + str(ex))
+					self.report.failures.append((full_opus_ref, str(ex)))
+		self.report.nb_committed += len(committed)
+		self.journal.add(committed)
+
+	def commit_opus(self, item, result):
+		corpus, zfile, opus_ref, opus_files_desc = item
+		full_opus_ref = ZipImporter.get_full_ref(item)
+		print ("Import opus with ref " + opus_ref + " in corpus " +  corpus.ref)
+		try:
+			opus = Opus.objects.get(ref=full_opus_ref)
+		except Opus.DoesNotExist as e:
+			# Create the Opus
+			opus = Opus(corpus=corpus, ref=full_opus_ref, title=opus_ref)
+		opus.mei = None
+
+		# If a json exists, then it should contain the relevant metadata
+		if opus_files_desc["json"] != "":
+			logger.info ("Found JSON metadata file %s" % opus_files_desc["json"])
+			json_doc = zfile.read(opus_files_desc["json"])
+			opus.from_dict (corpus, json.loads(json_doc.decode('utf-8')))
+
+			# Check whether a source file exists for each source
+			if opus_files_desc["source_files"] != "":
+				source_zip = zipfile.ZipFile(zfile.open(opus_files_desc["source_files"]))
+				for source in opus.opussource_set.all():
+					# Check in the zip file for the file that corresponds to the source
+					for fname in source_zip.namelist():
+						base, extension = decompose_zip_name (fname)
+						if base == source.ref:
+							# The file contains the source itself
+							print (f"Saving source file {fname}")
+							source.source_file.save(fname, ContentFile(source_zip.read(fname)))
+						if base == source.ref + "_mnf":
+							# The file contains the source manifest
+							print ("Import manifest")
+							source.manifest.save(fname, ContentFile(source_zip.read(fname)))
+						if base == source.ref + "_iiif_mnf":
+							# The file contains the IIIF source manifest
+							print ("Import IIIF manifest")
+							source.iiif_manifest.save(fname, ContentFile(source_zip.read(fname)))
+					source.save()
+
+		# OK, we loaded metada : save
+		opus.mei = None
+		opus.save()
+
+		if result["musicxml"] is not None:
+			opus.musicxml.save("score.xml", ContentFile(result["musicxml"]))
+		if result["mei"] is not None:
+			opus.mei.save("mei.xml", ContentFile(result["mei"]))
+		else:
+			logger.warning ("No MEI, no MusicXML: opus %s is incomplete" % opus.ref)
+
+		opus.title = result["title"]
+		if result["composer"]:
+			# The composer of an opus is a Person: the name found in the score is not kept
+			logger.info (f"Composer of {opus.ref} in the score: {result['composer']}")
+		opus.save()
+		opus.index_mei()
+
+
+def get_kern_mei(kern_content):
+	# Some reference records are not accepted by Verovio
+	kern_lines = []
+	for line in kern_content.splitlines():
+		if not line.startswith(KERN_IGNORED_RECORDS):
+			kern_lines.append (line.decode()  + os.linesep)
+	return toolkit_pool.to_mei("".join(kern_lines)).encode("utf-8")
+
+
+def get_first_text(xml_content, tag_name):
+	# Text of the first element with a tag name
+	doc = minidom.parseString(xml_content)
+	for element in doc.getElementsByTagName(tag_name):
+		for txtnode in element.childNodes:
+			return str(txtnode.data)
+		break
+	return None
+
+
+def get_score_metadata(content, format):
+	'''
+	  Title and composer of a score, found by music21. The parsed score
+	  is kept in the score cache, for the indexing of the opus
+	'''
+	suffix = ".mei" if format == "mei" else ".xml"
+	with tempfile.NamedTemporaryFile(suffix=suffix) as f:
+		f.write(content)
+		f.flush()
+		score = score_cache.get_score(f.name, format)
+	return score.get_title(), score.get_composer()
+
+
+def convert_opus(task):
+	'''
+	  Produce the files and the metadata of an opus, from the content of
+	  its files in the zip. Top-level function, so that it can be sent
+	  to a process pool. No DB access.
+	'''
+	opus_ref = task["opus_ref"]
+	result = {"opus_ref": opus_ref, "musicxml": None, "mei": None,
+			"title": task["title"], "composer": None, "error": None}
+	try:
+		if "compressed_xml" in task:
+			logger.info ("Found compressed MusicXML content")
+			xmlzip = zipfile.ZipFile(io.BytesIO(task["compressed_xml"]))
+			# Keep the file in the container with the same basename
+			for name2 in xmlzip.namelist():
+				if os.path.splitext(os.path.basename(name2))[0] == opus_ref:
+					result["musicxml"] = xmlzip.read(name2)
+		if "musicxml" in task:
+			logger.info ("Found MusicXML content")
+			result["musicxml"] = task["musicxml"]
+
+		if "kern" in task:
+			logger.info ("Found KERN content")
+			try:
+				result["mei"] = get_kern_mei(task["kern"])
+				title = get_first_text(result["mei"], "title")
+				if title is not None:
+					result["title"] = title
+			except Exception as e:
+				result["error"] = "Exception pendant le traitement d'un fichier Kern: " + str(e)
+				return result
+
+		if result["mei"] is None:
+			if "mei" in task:
+				mei_raw = task["mei"]
+				try:
+					mei_raw.decode("utf-8")
+					result["mei"] = mei_raw
+				except UnicodeDecodeError:
+					logger.info("Read in UTF 16")
+					try:
+						result["mei"] = mei_raw.decode("utf-16").encode("utf-8")
+					except Exception as ex:
+						logger.error ("Error processing MEI  " + str(ex))
+			elif result["musicxml"] is not None:
+				logger.info ("Produce the MEI from MusicXML")
+				try:
+					result["mei"] = toolkit_pool.to_mei(result["musicxml"]).encode("utf-8")
+				except Exception as e:
+					print ("Exception : " + str(e))
+
+		# Now try to obtain metadata
+		if result["musicxml"] is not None:
+			title = get_first_text(result["musicxml"], "movement-title")
+			if title is not None:
+				result["title"] = title
+
+		if result["title"] == opus_ref:
+			logger.info ("Try to find metadata in the XML file with music21")
+			title, composer = None, None
+			try:
+				if result["mei"] is not None:
+					title, composer = get_score_metadata(result["mei"], "mei")
+				elif result["musicxml"] is not None:
+					title, composer = get_score_metadata(result["musicxml"], "musicxml")
+			except Exception as ex:
+				logger.warning (f"Unable to read the metadata of opus {opus_ref}: {ex}")
+			if title != None and len(title) > 0:
+				result["title"] = title
+			if composer != None and len(composer) > 0:
+				result["composer"] = composer
+	except Exception as ex:
+		result["error"] = str(ex)
+	return result
@@ -0,0 +1,181 @@
+import os
+import tempfile
+import time
+import zipfile
+from fractions import Fraction
+
+import music21 as m21
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+from lib.music.Score import Score
+from neumasearch.MusicSummary import MusicSummary
+from neumasearch.Sequence import Sequence
+
+
+class ItemSequence(Sequence):
+	"""
+		The former implementation of the descriptors, one item at a time.
+		Kept as a reference for the benchmark
+	"""
+
+	def get_rhythms(self):
+		rhythms = []
+		previous_item = None
+		i_pos = 0
+		current_pos = i_pos
+		for item in self.items:
+			if previous_item is None:
+				previous_item = item
+			else:
+				if item.duration == 0 or previous_item.duration == 0:
+					continue
+				pitch_change = item.get_index() != previous_item.get_index()
+				gap = Fraction(Fraction.from_float(item.duration), Fraction.from_float(previous_item.duration)).limit_denominator(max_denominator=10000)
+				value = str(gap) if item.is_rest != True else str(-1)
+				rhythms.append({"start_pos": str(current_pos), "end_pos": str(i_pos),
+						"value": value, "pitch_change": pitch_change})
+				previous_item = item
+				current_pos = i_pos
+			i_pos += 1
+		return rhythms
+
+	def get_intervals(self, descriptor=settings.MELODY_DESCR):
+		dict_wordtonum = {"Unison": '2', "Second": '2', "Third": '3', "Fourth": '4', "Fifth": '5', "Sixth": '6', "Seventh": '7'}
+		intervals = []
+		previous_item = None
+		i_pos = 0
+		current_pos = i_pos
+		for item in self.items:
+			if item.is_rest:
+				i_pos += 1
+				continue
+			if previous_item is None:
+				previous_item = item
+			else:
+				gap = item.get_index() - previous_item.get_index()
+				if gap != 0:
+					direction = 'A' if gap > 0 else 'D'
+					if descriptor == settings.DIATONIC_DESCR:
+						m21_interval = m21.interval.Interval(noteStart=previous_item.get_music21_note(),
+												noteEnd=item.get_music21_note()).directedSimpleNiceName
+						value = dict_wordtonum[m21_interval.split(" ")[-1]] + direction
+					else:
+						value = str(abs(gap)) + direction
+					intervals.append({"start_pos": current_pos, "end_pos": i_pos, "value": value})
+					previous_item = item
+					current_pos = i_pos
+			i_pos += 1
+		return intervals
+
+	def get_notes(self):
+		notes = []
+		previous_item = None
+		i_pos = 0
+		current_pos = i_pos
+		for item in self.items:
+			if previous_item is None:
+				previous_item = item
+			else:
+				item_duration = Fraction.from_float(item.duration).limit_denominator(max_denominator=100)
+				previous_item_duration = Fraction.from_float(previous_item.duration).limit_denominator(max_denominator=100)
+				if item_duration == 0 or previous_item_duration == 0:
+					continue
+				rhythm = Fraction(item_duration, previous_item_duration).limit_denominator(max_denominator=100)
+				pitch_temp = item.get_index() - previous_item.get_index()
+				pitch = str(pitch_temp) + 'A' if pitch_temp > 0 else str(abs(pitch_temp)) + 'D'
+				notes.append({"start_pos": str(current_pos), "end_pos": str(i_pos), "rhythm": str(rhythm), "pitch": pitch})
+				previous_item = item
+				current_pos = i_pos
+			i_pos += 1
+		return notes
+
+	@staticmethod
+	def loop_ngrams(codes, NGRAM_SIZE = 3):
+		phrase = ""
+		for i in range(len(codes) - NGRAM_SIZE + 1):
+			ngram = ""
+			for j in range(i, i + NGRAM_SIZE):
+				ngram = ngram + codes[j]
+			phrase += ngram + " N "
+		return phrase
+
+	def get_melody_encoding(self, mirror_setting = False, NGRAM_SIZE = 3):
+		return self.loop_ngrams([str(i["value"]) + ";" for i in self.get_intervals(settings.MELODY_DESCR)])
+
+	def get_diatonic_encoding(self, mirror_setting = False, NGRAM_SIZE = 3):
+		return self.loop_ngrams([str(i["value"]) + ";" for i in self.get_intervals(settings.DIATONIC_DESCR)])
+
+	def get_rhythm_encoding(self, NGRAM_SIZE = 3):
+		return self.loop_ngrams(["(" + str(r["value"]) + ")" for r in self.get_rhythms()])
+
+	def get_note_encoding(self, NGRAM_SIZE = 3):
+		return self.loop_ngrams(self.notes_to_symbols(self.get_notes()))
+
+
+class Command(BaseCommand):
+	"""Benchmark """
+
+	help = 'Compare the computation time of the n-gram descriptors with the former implementation'
+
+	ENCODINGS = ["get_melody_encoding", "get_diatonic_encoding", "get_rhythm_encoding", "get_note_encoding"]
+
+	def add_arguments(self, parser):
+		parser.add_argument('-z', dest='zip_path', default=os.path.join(settings.BASE_DIR, "data", "chorals.zip"),
+						help="A ZIP with MEI files (default: the chorales)")
+		parser.add_argument('-n', dest='max_files', type=int, default=100)
+		parser.add_argument('-r', dest='repeat', type=int, default=3)
+
+	def handle(self, *args, **options):
+		if not os.path.exists(options['zip_path']):
+			raise CommandError(f"No such file: {options['zip_path']}")
+
+		sequences = self.load_sequences(options['zip_path'], options['max_files'])
+		nb_items = sum(len(sequence.items) for sequence in sequences)
+		print (f"{len(sequences)} voices, {nb_items} items")
+
+		timings = {}
+		for name, sequence_class in [("former", ItemSequence), ("vectorized", Sequence)]:
+			timings[name] = {}
+			# Each encoding alone, then all of them (as when an opus is indexed)
+			for encodings in [[encoding] for encoding in Command.ENCODINGS] + [Command.ENCODINGS]:
+				elapsed = 0
+				for i in range(options['repeat']):
+					voices = Command.copy_sequences(sequences, sequence_class)
+					start = time.perf_counter()
+					results = [[getattr(voice, encoding)() for encoding in encodings] for voice in voices]
+					elapsed += time.perf_counter() - start
+				timings[name][encodings[0] if len(encodings) == 1 else "all"] = (elapsed / options['repeat'], results)
+
+		for label in timings["former"].keys():
+			former, former_results = timings["former"][label]
+			vectorized, vectorized_results = timings["vectorized"][label]
+			print (f"{label:25} former: {former:8.3f}s  vectorized: {vectorized:8.3f}s  "
+					f"speedup: {former / vectorized:6.1f}  identical: {former_results == vectorized_results}")
+
+	@staticmethod
+	def copy_sequences(sequences, sequence_class):
+		# New objects: nothing computed before
+		copies = []
+		for sequence in sequences:
+			copy = sequence_class()
+			copy.items = sequence.items
+			copies.append(copy)
+		return copies
+
+	def load_sequences(self, zip_path, max_files):
+		sequences = []
+		with zipfile.ZipFile(zip_path) as zip_file, tempfile.TemporaryDirectory() as tmp_dir:
+			mei_files = [name for name in zip_file.namelist()
+					if name.endswith(".mei") and not name.startswith("__MACOSX")]
+			for name in sorted(mei_files)[:max_files]:
+				mei_path = zip_file.extract(name, tmp_dir)
+				score = Score()
+				score.load_from_xml(mei_path, "mei")
+				if score.m21_score is None:
+					continue
+				summary = MusicSummary.get_music_summary(score)
+				for part in summary.parts.values():
+					sequences += list(part.values())
+		return sequences
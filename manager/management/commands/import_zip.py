@@ -21,6 +21,8 @@ class Command(BaseCommand):
 		parser.add_argument('-c', dest='parent_corpus_ref')
 		parser.add_argument('-r', dest='corpus_ref')
 		parser.add_argument('-o', dest='import_options')
+		parser.add_argument('-j', dest='jobs', type=int, 
+						help='Nb of processes that convert the opera (default: IMPORT_JOBS)')
 
 	def handle(self, *args, **options):
 			
@@ -57,7 +59,7 @@ class Command(BaseCommand):
 				Workflow.async_import (upload, corpus_ref)
 			else:
 				print ("Running in synchronous mode")
-				Workflow.import_zip(zf, parent_corpus, corpus_ref, import_options)						 
+				Workflow.import_zip(zf, parent_corpus, corpus_ref, import_options, options["jobs"])
 		except Corpus.DoesNotExist:
 			raise CommandError('Corpus with ref "%s" does not exist' % options['parent_corpus_ref'])
 			exit(1)
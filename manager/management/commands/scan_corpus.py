@@ -19,6 +19,7 @@ from lib.music.Voice import IncompleteBarsError
 
 
 from neumasearch.IndexWrapper import IndexWrapper
+from neumasearch.NgramIndex import NgramIndex
 
 # List of actions
 
@@ -27,6 +28,7 @@ CLEAR_INDEX_ACTION="clearindex"
 INDEX_ACTION="index"
 PROPAGATE_ACTION="propagate"
 INDEX_ALL_ACTION = "index_all"
+NGRAM_INDEX_ACTION = "ngram_index"
 STATS_ACTION="stats"
 TITLE_ACTION="title"
 CPTDIST="cptdist"
@@ -54,6 +56,8 @@ class Command(BaseCommand):
 		parser.add_argument('-t', dest='corpus_target')
 		parser.add_argument('-d', dest='descriptor')
 		parser.add_argument('-m', dest='metric')
+		parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+						help='Nb of processes used to index')
 
 	def handle(self, *args, **options):
 		action = options['action']
@@ -65,9 +69,15 @@ class Command(BaseCommand):
 			return 
 		elif action == INDEX_ALL_ACTION:
 			corpora = Corpus.objects.all()
+			opera_ids = []
 			for c in corpora:
 				if not c.parent_ref(c.ref):
-					Workflow.index_corpus(c)
+					opera_ids += Workflow.get_opera_ids(c)
+			Workflow.index_opera(opera_ids, options['jobs'])
+			return 
+		elif action == NGRAM_INDEX_ACTION:
+			# Build the local n-gram index from the descriptors in the DB
+			NgramIndex.build()
 			return 
 		elif action == EXPORT_TO_DATASET_ACTION:
 			# Export the reference and computed MEI to 'ground-truth'
@@ -109,7 +119,7 @@ class Command(BaseCommand):
 				Workflow.produce_mei(corpus)
 				print ("MEI conversion completed for " + corpus.title)
 			elif action == INDEX_ACTION:
-				Workflow.index_corpus(corpus)
+				Workflow.index_corpus(corpus, jobs=options['jobs'])
 				print ("Indexing completed for corpus '" + corpus.title + "'")
 			elif action == TITLE_ACTION:		
 				for opus in Opus.objects.filter(corpus__ref=corpus.ref):
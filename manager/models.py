@@ -17,12 +17,11 @@ from xml.dom import minidom
 from natsort import natsorted
 
 import music21 as m21
-import verovio
 
 #
 # Django packages imports
 #
-from django.db import models
+from django.db import models, transaction, connections
 from django.core.files import File
 from django.core.files.temp import NamedTemporaryFile
 from django.core.files.base import ContentFile, File
@@ -52,6 +51,10 @@ import lib.music.source as source_mod
 import lib.music.collection as collection_mod
 import lib.music.opusmeta as opusmeta_mod
 import lib.music.constants as constants_mod
+from lib.music.scorecache import ScoreCache
+from lib.music.toolkits import toolkit_pool
+from lib.music.rendercache import RenderCache
+from lib.music.meiindex import mei_indexes
 
 import lib.iiif.IIIF2 as iiif2_mod
 import lib.iiif.IIIF3 as iiif3_mod
@@ -60,6 +63,8 @@ import lib.iiif.IIIF3 as iiif3_mod
 import lib.collabscore.parser as parser_mod
 from lib.collabscore.parser import CollabScoreParser, OmrScore
 from lib.collabscore.editions import Edition
+from lib.collabscore.reader import DmosReader
+from lib.collabscore.incremental import IncrementalScore
 
 # Get an instance of a logger
 # See https://realpython.com/python-logging/
@@ -77,6 +82,17 @@ logger.addHandler(c_handler)
 def set_logging_level(level):
 	logger.setLevel(level)
 
+# Parsed scores, shared by all the opera of the process
+score_cache = ScoreCache(settings.SCORE_CACHE_DIR,
+					settings.SCORE_CACHE_LRU_SIZE,
+					settings.SCORE_CACHE_ENABLED)
+
+# Size of the blocks copied in the zip exports
+ZIP_CHUNK_SIZE = 1024 * 1024
+
+# SVG pages, MIDI and MEI pages rendered from the opera files
+render_cache = RenderCache(settings.RENDER_CACHE_DIR, settings.RENDER_OPTIONS)
+
 #################
 class Config(models.Model):
 	"""
@@ -424,357 +440,139 @@ class Corpus(models.Model):
 	def get_opera(self):
 		return Opus.objects.filter(corpus=self).order_by('ref')
 
-	def export_as_zip(self, request, mode="json"):
+	def export_as_zip(self, output, mode="json", flat=False):
 		''' Export a corpus, its children and all opuses in
-			a recursive zip file.
+			a recursive zip file, written to output (a file, which
+			does not need to be seekable).
 			By default, standard JSON files are used to encode corpus and opus
 			If mode == jsonld, we export as linked data
+			If flat, the children are directories instead of zip files
 		'''
-		
-		# Write the ZIP file in memory
-		s = io.BytesIO()
+		for _block in self.stream_zip(output, mode, flat):
+			pass
 
-		# The zip compressor
-		zf = zipfile.ZipFile(s, "w")
-	
+	def stream_zip(self, output, mode="json", flat=False):
+		''' Same as export_as_zip, as a generator which yields each time
+			a block is written to output. The bytes written so far can then
+			be sent: the archive is never in memory
+		'''
+		with zipfile.ZipFile(output, "w") as zf:
+			yield from self.write_zip_entries(zf, mode, flat)
+		yield
+
+	@staticmethod
+	def write_zip_file(zf, path, arcname):
+		# Copy a file in a zip entry, block by block
+		zinfo = zipfile.ZipInfo.from_file(path, arcname)
+		with open(path, "rb") as src, zf.open(zinfo, "w") as dest:
+			for chunk in iter(lambda: src.read(ZIP_CHUNK_SIZE), b""):
+				dest.write(chunk)
+				yield
+
+	def write_zip_entries(self, zf, mode, flat, prefix=""):
 		# Add a JSON file with meta data
-		zf.writestr("corpus.json", self.json())
+		zf.writestr(prefix + "corpus.json", self.json())
+		yield
 		# Write the cover file
-		if self.cover is not None:
+		if self.cover:
 			try:
-				with open (self.cover.path, "r") as coverfile:
-					zf.writestr("cover.jpg", self.cover.read())
-			except Exception as ex:
+				yield from Corpus.write_zip_file(zf, self.cover.path, prefix + "cover.jpg")
+			except OSError as ex:
 				print ("Cannot read the cover file ?" + str(ex))
 			
-		# Add the zip files of the children
+		# Add the children
 		for child in self.get_direct_children():
 			# Composer at the corpus level ? Then each child inherits the composer
 			if self.composer is not None:
 				child.composer = self.composer
 				child.save()
 
-			zf.writestr(Corpus.local_ref(child.ref) + ".zip", 
-					child.export_as_zip(request,mode).getvalue())
+			if flat:
+				yield from child.write_zip_entries(zf, mode, flat, 
+								prefix + Corpus.local_ref(child.ref) + "/")
+			else:
+				# The zip of the child is written inside the entry: its size is unknown
+				with zf.open(prefix + Corpus.local_ref(child.ref) + ".zip", "w", force_zip64=True) as entry:
+					with zipfile.ZipFile(entry, "w") as child_zf:
+						yield from child.write_zip_entries(child_zf, mode, flat)
 			
-		for opus in self.get_opera():
+		for opus in self.get_opera().prefetch_related("opussource_set").iterator(chunk_size=100):
 			# Only add files where we are not in momde JSON-LD
 			if not mode == "jsonld":
 				# Add MusicXML file
 				if opus.musicxml:
 					if os.path.exists(opus.musicxml.path):
-						zf.write(opus.musicxml.path, opus.local_ref() + ".xml")
+						yield from Corpus.write_zip_file(zf, opus.musicxml.path, 
+											prefix + opus.local_ref() + ".xml")
 				if opus.mei:
 					if os.path.exists(opus.mei.path):
-						zf.write(opus.mei.path, opus.local_ref() + ".mei")
-			# Add a sub dir for sources files
-			source_bytes = io.BytesIO()
-			# The zip compressor
-			source_compressor = zipfile.ZipFile(source_bytes, "w")
-			nb_source_files = 0
+						yield from Corpus.write_zip_file(zf, opus.mei.path, 
+											prefix + opus.local_ref() + ".mei")
+			# Source files, in a sub zip file
+			source_files = []
 			for source in opus.opussource_set.all():
 				if source.source_file:
-					nb_source_files += 1
-					source_compressor.write(source.source_file.path, 
-							source.ref + "." + source.source_file.path.split(".")[-1])
+					source_files.append((source.source_file.path, 
+							source.ref + "." + source.source_file.path.split(".")[-1]))
 				if source.manifest:
-					nb_source_files += 1
-					source_compressor.write(source.manifest.path, 
-							source.ref + "_mnf." + source.manifest.path.split(".")[-1])
+					source_files.append((source.manifest.path, 
+							source.ref + "_mnf." + source.manifest.path.split(".")[-1]))
 				if source.iiif_manifest:
 					if "\{\}" in source.iiif_manifest.path:
-						nb_source_files += 1
-						source_compressor.write(source.iiif_manifest.path, 
-							source.ref + "_iiif_mnf." + source.iiif_manifest.path.split(".")[-1])
+						source_files.append((source.iiif_manifest.path, 
+							source.ref + "_iiif_mnf." + source.iiif_manifest.path.split(".")[-1]))
 					else:
 						print (f"Error {opus.ref}: iiif_manifest is empty")
-			source_compressor.close()
-			if nb_source_files > 0:
-				source_file = opus.local_ref() +  '.szip'
-				#source_file = opus.local_ref() +  '.source_files.zip'
-				zf.writestr( source_file, source_bytes.getvalue())
+			if len(source_files) > 0:
+				if flat:
+					for path, name in source_files:
+						yield from Corpus.write_zip_file(zf, path, 
+										prefix + opus.local_ref() + ".sources/" + name)
+				else:
+					source_file = prefix + opus.local_ref() +  '.szip'
+					#source_file = opus.local_ref() +  '.source_files.zip'
+					with zf.open(source_file, "w", force_zip64=True) as entry:
+						with zipfile.ZipFile(entry, "w") as source_compressor:
+							for path, name in source_files:
+								yield from Corpus.write_zip_file(source_compressor, path, name)
 
 			# Add a JSON file with meta data
 			opus_json = opus.json()
-			zf.writestr(opus.local_ref() + ".json", opus_json)
-		zf.close()
-		
-		return s
+			zf.writestr(prefix + opus.local_ref() + ".json", opus_json)
+			yield
+
+	def get_export_name(self, mode="json", flat=False):
+		# Name of the zip produced in the background
+		name = f"{Corpus.local_ref(self.ref)}-{mode}"
+		if flat:
+			name += "-flat"
+		return name + ".zip"
+
+	def export_to_file(self, mode="json", flat=False):
+		''' Export the corpus in the exports dir (for large corpora, in
+			the background). Returns the path of the zip file
+		'''
+		os.makedirs(settings.EXPORT_DIR, exist_ok=True)
+		path = os.path.join(settings.EXPORT_DIR, self.get_export_name(mode, flat))
+		tmp_path = f"{path}.{os.getpid()}.tmp"
+		try:
+			with open(tmp_path, "wb") as f:
+				self.export_as_zip(f, mode, flat)
+			os.replace(tmp_path, path)
+		finally:
+			if os.path.exists(tmp_path):
+				os.remove(tmp_path)
+		return path
 
 	@staticmethod
-	def import_from_zip(zfile, parent_corpus, zip_name):
+	def import_from_zip(zfile, parent_corpus, zip_name, jobs=None, progress=None):
 		''' Import a corpus from a Neuma zip export. If necessary, the
-			 corpus is created, and its descriptions loaded from the json file
+			 corpus is created, and its descriptions loaded from the json file.
+			 The opera are converted in a pool of processes (see manager.importer)
 		'''
-		opus_files = {}
-		children = {}
-		found_corpus_data = False
-		found_cover = False
-		corpus_dict = {}
-		cover_data = ""
-		# Scan the content of the ZIP file to find the list of opus
-		for fname in zfile.namelist():
-			# Skip files with weird names
-			base, extension = decompose_zip_name (fname)
-			if base == "" or base.startswith('_') or  base.startswith('.'):
-				continue
-			# Look for the corpus data file
-			if base == "corpus" and extension == ".json":
-				found_corpus_data = True 
-				corpus_dict = json.loads(zfile.open(fname).read().decode('utf-8'))
-			elif base == "cover" and extension == ".jpg":
-				found_cover = True 
-				cover_data = zfile.open(fname).read()
-			elif extension == ".zip":
-				# If not a zip of source files: A zip file with a sub corpus
-				if not base.__contains__ ("source_files"):
-					children[base] = zipfile.ZipFile(io.BytesIO(zfile.open(fname).read()))
-			# OK, there is an Opus there
-			elif (extension ==".json" or extension == ".mei" or extension == ".xml"
-				or extension == '.mxl' or extension=='.krn' or extension=='.mid'):
-				opus_files[base] = {"mei": "", 
-						"musicxml": "",
-						"compressed_xml": "",
-						"json": "",
-						"kern": "",
-						"source_files": ""}
-			else:
-				print ("Ignoring file %s%s" % (base, extension))
-
-		# Sanity
-		if not found_corpus_data:
-			logger.warning ("Missing corpus JSON file. Producing a skeleton with ref %s" % zip_name)
-			corpus_dict = {"local_ref": zip_name, 
-				 "title": zip_name, 
-				 "short_title": zip_name, 
-				 "description": zip_name, 
-				 "is_public": True,
-				 "short_description": zip_name,
-				 "copyright": "",
-				 "supervisors": ""
-				}
-		if not found_cover:
-			logger.warning ("Missing cover for corpus " + corpus_dict['ref'])
-			
-		# Get the corpus, or create it
-		logger.info ("Importing corpus %s in %s" % (corpus_dict['local_ref'], parent_corpus.ref) )
-		print ("Importing corpus %s in %s" % (corpus_dict['local_ref'], parent_corpus.ref) )
-		full_corpus_ref = Corpus.make_ref_from_local_and_parent(corpus_dict['local_ref'], parent_corpus.ref)
-		try:
-			corpus = Corpus.objects.get(ref=full_corpus_ref)
-		except Corpus.DoesNotExist as e:
-			# Create this corpus
-			corpus = Corpus (parent=parent_corpus, ref=full_corpus_ref)
-	
-		# Load / replace content from the dictionary
-		corpus.from_dict(corpus_dict)
-		corpus.save()
-		# Take the cover image
-		if found_cover :
-			corpus.cover.save("cover.jpg", ContentFile(cover_data))
-		else:
-			# Good to know: sets the file field to blank string
-			corpus.cover = None
-		
-		# Recursive import of the children
-		for base in children.keys():
-			print ("*** Importing sub corpus " + base)
-			corpus.import_from_zip(children[base], corpus, base)
-
-		# Second scan: we note the files present for each opus
-		for fname in zfile.namelist():
-			(opus_ref, extension) = decompose_zip_name (fname)
-			if opus_ref in opus_files:
-				if extension == '.mxl':
-					 opus_files[opus_ref]["compressed_xml"] = fname
-				elif (extension == '.xml' or extension == '.musicxml'):
-					opus_files[opus_ref]["musicxml"] = fname
-				elif extension == '.mei':
-					opus_files[opus_ref]["mei"] = fname
-				elif extension == '.json':
-					opus_files[opus_ref]["json"] = fname
-				elif extension == '.mid':
-					opus_files[opus_ref]["midi"] = fname
-				elif extension == '.krn':
-					opus_files[opus_ref]["kern"] = fname
-				elif extension == ".szip":
-					# If a zip of source files
-					opus_files[opus_ref]["source_files"] = fname
-
-		# OK, now in opus_files, we know whether we have the MusicXML, MEI or any other
-		list_imported = []
-		for opus_ref, opus_files_desc in opus_files.items():			
-				full_opus_ref = corpus.ref + settings.NEUMA_ID_SEPARATOR + opus_ref
-				print ("Import opus with ref " + opus_ref + " in corpus " +  corpus_dict['ref'])
-				try:
-					opus = Opus.objects.get(ref=full_opus_ref)
-				except Opus.DoesNotExist as e:
-					# Create the Opus
-					opus = Opus(corpus=corpus, ref=full_opus_ref, title=opus_ref)
-				list_imported.append(opus)
-				opus.mei = None
-
-				# If a json exists, then it should contain the relevant metadata
-				if opus_files_desc["json"] != "":
-					logger.info ("Found JSON metadata file %s" % opus_files_desc["json"])
-					json_file = zfile.open(opus_files_desc["json"])
-					json_doc = json_file.read()
-					opus.from_dict (corpus, json.loads(json_doc.decode('utf-8')))
-					
-					# Check whether a source file exists for each source
-					for source in opus.opussource_set.all():
-						if opus_files_desc["source_files"] != "":
-							# Yep we found one
-							source_zip_content = io.BytesIO(zfile.read(opus_files_desc["source_files"]))
-							source_zip = zipfile.ZipFile(source_zip_content)
-							# Check in the zip file for the file that corresponds to the source
-							for fname in source_zip.namelist():
-								base, extension = decompose_zip_name (fname)
-								if base == source.ref:
-									# The file contains the source itself
-									sfile_content = source_zip.read(fname)
-									print (f"Saving source file {fname}")
-									source.source_file.save(fname, ContentFile(sfile_content))
-								if base == source.ref + "_mnf":
-									# The file contains the source manifest
-									print ("Import manifest")
-									manifest_content = source_zip.read(fname)
-									source.manifest.save(fname, ContentFile(manifest_content))
-								if base == source.ref + "_iiif_mnf":
-									# The file contains the IIIF source manifest
-									print ("Import IIIF manifest")
-									manifest_content = source_zip.read(fname)
-									source.iiif_manifest.save(fname, ContentFile(manifest_content))
-							source.save()
-
-				# OK, we loaded metada : save
-				opus.mei = None
-				opus.save()
-			
-				if opus_files_desc["compressed_xml"] != "":
-					logger.info ("Found compressed MusicXML content")
-					# Compressed XML
-					container = io.BytesIO(zfile.read(opus_files_desc["compressed_xml"]))
-					xmlzip = zipfile.ZipFile(container)
-					# Keep the file in the container with the same basename
-					for name2 in xmlzip.namelist():
-						basename2 = os.path.basename(name2)
-						ref2 = os.path.splitext(basename2)[0]
-						if opus_files_desc["opus_ref"]  == ref2:
-							xml_content = xmlzip.read(name2)
-					opus.musicxml.save("score.xml", ContentFile(xml_content))
-				if opus_files_desc["musicxml"] != "":
-					logger.info ("Found MusicXML content")
-					xml_content = zfile.read(opus_files_desc["musicxml"])
-					opus.musicxml.save("score.xml", ContentFile(xml_content))
-				if opus_files_desc["kern"] != "":
-					logger.info ("Found KERN content")
-					kern_content = zfile.read(opus_files_desc["kern"])
-					# We need to write in a tmp file, probably 
-					tmp_file = "/tmp/tmp_kern.txt"
-					f = open(tmp_file, "w")
-					lines = kern_content.splitlines()
-					for line in lines:
-						if not (line.startswith(b"!!!ARE: ") 
-							or line.startswith(b"!!!AGN: ")
-							or line.startswith(b"!!!OTL: ")
-							or line.startswith(b"!!!YOR: ")
-							or line.startswith(b"!!!SCA: ")
-							or line.startswith(b"!!!OCY: ")
-							or line.startswith(b"!! ")
-							):
-							f.write (line.decode()  + os.linesep)
-					f.close()
-					try:
-						tk = verovio.toolkit()
-						tk.loadFile(tmp_file)
-						mei_content = tk.getMEI()
-						opus.mei.save("mei.xml", ContentFile(mei_content))
-						doc = minidom.parseString(mei_content)
-						titles = doc.getElementsByTagName("title")
-						for title in titles:
-							for txtnode in title.childNodes:
-								opus.title = str(txtnode.data)
-								break
-							break
-					except Exception as e:
-						print ("Exception pendant le traitement d'un fichier Kern: " + str(e))
-						return
-
-				if bool(opus.mei) == False:
-					if opus_files_desc["mei"] != "":
-						logger.info ("Load MEI content")
-						# Add the MEI file
-						try:
-							mei_file = zfile.open(opus_files_desc["mei"])
-							mei_raw  = mei_file.read()
-							encoding = "utf-8"
-							try:
-								logger.info("Attempt to read in UTF 8")
-								mei_raw.decode(encoding)
-							except Exception as ex:
-								logger.info("Read in UTF 16")
-								encoding = "utf-16"
-								mei_raw.decode(encoding)
-							logger.info("Correct encoding: " + encoding)
-							mei_content = mei_raw.decode(encoding)
-							logger.info ("Save the MEI file.")
-							opus.mei.save("mei.xml", ContentFile(mei_content))
-						except Exception as ex:
-							logger.error ("Error processing MEI  " + str(ex))
-					else:
-						# Produce the MEI from the MusicXML
-						if opus_files_desc["musicxml"] != "":
-							logger.info ("Produce the MEI from MusicXML")
-							try:
-								print ("Produce the MEI from MusicXML")
-								tk = verovio.toolkit()
-								tk.loadFile(opus.musicxml.path)
-								mei_content = tk.getMEI()
-								opus.mei.save("mei.xml", ContentFile(mei_content))
-							except Exception as e:
-								print ("Exception : " + str(e))
-								# Workflow.produce_opus_mei(opus)	 
-						else:
-							logger.warning ("No MEI, no MusicXML: opus %s is incomplete" % opus.ref)
-
-				# Now try to obtain metadata
-				if opus_files_desc["compressed_xml"]!="" or opus_files_desc["musicxml"]!="":
-					# Get MusicXML metadata
-					doc = minidom.parseString(xml_content)
-					titles = doc.getElementsByTagName("movement-title")
-					for title in titles:
-						for txtnode in title.childNodes:
-							opus.title = str(txtnode.data)
-							break
-						break
-				elif opus_files_desc["compressed_xml"]!="" or opus_files_desc["musicxml"]!="":
-					# Get MusicXML metadata
-					doc = minidom.parseString(xml_content)
-					titles = doc.getElementsByTagName("movement-title")
-					for title in titles:
-						for txtnode in title.childNodes:
-							opus.title = str(txtnode.data)
-							break
-						break
-					
-				try:
-					if opus.title == opus_ref:
-						#print ("Title = " + opus.title + " Try to obtain metadata")
-						logger.info ("Try to find metadata in the XML file with music21")
-						score = opus.get_score()
-						if score.get_title() != None and len(score.get_title()) > 0:
-							opus.title = score.get_title()
-						if score.get_composer() != None and len(score.get_composer()) > 0:
-							opus.composer = score.get_composer()
-							
-					opus.save()
-				except Exception as ex:
-					print ("Error importing opus  " + str(ex))
-					logger.error ("Error importing opus " + str(ex))
-					
-				print ("Opus ref " + opus_ref + " imported in corpus " + corpus.ref+ "\n")
-		return list_imported
+		# Imported here: the importer imports the models
+		from .importer import ZipImporter
+		return ZipImporter(zfile, parent_corpus, zip_name, jobs, progress=progress).run()
 	
 	def stats_editions(self):
 		# Group all opus editions by type and return a dict with 
@@ -946,18 +744,15 @@ class Opus(models.Model):
 			source.source_file.save("ref_mei.xml", File(self.mei))
 
 	def get_score(self):
-		"""Get a score object from an XML document"""
-		score = Score()
+		"""Get a score object from an XML document (possibly from the score cache)"""
 		# Try to obtain the MEI document, which contains IDs
 
 		if self.mei:
 			print ("Load from MEI")
-			score.load_from_xml(self.mei.path, "mei")
-			return score
+			return score_cache.get_score(self.mei.path, "mei")
 		elif self.musicxml:
 			print ("Load from MusicXML")
-			score.load_from_xml(self.musicxml.path, "musicxml")
-			return score
+			return score_cache.get_score(self.musicxml.path, "musicxml")
 		else:
 			raise LookupError ("Opus " + self.ref + " doesn't have any XML file attached")
 
@@ -1146,18 +941,65 @@ class Opus(models.Model):
 				
 		return source
 		
+	def invalidate_score_cache(self):
+		"""The XML files are about to change: forget the parsed scores and renderings"""
+		if self.mei:
+			score_cache.invalidate(self.mei.path)
+			render_cache.invalidate(self.mei.path)
+			mei_indexes.invalidate(self.mei.path)
+		if self.musicxml:
+			score_cache.invalidate(self.musicxml.path)
+			render_cache.invalidate(self.musicxml.path)
+
+	def get_mei_index(self):
+		"""The xml:id index of the MEI file, built if necessary"""
+		if not self.mei:
+			return None
+		return mei_indexes.get_index(self.mei.path)
+
+	def index_mei(self):
+		"""Build the xml:id index of a new MEI file"""
+		try:
+			self.get_mei_index()
+		except Exception as ex:
+			logger.warning (f"Unable to index the MEI of opus {self.ref}: {ex}")
+
+	def get_render_path(self):
+		"""The file rendered by Verovio: the MEI, or else the MusicXML"""
+		if self.mei:
+			return self.mei.path
+		if self.musicxml:
+			return self.musicxml.path
+		return None
+
+	def prewarm_renders(self):
+		"""Render the artifacts of the opus in the background"""
+		if not settings.RENDER_CACHE_PREWARM:
+			return
+		# Imported here: the tasks module imports the models
+		from home.tasks import render_opus
+		try:
+			render_opus.delay(self.ref)
+		except Exception as ex:
+			logger.warning (f"Unable to schedule the rendering of opus {self.ref}: {ex}")
+
 	def replace_musicxml (self, mxml_file):
+		self.invalidate_score_cache()
 		with open(mxml_file) as f:
 			self.musicxml = File(f,name="score.xml")
 			self.save()
+		self.prewarm_renders()
 		return  self.create_source_with_file(source_mod.ItemSource.MUSICXML_REF, 
 					SourceType.STYPE_MXML, "", mxml_file, "score.xml")
 
 	def replace_mei (self, mei_file):
+		self.invalidate_score_cache()
 		with open(mei_file) as f:
 			print ("Replace MEI file")
 			self.mei = File(f,name="mei.xml")
 			self.save()	
+		self.index_mei()
+		self.prewarm_renders()
 		return self.create_source_with_file("mei", SourceType.STYPE_MEI,
 							"", mei_file, "score.mei")
 
@@ -1180,7 +1022,7 @@ class Opus(models.Model):
 		schema_file = os.path.join(schema_dir, 'dmos_schema.json')
 		# Parse the schema
 		try:
-			parser = CollabScoreParser(schema_file, schema_dir)
+			parser = CollabScoreParser.get_parser(schema_file, schema_dir)
 		except jsonschema.SchemaError as ex:
 			return "Schema parsing error: " + ex.message
 		except Exception as ex:
@@ -1197,28 +1039,30 @@ class Opus(models.Model):
 		if iiif_source is None:
 			print (f"Unable to find IIIF source {iiif_source_ref}")
 			return None
-		if dmos_source.source_file:
-			dmos_data = json.loads(dmos_source.source_file.read())
-		else:
+		if not dmos_source.source_file:
 			print (f"Unable to find the DMOS file in source {dmos_source_ref}")
 			return None
 			
 		for json_edition in dmos_source.operations:
 				editions.append (Edition.from_json(json_edition))
-		if dmos_data == None:
-			print ("Unable to find the DMOS file ??")
-			return "Unable to find the DMOS file ??"
-		try:
-			parser.validate_data (dmos_data)
-		except Exception as ex:
-			return "DMOS file validation error : " + str(ex)
 		
 		# Get the global configuration
 		config = Config.objects.get(code=Config.CODE_DEFAULT_CONFIG)
 
-		# Parse DMOS data
-		omr_score = OmrScore (self.get_url(), dmos_data, 
-						config.to_dict(), editions)
+		# Parse DMOS data. Pages are read and validated one at a time
+		# (by a pool of processes): only the first invalid page is reported
+		if settings.DMOS_PARSER_JOBS > 1:
+			# Forked processes must not share the DB connections of the parent
+			connections.close_all()
+		try:
+			with open(dmos_source.source_file.path, "rb") as dmos_file:
+				dmos_data = DmosReader(dmos_file, parser)
+				omr_score = OmrScore (self.get_url(), dmos_data, 
+							config.to_dict(), editions, settings.DMOS_PARSER_JOBS)
+		except Exception as ex:
+			return "DMOS file validation error : " + str(ex)
+		if len(dmos_data.error_messages) > 0:
+			parser_mod.logger.warning (f"DMOS file validation: {len(dmos_data.error_messages)} errors. First ones: {dmos_data.error_messages[:3]}")
 		score = omr_score.get_score()
 		
 		# Store the MusicXML file in the opus
@@ -1311,24 +1155,19 @@ class Opus(models.Model):
 			score.uri = "Undetermined: change the 'just_annotations' setting"
 
 		if not just_score:
-			# Clean existing annotations for image-region model
-			print ("Cleaning existing annotations")
-			image_model = AnalyticModel.objects.get(code=AM_IMAGE_REGION)
-			Annotation.objects.filter(opus=self).filter(analytic_concept__model=image_model).delete()
-			error_model = AnalyticModel.objects.get(code=AM_OMR_ERROR)
-			Annotation.objects.filter(opus=self).filter(analytic_concept__model=error_model).delete()
-
-			print (f'Inserting annotations')
 			user_annot = User.objects.get(username=settings.COMPUTER_USER_NAME)
+			writer = AnnotationWriter(user_annot, self)
 			for annotation in score.annotations:
 				annotation.target.resource.source = score.uri
-				db_annot = Annotation.create_from_web_annotation(user_annot, 
-															self, annotation)
-				if db_annot is not None:
-					db_annot.target.save()
-					if db_annot.body is not None:
-						db_annot.body.save()
-					db_annot.save()
+				writer.add(annotation)
+
+			# Existing annotations for image-region and error models are replaced
+			print (f'Replacing annotations')
+			image_model = AnalyticModel.objects.get(code=AM_IMAGE_REGION)
+			error_model = AnalyticModel.objects.get(code=AM_OMR_ERROR)
+			nb_annotations = writer.replace(Annotation.objects.filter(opus=self).filter(
+								analytic_concept__model__in=[image_model, error_model]))
+			print (f'{nb_annotations} annotations inserted')
 
 		return score
 
@@ -1604,9 +1443,7 @@ class OpusSource (models.Model):
 
 		if not (self.ref == source_mod.ItemSource.IIIF_REF):
 			raise Exception ("Can  only apply editions to an IIIF source ")
-		if self.source_file:
-			dmos_data = json.loads(self.source_file.read())
-		else:
+		if not self.source_file:
 			raise Exception ("This IIIF does not have a DMOS file")	
 		
 		# We start from the current list of editions
@@ -1616,11 +1453,21 @@ class OpusSource (models.Model):
 			print (f"Applying edition {edition}")
 			editions_to_apply = Edition.add_edition_to_list(editions_to_apply, edition)
 
-		omr_score = OmrScore ("", dmos_data, page_range, editions_to_apply)
+		# The score produced for the previous editions is kept for a version
+		# of the DMOS file: only the measures changed by editions are produced
+		version = f"{self.source_file.name}-{os.path.getmtime(self.source_file.path)}"
+		key = (self.id, version, json.dumps(page_range, sort_keys=True))
+		incremental_score = IncrementalScore.get_score(key, 
+						lambda: open(self.source_file.path, "rb"), page_range,
+						settings.DMOS_PARSER_JOBS)
 	
 		# Store the MusicXML file in the opus
 		mxml_file = "/tmp/" + shortuuid.uuid() + ".xml"
-		omr_score.write_as_musicxml (mxml_file)
+		if settings.DMOS_PARSER_JOBS > 1:
+			# A full production forks a pool of processes: they must
+			# not share the DB connections of the parent
+			connections.close_all()
+		incremental_score.write_as_musicxml (editions_to_apply, mxml_file)
 		self.opus.replace_musicxml(mxml_file)
 		# Same for MEI
 		# Crashes on Mac OS X...
@@ -1672,9 +1519,8 @@ class OpusSource (models.Model):
 		
 		user_annot = User.objects.get(username=settings.COMPUTER_USER_NAME)
 		audio_concept = AnalyticConcept.objects.get(code=constants_mod.TFRAME_MEASURE_CONCEPT)
-		
-		# Remove existing annotations
-		Annotation.objects.filter(opus=self.opus).filter(analytic_concept=audio_concept).delete()
+		writer = AnnotationWriter(user_annot, self.opus)
+		writer.concepts[audio_concept.code] = audio_concept
 		creator = annot_mod.Creator ("collabscore", 
 						annot_mod.Creator.SOFTWARE_TYPE, "collabscore")
 		
@@ -1685,13 +1531,10 @@ class OpusSource (models.Model):
 				annotation = annot_mod.Annotation.create_annot_from_xml_to_audio(creator, self.opus.musicxml.url, 
 								measure, self.url, time_frame, 
 								constants_mod.TFRAME_MEASURE_CONCEPT)
-				db_annot = Annotation.create_from_web_annotation(user_annot, 
-															self.opus, annotation)
-				if db_annot is not None:
-					db_annot.target.save()
-					if db_annot.body is not None:
-						db_annot.body.save()
-					db_annot.save()
+				writer.add(annotation)
+
+		# Existing annotations are replaced
+		writer.replace(Annotation.objects.filter(opus=self.opus).filter(analytic_concept=audio_concept))
 
 	def stats_editions(self):
 		# Group editions by type and return a dict with 
@@ -1817,6 +1660,9 @@ class Annotation(models.Model):
 	
 	# We "cache" the web annotation as a JSON object for web exchanges
 	web_annotation = models.JSONField(blank=True,default=dict)
+	# Form of the stored web annotation, sent as is by all the REST services:
+	# the simplified form of lib.music.annotation, not the full W3C form
+	W3C_FORM = False
 	
 	# Creation / update dates
 	created_at = models.DateTimeField(auto_now_add=True, null=True, blank=True)
@@ -1835,50 +1681,88 @@ class Annotation(models.Model):
 		'''
 		
 		if len(self.web_annotation) == 0:
-			# Let's create the annotation
-			target_selector = annot_mod.FragmentSelector(
-					annot_mod.FragmentSelector.XML_SELECTOR, self.target.selector_value)
-			target_resource = annot_mod.SpecificResource(self.target.source, target_selector)
-			target = annot_mod.Target(target_resource)
-		
-			if self.body is not None:
-				body_selector = annot_mod.FragmentSelector(self.body.selector_conforms_to, 
-												self.body.selector_value)
-				body_resource = annot_mod.SpecificResource(self.body.source, body_selector)
-				body = annot_mod.ResourceBody(body_resource)
-			if self.textual_body is not None:
-				body = annot_mod.TextualBody(self.textual_body)
-			if self.user is not None:
-				creator = annot_mod.Creator(self.user.id, annot_mod.Creator.PERSON_TYPE, 
-									self.user.username)
-			else:
-				creator = annot_mod.Creator('xxx', annot_mod.Creator.SOFTWARE_TYPE, 
-									settings.COMPUTER_USER_NAME)
-
-			annotation = annot_mod.Annotation(self.id, creator, target, body, 
-							self.analytic_concept.model.code, self.analytic_concept.code, 
-							self.motivation,
-							self.created_at, self.updated_at)
-			annotation.set_style (annot_mod.Style (self.analytic_concept.icon,
-											 self.analytic_concept.display_options))
-			
+			annotation = self.build_web_annotation()
 			# Store it for the next time !
-			self.web_annotation = annotation.get_json_obj(False)
+			self.web_annotation = annotation.get_json_obj(Annotation.W3C_FORM)
 			self.save()
 			return annotation
 		else:
 			return self.web_annotation
+
+	def build_web_annotation(self):
+		'''
+			The annotation of our score model, built from the DB data without
+			being stored. Target, body, concept and user should be selected
+			with the annotation
+		'''
+		target_selector = annot_mod.FragmentSelector(
+				annot_mod.FragmentSelector.XML_SELECTOR, self.target.selector_value)
+		target_resource = annot_mod.SpecificResource(self.target.source, target_selector)
+		target = annot_mod.Target(target_resource)
+		
+		if self.body is not None:
+			body_selector = annot_mod.FragmentSelector(self.body.selector_conforms_to, 
+											self.body.selector_value)
+			body_resource = annot_mod.SpecificResource(self.body.source, body_selector)
+			body = annot_mod.ResourceBody(body_resource)
+		if self.textual_body is not None:
+			body = annot_mod.TextualBody(self.textual_body)
+		if self.user is not None:
+			creator = annot_mod.Creator(self.user.id, annot_mod.Creator.PERSON_TYPE, 
+								self.user.username)
+		else:
+			creator = annot_mod.Creator('xxx', annot_mod.Creator.SOFTWARE_TYPE, 
+								settings.COMPUTER_USER_NAME)
+
+		annotation = annot_mod.Annotation(self.id, creator, target, body, 
+						self.analytic_concept.model.code, self.analytic_concept.code, 
+						self.motivation,
+						self.created_at, self.updated_at)
+		annotation.set_style (annot_mod.Style (self.analytic_concept.icon,
+										 self.analytic_concept.display_options))
+		return annotation
+
+	@staticmethod
+	def backfill_web_annotations(annotations, batch_size=1000):
+		'''
+			Store the web annotation of the annotations of a queryset
+			that do not have one yet. Returns their number
+		'''
+		missing = annotations.filter(web_annotation={}).select_related(
+					"target", "body", "analytic_concept__model", "user")
+		nb_annotations = 0
+		batch = []
+		for annotation in missing.iterator(chunk_size=batch_size):
+			annotation.web_annotation = annotation.build_web_annotation().get_json_obj(Annotation.W3C_FORM)
+			batch.append(annotation)
+			if len(batch) == batch_size:
+				Annotation.objects.bulk_update(batch, ["web_annotation"])
+				nb_annotations += len(batch)
+				batch = []
+		if len(batch) > 0:
+			Annotation.objects.bulk_update(batch, ["web_annotation"])
+			nb_annotations += len(batch)
+		return nb_annotations
 		
 	@staticmethod 
-	def create_from_web_annotation(user, opus, webannot):
+	def create_from_web_annotation(user, opus, webannot, concepts=None):
 		'''
-			Create a DB annotation from an annotation of our score model
+			Create a DB annotation from an annotation of our score model. The
+			annotation, its target and its body are not saved.
+			
+			concepts: dict of the concepts already looked up, by code
 		'''
-		try:
-			annot_concept = AnalyticConcept.objects.get(code=webannot.annotation_concept)
-		except AnalyticConcept.DoesNotExist:
-			logger.error (f'Unknown annotation concept {webannot.annotation_concept}')
-			return
+		if concepts is None:
+			concepts = {}
+		if webannot.annotation_concept not in concepts:
+			try:
+				concepts[webannot.annotation_concept] = AnalyticConcept.objects.get(code=webannot.annotation_concept)
+			except AnalyticConcept.DoesNotExist:
+				logger.error (f'Unknown annotation concept {webannot.annotation_concept}')
+				concepts[webannot.annotation_concept] = None
+		annot_concept = concepts[webannot.annotation_concept]
+		if annot_concept is None:
+			return None
 		
 		# Create the target
 		wtarget = webannot.target		
@@ -1889,7 +1773,6 @@ class Annotation(models.Model):
 		else:
 			target = Resource(source=wtarget.resource.source, selector_type=wtselector.type,
 					selector_conforms_to=wtselector.conforms_to, selector_value=wtselector.value)
-			target.save()
 
 		# Create the body
 		wbody = webannot.body
@@ -1897,7 +1780,6 @@ class Annotation(models.Model):
 			wbselector = wbody.resource.selector
 			body = Resource(source=wbody.resource.source, selector_type=wbselector.type,
 					selector_conforms_to=wbselector.conforms_to, selector_value=wbselector.value)
-			body.save()
 			# NB: the annotation model of webannot is ignored, we take the model of the concept istead.
 			# There is probably no need to refer tothe annotation model in web annotation, unless
 			# two concepts in two distinct models share the same code
@@ -1924,6 +1806,55 @@ class Annotation(models.Model):
 		return annotations
 
 
+class AnnotationWriter:
+	'''
+		Insertion of many annotations of an opus. Concepts are looked up
+		once, and the resources and annotations are inserted in bulk
+	'''
+	
+	# Nb of rows inserted by a query
+	BATCH_SIZE = 1000
+	
+	def __init__(self, user, opus):
+		self.user = user
+		self.opus = opus
+		self.concepts = {}
+		self.annotations = []
+
+	def add(self, webannot):
+		db_annot = Annotation.create_from_web_annotation(self.user, self.opus, 
+												webannot, self.concepts)
+		if db_annot is not None:
+			self.annotations.append(db_annot)
+		return db_annot
+
+	def write(self):
+		'''
+			Insert the annotations added so far. Returns their number
+		'''
+		resources = []
+		for db_annot in self.annotations:
+			resources.append(db_annot.target)
+			if db_annot.body is not None:
+				resources.append(db_annot.body)
+		with transaction.atomic():
+			# Primary keys of the resources are set by bulk_create
+			Resource.objects.bulk_create(resources, batch_size=AnnotationWriter.BATCH_SIZE)
+			Annotation.objects.bulk_create(self.annotations, batch_size=AnnotationWriter.BATCH_SIZE)
+		nb_annotations = len(self.annotations)
+		self.annotations = []
+		return nb_annotations
+
+	def replace(self, old_annotations):
+		'''
+			Delete some annotations (a queryset) and insert the new
+			ones, in a single transaction
+		'''
+		with transaction.atomic():
+			old_annotations.delete()
+			return self.write()
+
+
 # Get the Opus ref and extension from a file name
 def decompose_zip_name (fname):
 	dirname = os.path.dirname(fname)
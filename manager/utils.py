@@ -14,3 +14,30 @@ class OverwriteStorage(FileSystemStorage):
         if self.exists(name):
              os.remove(os.path.join(settings.MEDIA_ROOT, name))
         return name
+
+
+class StreamBuffer:
+    """A write-only file which keeps the bytes written until they
+    are taken: used to send a file while it is produced (e.g. a zip)
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        """The bytes written since the last call"""
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
@@ -0,0 +1,335 @@
+# import the logging library
+import logging
+
+import gzip
+import hashlib
+import os
+import re
+import shutil
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, FileResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+
+from lib.music.scorecache import file_digest
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+logger = logging.getLogger(__name__)
+
+'''
+  Delivery of the files of opera and sources (MEI, MusicXML, JSON).
+
+  Files are streamed from the disk, or handed to the web server
+  (X-Accel-Redirect / X-Sendfile). The ETag is the hash of the content,
+  computed once per version of a file. Conditional requests get a 304,
+  byte ranges a 206, and text files are sent compressed (gzip, or brotli
+  if installed) from copies compressed once. Copies not used for a while
+  are removed, as are the least recently used ones past a total size.
+'''
+
+# Headers of the files read by the viewers of other sites
+CORS_HEADERS = {
+	"Access-Control-Allow-Origin": "*",
+	"Access-Control-Allow-Credentials": "true",
+	"Access-Control-Allow-Methods": "GET, OPTIONS",
+	"Access-Control-Allow-Headers": "Access-Control-Allow-Headers, Origin, Accept, "
+				"X-Requested-With, Content-Type, Access-Control-Request-Method, "
+				"Access-Control-Request-Headers, credentials, If-None-Match, Range",
+	"Access-Control-Expose-Headers": "ETag, Last-Modified, Content-Range, Content-Disposition",
+}
+
+# Compressed copies, by order of preference
+ENCODINGS = {"br": ".br", "gzip": ".gz"}
+
+# Files smaller than this are not compressed
+MIN_COMPRESSED_SIZE = 1024
+
+# Text files, whatever the content type they are sent with
+COMPRESSIBLE_EXTENSIONS = {".mei", ".xml", ".musicxml", ".json", ".krn", ".abc", ".txt", ".svg"}
+
+# The cache is cleaned at most once per interval (seconds) by a process
+CLEANING_INTERVAL = 3600
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def add_cors_headers(resp):
+	for header, value in CORS_HEADERS.items():
+		resp[header] = value
+	return resp
+
+
+class FileDelivery:
+	"""
+		Send files with their validators and compressed variants
+	"""
+
+	def __init__(self, cache_dir, sendfile=None, sendfile_locations={},
+					max_cache_size=None, max_cache_age=None):
+		# Compressed copies are kept there, named after the content hash
+		self.cache_dir = cache_dir
+		# Limits of the copies: total size (bytes), time since last use (seconds)
+		self.max_cache_size = max_cache_size
+		self.max_cache_age = max_cache_age
+		self.last_cleaning = 0
+		self.lock = threading.Lock()
+		# None, "x-accel-redirect" (nginx) or "x-sendfile" (apache)
+		self.sendfile = sendfile
+		# Directory -> internal location of nginx
+		self.sendfile_locations = sendfile_locations
+
+	@staticmethod
+	def get_digest(file_path, stat):
+		"""
+		  Hash of a file, stored in the cache for the current version of the file
+		"""
+		key = "file_digest:" + hashlib.sha1(
+			f"{file_path}:{stat.st_mtime_ns}:{stat.st_size}".encode("utf-8")).hexdigest()
+		digest = cache.get(key)
+		if digest is None:
+			digest = file_digest(file_path)
+			cache.set(key, digest, timeout=None)
+		return digest
+
+	@staticmethod
+	def is_compressible(content_type, file_path=""):
+		return (content_type.startswith("text/") or content_type.endswith("xml")
+				or content_type.endswith("json")
+				or os.path.splitext(file_path)[1].lower() in COMPRESSIBLE_EXTENSIONS)
+
+	@staticmethod
+	def accepted_encodings(request):
+		accepted = []
+		for item in request.headers.get("Accept-Encoding", "").split(","):
+			parts = item.strip().split(";")
+			if len(parts) > 1 and parts[1].strip() in ("q=0", "q=0.0"):
+				continue
+			accepted.append(parts[0].strip())
+		return accepted
+
+	def get_variant(self, file_path, digest, encoding):
+		"""
+		  Path of the compressed copy of a file, produced on first use
+		"""
+		variant_path = os.path.join(self.cache_dir, digest[:2], digest + ENCODINGS[encoding])
+		if os.path.exists(variant_path):
+			return variant_path
+		os.makedirs(os.path.dirname(variant_path), exist_ok=True)
+		tmp_path = f"{variant_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+		try:
+			with open(file_path, "rb") as src:
+				if encoding == "gzip":
+					# No name, no date: the copy only depends on the content
+					with open(tmp_path, "wb") as dest_file, \
+							gzip.GzipFile(filename="", mode="wb", fileobj=dest_file, mtime=0) as dest:
+						shutil.copyfileobj(src, dest, STREAM_CHUNK_SIZE)
+				else:
+					with open(tmp_path, "wb") as dest:
+						dest.write(brotli.compress(src.read()))
+			os.replace(tmp_path, variant_path)
+		finally:
+			if os.path.exists(tmp_path):
+				os.remove(tmp_path)
+		self.copy_added()
+		return variant_path
+
+	def choose_variant(self, request, file_path, digest, size, content_type):
+		# Encoding and path of the file to send
+		if size < MIN_COMPRESSED_SIZE or not FileDelivery.is_compressible(content_type, file_path):
+			return None, file_path
+		accepted = FileDelivery.accepted_encodings(request)
+		for encoding in ENCODINGS:
+			if encoding not in accepted or (encoding == "br" and brotli is None):
+				continue
+			try:
+				return encoding, self.get_variant(file_path, digest, encoding)
+			except OSError as ex:
+				logger.warning (f"Unable to compress {file_path}: {ex}")
+				break
+		return None, file_path
+
+	@staticmethod
+	def not_modified(request, etag, mtime):
+		if request.method not in ("GET", "HEAD"):
+			return False
+		if_none_match = request.headers.get("If-None-Match")
+		if if_none_match is not None:
+			tags = [tag.strip() for tag in if_none_match.split(",")]
+			return "*" in tags or etag in tags or f"W/{etag}" in tags
+		if_modified_since = parse_http_date_safe(request.headers.get("If-Modified-Since", ""))
+		return if_modified_since is not None and int(mtime) <= if_modified_since
+
+	@staticmethod
+	def get_range(request, size):
+		"""
+		  The byte range requested (a single one), None for the whole file,
+		  or False if the range cannot be satisfied
+		"""
+		if request.method != "GET" or "Range" not in request.headers:
+			return None
+		match = RANGE_RE.match(request.headers["Range"].strip())
+		if match is None or match.group(0) == "bytes=-":
+			return None
+		start, end = match.groups()
+		if start == "":
+			# The last bytes
+			start, end = max(0, size - int(end)), size - 1
+		else:
+			start, end = int(start), min(int(end), size - 1) if end != "" else size - 1
+		if start > end or start >= size:
+			return False
+		return start, end
+
+	def get_sendfile_url(self, file_path):
+		for directory, location in self.sendfile_locations.items():
+			if file_path.startswith(os.path.join(directory, "")):
+				return location.rstrip("/") + "/" + os.path.relpath(file_path, directory)
+		return None
+
+	@staticmethod
+	def stream_range(file_path, start, end):
+		with open(file_path, "rb") as f:
+			f.seek(start)
+			remaining = end - start + 1
+			while remaining > 0:
+				chunk = f.read(min(STREAM_CHUNK_SIZE, remaining))
+				if not chunk:
+					break
+				remaining -= len(chunk)
+				yield chunk
+
+	def serve(self, request, file_path, content_type, file_name=None):
+		"""
+		  Response sending a file. The file name, if given, is
+		  proposed for a download
+		"""
+		stat = os.stat(file_path)
+		digest = FileDelivery.get_digest(file_path, stat)
+		encoding, send_path = self.choose_variant(request, file_path, digest, stat.st_size, content_type)
+		# A compressed copy is a distinct representation
+		etag = f'"{digest[:32]}-{encoding}"' if encoding is not None else f'"{digest[:32]}"'
+
+		if FileDelivery.not_modified(request, etag, stat.st_mtime):
+			resp = HttpResponse(status=304)
+		else:
+			send_size = os.path.getsize(send_path)
+			byte_range = FileDelivery.get_range(request, send_size) if encoding is None else None
+			sendfile_url = self.get_sendfile_url(send_path) if self.sendfile == "x-accel-redirect" else None
+			if byte_range is False:
+				resp = HttpResponse(status=416)
+				resp["Content-Range"] = f"bytes */{send_size}"
+			elif sendfile_url is not None:
+				# nginx sends the file, and handles the ranges
+				resp = HttpResponse(content_type=content_type)
+				resp["X-Accel-Redirect"] = sendfile_url
+			elif self.sendfile == "x-sendfile":
+				resp = HttpResponse(content_type=content_type)
+				resp["X-Sendfile"] = send_path
+			elif byte_range is not None:
+				start, end = byte_range
+				resp = StreamingHttpResponse(FileDelivery.stream_range(send_path, start, end),
+									status=206, content_type=content_type)
+				resp["Content-Range"] = f"bytes {start}-{end}/{send_size}"
+				resp["Content-Length"] = str(end - start + 1)
+			else:
+				resp = FileResponse(open(send_path, "rb"), content_type=content_type)
+			if encoding is not None:
+				resp["Content-Encoding"] = encoding
+			if file_name is not None:
+				resp["Content-Disposition"] = f'attachment; filename="{file_name}"'
+
+		resp["ETag"] = etag
+		resp["Last-Modified"] = http_date(stat.st_mtime)
+		resp["Accept-Ranges"] = "bytes"
+		resp["Vary"] = "Accept-Encoding"
+		# The client checks the ETag before using its copy
+		resp["Cache-Control"] = "no-cache"
+		return add_cors_headers(resp)
+
+	def serve_as_utf8(self, request, file_path, content_type, file_name=None):
+		"""
+		  Same, for files that may be encoded in UTF-16: those are sent
+		  from a copy in UTF-8
+		"""
+		with open(file_path, "rb") as f:
+			start = f.read(2)
+		if start not in (b"\xff\xfe", b"\xfe\xff"):
+			return self.serve(request, file_path, content_type, file_name)
+		stat = os.stat(file_path)
+		digest = FileDelivery.get_digest(file_path, stat)
+		utf8_path = os.path.join(self.cache_dir, digest[:2], digest + ".utf8")
+		if not os.path.exists(utf8_path):
+			os.makedirs(os.path.dirname(utf8_path), exist_ok=True)
+			tmp_path = f"{utf8_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+			with open(file_path, "r", encoding="utf-16") as src, open(tmp_path, "w", encoding="utf-8") as dest:
+				shutil.copyfileobj(src, dest, STREAM_CHUNK_SIZE)
+			os.replace(tmp_path, utf8_path)
+			self.copy_added()
+		return self.serve(request, utf8_path, content_type, file_name)
+
+	def copy_added(self):
+		# Each new copy may exceed the limits: the cache is cleaned from time to time
+		with self.lock:
+			if time.time() - self.last_cleaning < CLEANING_INTERVAL:
+				return
+			self.last_cleaning = time.time()
+		try:
+			self.clean_cache()
+		except OSError as ex:
+			logger.warning (f"Unable to clean {self.cache_dir}: {ex}")
+
+	def clean_cache(self):
+		'''
+		  Remove the copies not used for max_cache_age seconds, then the
+		  least recently used ones until the cache fits in max_cache_size.
+		  Returns the number of files removed
+		'''
+		now = time.time()
+		entries = []
+		for dir_path, dir_names, file_names in os.walk(self.cache_dir):
+			for file_name in file_names:
+				path = os.path.join(dir_path, file_name)
+				try:
+					stat = os.stat(path)
+				except FileNotFoundError:
+					continue
+				if file_name.endswith(".tmp") and now - stat.st_mtime < CLEANING_INTERVAL:
+					# Being written
+					continue
+				entries.append((max(stat.st_atime, stat.st_mtime), stat.st_size, path))
+
+		# Least recently used first
+		entries.sort()
+		total_size = sum(size for last_use, size, path in entries)
+		nb_removed = 0
+		for last_use, size, path in entries:
+			too_old = self.max_cache_age is not None and now - last_use > self.max_cache_age
+			too_large = self.max_cache_size is not None and total_size > self.max_cache_size
+			if not too_old and not too_large:
+				break
+			try:
+				os.remove(path)
+			except FileNotFoundError:
+				pass
+			total_size -= size
+			nb_removed += 1
+		if nb_removed > 0:
+			logger.info (f"{nb_removed} files removed from {self.cache_dir}")
+		return nb_removed
+
+
+# Files served by the process
+file_delivery = FileDelivery(settings.FILE_DELIVERY_CACHE_DIR,
+					settings.FILE_DELIVERY_SENDFILE,
+					settings.FILE_DELIVERY_SENDFILE_LOCATIONS,
+					settings.FILE_DELIVERY_CACHE_MAX_SIZE,
+					settings.FILE_DELIVERY_CACHE_MAX_AGE)
@@ -237,13 +237,13 @@ def get_concepts_level(db_model, parent):
 
 def annotation_to_rest(annotation):
 	"""
-	  Create the REST answer that describes an annotation
+	  Create the REST answer that describes an annotation: its stored
+	  web annotation (see Annotation.W3C_FORM)
 	"""
 
 	if len(annotation.web_annotation) == 0:
-		w3c = False # Change to true for a full W3C compliant
 		webannot = annotation.produce_web_annotation()
-		return webannot.get_json_obj(w3c)
+		return webannot.get_json_obj(Annotation.W3C_FORM)
 	else:
 		return annotation.web_annotation
 
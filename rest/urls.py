@@ -68,6 +68,8 @@ urlpatterns = [
     #re_path(r'collections/(?P<full_neuma_ref>(.*))/_uploads/(?P<upload_id>(.*))/_import/$',views.handle_import_request, name='handle_import_request'),
      # Generic request to a corpus or an opus 
 	path ('collections/<str:full_neuma_ref>/_file/', views.OpusFile.as_view(), name='opus_file_request'),
+	path ('collections/<str:full_neuma_ref>/_render/<str:artifact>/', views.OpusRender.as_view(), name='opus_render_request'),
+	path ('collections/<str:full_neuma_ref>/_elements/', views.ElementList.as_view(), name='opus_elements_request'),
     path ('collections/<str:full_neuma_ref>/', views.Element.as_view(), name='handle_neuma_ref_request'),
  
 ]
@@ -16,6 +16,7 @@ from pathlib import Path
 from django.core.files.base import ContentFile
 
 from django.conf import settings
+from django.core.cache import cache
 from django.db.models import Count, F
 
 from django.contrib.auth.models import User
@@ -25,7 +26,7 @@ from . import serializers
 
 from django.utils.dateformat import DateFormat
 
-from django.http import HttpResponse, FileResponse
+from django.http import HttpResponse, FileResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 
 from rest_framework import viewsets
@@ -61,8 +62,13 @@ from lxml import etree
 from lib.collabscore.parser import CollabScoreParser, OmrScore
 from lib.collabscore.editions import Edition
 
+# Rendered artifacts
+from lib.music.rendercache import RenderCache
+
+from .delivery import file_delivery, add_cors_headers
+
 # Asynchronous tasks
-from home.tasks import parse_dmos
+from home.tasks import parse_dmos, backfill_web_annotations
 
 # Modèles
 from manager.models import (
@@ -73,7 +79,8 @@ from manager.models import (
 	Annotation,
 	Upload,
 	OpusSource,
-	SourceType
+	SourceType,
+	render_cache
 )
 
 from .serializers import (
@@ -125,6 +132,22 @@ INTERNAL_REF_RESOURCE = "INTERNAL"  # For XML element inside an opus / MEI
    Utility functions
 '''
 
+def get_sorted_refs(refs, list_key):
+	"""
+	  Sort annotation refs in natural order. The order is kept in the
+	  cache for a list of annotations (one entry per list), with a digest
+	  of the refs that tells whether the list has changed
+	"""
+	refs = sorted(refs)
+	digest = hashlib.sha1("\n".join(refs).encode("utf-8")).hexdigest()
+	cache_key = f"annotation_refs:{list_key}"
+	cached = cache.get(cache_key)
+	if cached is not None and cached[0] == digest:
+		return cached[1]
+	sorted_refs = natsorted(refs)
+	cache.set(cache_key, (digest, sorted_refs), timeout=settings.ANNOTATION_REFS_CACHE_TIMEOUT)
+	return sorted_refs
+
 class JSONResponse(HttpResponse):
 	"""
 	An HttpResponse that renders its content into JSON.
@@ -336,6 +359,12 @@ class Element (APIView):
 						with open(opus.mei.path, "r") as meifile:
 							meiString = meifile.read()
 						return HttpResponse(meiString, content_type="application/xml")
+					elif opus.mei:
+						# The XML fragment of an element, read from the index
+						fragment = opus.get_mei_index().get_fragment(filename)
+						if fragment is None:
+							return Response(status=status.HTTP_404_NOT_FOUND)
+						return HttpResponse(fragment, content_type="application/xml")
 					else:
 						return Response(status=status.HTTP_404_NOT_FOUND)
 				else:
@@ -347,16 +376,13 @@ class Element (APIView):
 						)
 					obj = {"id": element_id, "annotations": []}
 
-					# Try to obtain the MEI document, which contains IDs
+					# The index of the MEI document gives the element
 					if opus.mei:
 						try:
-							tree = etree.parse(opus.mei.path)
-							xpath_expr = "//*[@xml:id='" + element_id + "']"
-							# print ("Search for " + xpath_expr)
-							element = tree.xpath(xpath_expr)
+							obj["element"] = opus.get_mei_index().lookup(element_id)
 						except Exception as ex:
 							logging.warning(
-								"Error during parsing of file "
+								"Error during indexing of file "
 								+ opus.mei.path
 								+ ": "
 								+ str(ex)
@@ -374,10 +400,56 @@ class Element (APIView):
 
 
 
+@permission_classes((AllowAny, ))
+class ElementList (APIView):
+	"""
+	 Description of a list of elements of the MEI of an opus, found
+	 in the xml:id index. Their XML fragments are added on demand
+	"""
+
+	@extend_schema(operation_id="ElementListGet",
+		parameters=[
+			OpenApiParameter(name='ids', 
+							description='Comma-separated list of xml:ids', 
+							required=True, 
+							type=str),
+			OpenApiParameter(name='fragments', 
+							description='Include the XML fragments', 
+							required=False, 
+							type=bool),
+			]
+		)
+	def get(self, request, full_neuma_ref):
+		ids = [xml_id for xml_id in request.GET.get("ids", "").split(",") if xml_id != ""]
+		with_fragments = request.GET.get("fragments", "false").lower() == "true"
+		return self.lookup(full_neuma_ref, ids, with_fragments)
+
+	@extend_schema(operation_id="ElementListPost")
+	def post(self, request, full_neuma_ref):
+		# Long lists of ids are posted: {"ids": [...], "fragments": true}
+		ids = request.data.get("ids", [])
+		with_fragments = bool(request.data.get("fragments", False))
+		return self.lookup(full_neuma_ref, ids, with_fragments)
+
+	def lookup(self, full_neuma_ref, ids, with_fragments):
+		opus, object_type = get_object_from_neuma_ref(full_neuma_ref)
+		if object_type != OPUS_RESOURCE or not opus.mei:
+			return Response(status=status.HTTP_404_NOT_FOUND)
+
+		mei_index = opus.get_mei_index()
+		elements = mei_index.lookup_batch(ids)
+		if with_fragments:
+			for xml_id, fragment in mei_index.get_fragments(ids).items():
+				if fragment is not None:
+					elements[xml_id]["fragment"] = fragment.decode("utf-8")
+		return JSONResponse(elements)
+
+
 @permission_classes((AllowAny, ))
 class OpusFile (APIView):
 	"""
-	 Return the file  of a Opus, disabling caching
+	 Return the MEI file of a Opus. The client keeps it, and checks
+	 its ETag before using it again
 	 
 	"""
 	
@@ -385,23 +457,45 @@ class OpusFile (APIView):
 	def get(self, request, full_neuma_ref):
 		opus, object_type = get_object_from_neuma_ref(full_neuma_ref)
 		if opus.mei:
-			with open(opus.mei.path, "r") as f:
-				file_name = os.path.basename(opus.mei.path).split('/')[-1]
-				content = f.read()
-				resp = FileResponse(content) 
-				resp['Content-type'] = "binary/octet-stream"  # source.source_type.mime_type
-				resp["Content-Disposition"] = f"attachment; filename={file_name}"
-				resp['Access-Control-Allow-Origin'] = '*'
-				resp['Access-Control-Allow-Credentials'] = "true"
-				resp['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
-				resp['Access-Control-Allow-Headers'] = 'Access-Control-Allow-Headers, Origin, Accept, ' \
-                                               'X-Requested-With, Content-Type, Access-Control-Request-Method,' \
-                                               ' Access-Control-Request-Headers, credentials'	
-			return resp
+			file_name = os.path.basename(opus.mei.path)
+			return file_delivery.serve(request, opus.mei.path, "binary/octet-stream", file_name)
 		else:
 			return Response(status=status.HTTP_404_NOT_FOUND)
 
 
+class OpusRender (APIView):
+	"""
+	 Return an artifact rendered from the score of an Opus: the SVG or the MEI
+	 fragment of a page (parameter 'page'), or the MIDI file. Artifacts
+	 are served with a strong ETag
+	"""
+	
+	@extend_schema(operation_id="OpusRenderGet")
+	def get(self, request, full_neuma_ref, artifact):
+		opus, object_type = get_object_from_neuma_ref(full_neuma_ref)
+		render_path = opus.get_render_path()
+		if render_path is None or artifact not in RenderCache.CONTENT_TYPES:
+			return Response(status=status.HTTP_404_NOT_FOUND)
+		try:
+			page = int(request.GET.get("page", 1))
+			options = RenderCache.parse_options(request.GET)
+		except ValueError:
+			return Response(status=status.HTTP_400_BAD_REQUEST)
+
+		rendered = render_cache.get_artifact(render_path, artifact, page, options)
+		if rendered is None:
+			return Response(status=status.HTTP_404_NOT_FOUND)
+		path, etag = rendered
+		if etag in [tag.strip() for tag in request.headers.get("If-None-Match", "").split(",")]:
+			resp = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+		else:
+			resp = FileResponse(open(path, "rb"), content_type=RenderCache.CONTENT_TYPES[artifact])
+		resp["ETag"] = etag
+		# The client checks the ETag before using its copy
+		resp["Cache-Control"] = "no-cache"
+		return add_cors_headers(resp)
+
+
 @extend_schema(operation_id="TopLevelCorpusList")
 class TopLevelCorpusList(generics.ListAPIView):
 	"""
@@ -654,18 +748,7 @@ class SourceApplyEditions(APIView):
 			return JSONResponse (json_answer)
 
 		# We return the full XML file
-		with open(tmp_src.source_file.path, "r") as f:
-			content = f.read()
-			resp = FileResponse(content) 
-			resp['Content-type'] = "text/xml"  # source.source_type.mime_type
-			#resp["Content-Disposition"] = f"attachment; filename={file_name}"
-			resp['Access-Control-Allow-Origin'] = '*'
-			resp['Access-Control-Allow-Credentials'] = "true"
-			resp['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
-			resp['Access-Control-Allow-Headers'] = 'Access-Control-Allow-Headers, Origin, Accept, ' \
-                                'X-Requested-With, Content-Type, Access-Control-Request-Method,' \
-                              ' Access-Control-Request-Headers, credentials'	
-			return resp
+		return file_delivery.serve(request, tmp_src.source_file.path, "text/xml")
 
 class SourceEditions(APIView):
 	
@@ -742,32 +825,18 @@ class SourceFile (APIView):
 	def get(self, request, full_neuma_ref, source_ref):
 		source = self.get_object(full_neuma_ref, source_ref)
 		if source.source_file:
-			try:
-				with open(source.source_file.path, "r", encoding='utf-8') as f:				
-					content = f.read()
-			except Exception as e:
-				# Try utf16 instead
-				with open(source.source_file.path, "r", encoding='utf-16') as f:				
-					content = f.read()
-						
 			file_name = full_neuma_ref.replace (':','-') + '-' + source.ref
 			if source.source_type.mime_type == "application/xml":
 				file_name += ".xml"
 			if source.source_type.mime_type == "application/json":
 				file_name += ".json"
-			resp = FileResponse(content) 
 			if file_name == "manifest.json":
-					resp['Content-type'] =  "application/json"
+				content_type = "application/json"
 			else:
-				resp['Content-type'] =  source.source_type.mime_type
-			resp["Content-Disposition"] = f"attachment; filename={file_name}"
-			resp['Access-Control-Allow-Origin'] = '*'
-			resp['Access-Control-Allow-Credentials'] = "true"
-			resp['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
-			resp['Access-Control-Allow-Headers'] = 'Access-Control-Allow-Headers, Origin, Accept, ' \
-                                               'X-Requested-With, Content-Type, Access-Control-Request-Method,' \
-                                               ' Access-Control-Request-Headers, credentials'	
-			return resp
+				content_type = source.source_type.mime_type
+			# UTF-16 files are sent in UTF-8
+			return file_delivery.serve_as_utf8(request, source.source_file.path, 
+											content_type, file_name)
 		else:
 			return Response(status=status.HTTP_404_NOT_FOUND)
 
@@ -887,6 +956,10 @@ class AnnotationModelStats (APIView):
 			return JSONResponse(serializer.data)
 
 class AnnotationList(generics.ListAPIView):
+	"""
+	 Annotations of an opus, grouped by ref in natural order. Each one is
+	 in the same form as in the other services (see Annotation.W3C_FORM)
+	"""
 
 	serializer_class = AnnotationSerializer
 
@@ -927,16 +1000,38 @@ class AnnotationList(generics.ListAPIView):
 				opus=opus, analytic_concept__model=db_model
 			)
 			
+		# The stored web annotations are read in a single query
 		annotations = {}
-		for annotation in db_annotations:
-			if not annotation.ref in annotations:
-				annotations[annotation.ref] = []
-			annotations[annotation.ref].append(AnnotationSerializer(annotation).data)
+		missing = {}
+		for annot_id, ref, web_annotation in db_annotations.values_list("id", "ref", "web_annotation"):
+			if not ref in annotations:
+				annotations[ref] = []
+			if len(web_annotation) == 0:
+				missing[annot_id] = (ref, len(annotations[ref]))
+			annotations[ref].append(web_annotation)
+
+		if len(missing) > 0:
+			# Produced without being stored: they are stored in the background
+			for annotation in Annotation.objects.filter(id__in=missing.keys()).select_related(
+						"target", "body", "analytic_concept__model", "user"):
+				ref, pos = missing[annotation.id]
+				annotations[ref][pos] = annotation.build_web_annotation().get_json_obj(Annotation.W3C_FORM)
+			try:
+				backfill_web_annotations.delay(opus.ref)
+			except Exception as e:
+				logger.warning (f"Unable to schedule the storage of web annotations: {e}")
+
+		# Refs in natural order
+		refs = get_sorted_refs(annotations.keys(), f"{opus.id}:{model_code}:{concept_code}")
 
-		# Sort in natural order
-		sorted_annotations = dict(natsorted(annotations.items())) 
+		def json_chunks():
+			yield "{"
+			for i, ref in enumerate(refs):
+				sep = "," if i > 0 else ""
+				yield f"{sep}{json.dumps(ref)}:{json.dumps(annotations[ref], ensure_ascii=False, separators=(',', ':'))}"
+			yield "}"
 
-		return JSONResponse(sorted_annotations)
+		return StreamingHttpResponse(json_chunks(), content_type="application/json")
 
 	@extend_schema(operation_id="AnnotationsClear")
 	def delete(self, request, full_neuma_ref, model_code='_stats', concept_code="_all"):
@@ -1007,7 +1102,7 @@ class AnnotationCreate(APIView):
 			schema_file = 'file://' + os.path.join (schema_path, 'annotation_schema.json')
 			# Where  json refs must be solved
 			base_uri='file://' + schema_path + os.sep
-			validator = CollabScoreParser(schema_file, base_uri)
+			validator = CollabScoreParser.get_parser(schema_file, base_uri)
 		except jsonschema.SchemaError as ex:
 			return JSONResponse({"error": "Schema parsing error: " + str (ex)})
 		except Exception as ex:
@@ -1189,17 +1284,7 @@ class ArkIdxGetElementFile (APIView):
 		abs_url = request.build_absolute_uri("/")[:-1]
 		try:
 			opus = Opus.objects.get(ref = self.kwargs['id'])
-			with open(opus.mei.path) as f:
-				content = f.read()
-			resp = FileResponse(content) # sendfile(request, opus.mei.path)
-			resp['Content-type'] = 'application/xml'
-			resp['Access-Control-Allow-Origin'] = '*'
-			resp['Access-Control-Allow-Credentials'] = "true"
-			resp['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
-			resp['Access-Control-Allow-Headers'] = 'Access-Control-Allow-Headers, Origin, Accept, ' \
-                                               'X-Requested-With, Content-Type, Access-Control-Request-Method,' \
-                                               ' Access-Control-Request-Headers, credentials'	
-			return resp
+			return file_delivery.serve(request, opus.mei.path, 'application/xml')
 		except Opus.DoesNotExist:
 			return Response(status=status.HTTP_404_NOT_FOUND)
 		except OpusSource.DoesNotExist:
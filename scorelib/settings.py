@@ -189,6 +189,55 @@ ES_QUERY_DIR = os.path.join(BASE_DIR, "static/queries")
 # Tells whether we use our own ranked search
 ES_RANKED_SEARCH = False
 
+# Cache of parsed scores (frozen music21 streams, keyed by file content)
+SCORE_CACHE_ENABLED = True
+SCORE_CACHE_DIR = os.path.join(MEDIA_ROOT, 'cache', 'scores')
+# Nb of Score objects kept in memory by each process
+SCORE_CACHE_LRU_SIZE = 16
+
+# Artifacts rendered by Verovio (SVG pages, MIDI, MEI pages), keyed by file content
+RENDER_CACHE_DIR = os.path.join(MEDIA_ROOT, 'cache', 'renders')
+# Options of the renderings. Same as the score viewer
+RENDER_OPTIONS = {"scale": 35, "breaks": "encoded", "condense": "auto", "condenseFirstPage": True}
+# Render the artifacts in the background when the files of an opus are replaced
+RENDER_CACHE_PREWARM = True
+
+# Corpus exports produced in the background
+EXPORT_DIR = os.path.join(MEDIA_ROOT, 'exports')
+EXPORT_URL = MEDIA_URL + 'exports/'
+
+# Compressed copies of the files sent by the REST services (see rest.delivery)
+FILE_DELIVERY_CACHE_DIR = os.path.join(MEDIA_ROOT, 'cache', 'files')
+# Let the web server send the files: None, "x-accel-redirect" (nginx) or "x-sendfile" (apache)
+FILE_DELIVERY_SENDFILE = None
+# For nginx: directory -> internal location, e.g. {MEDIA_ROOT: "/protected-media/"}
+FILE_DELIVERY_SENDFILE_LOCATIONS = {}
+# Limits of the compressed copies: total size in bytes, and time without use in seconds
+FILE_DELIVERY_CACHE_MAX_SIZE = 2 * 1024 * 1024 * 1024
+FILE_DELIVERY_CACHE_MAX_AGE = 30 * 24 * 3600
+
+# Nb of processes that decode the pages of a DMOS file (see OmrScore), and
+# that produce its MusicXML document (see collabscore.incremental). 1: no parallelism
+DMOS_PARSER_JOBS = min(4, os.cpu_count() or 1)
+
+# Imports of corpus zip files (see manager.importer): nb of conversion
+# processes, nb of opera written in a transaction, journals of the imports
+IMPORT_JOBS = min(4, os.cpu_count() or 1)
+IMPORT_BATCH_SIZE = 50
+IMPORT_JOURNAL_DIR = os.path.join(MEDIA_ROOT, 'cache', 'imports')
+
+# Backend of the searches: "elasticsearch", or "ngram" for the local
+# n-gram index (see neumasearch.NgramIndex)
+SEARCH_BACKEND = "elasticsearch"
+NGRAM_INDEX_PATH = os.path.join(MEDIA_ROOT, 'index', 'ngrams.idx')
+
+# Cache of search results (in the Django cache, see CACHES), invalidated when opera are indexed
+SEARCH_CACHE_ENABLED = True
+# In seconds
+SEARCH_CACHE_TIMEOUT = 3600
+# Natural order of the annotation refs of an opus, in seconds
+ANNOTATION_REFS_CACHE_TIMEOUT = 24 * 3600
+
 #
 # Site configuration paramaters
 #
@@ -264,6 +313,15 @@ ELASTIC_SEARCH = {"host": "cchumweb05.in2p3.fr", "port": 11420, "index": "scorel
 REDIS_HOST = env("REDIS_HOST")
 REDIS_PORT = int(env("REDIS_PORT"))
 
+# Django cache, shared by the web server, Celery and the commands: the search
+# results cached there are invalidated when opera are indexed (see neumasearch.SearchCache)
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": "redis://%s:%d/1" % (REDIS_HOST, REDIS_PORT),
+    }
+}
+
 # Celery
 CELERY_BROKER_URL = "redis://%s:%d/0" % (REDIS_HOST, REDIS_PORT)
 CELERY_RESULT_BACKEND = 'django-db'